@@ -1,40 +1,408 @@
-_timer_setup = """
-from cPickle import dumps as pickle_dumps, loads as pickle_loads
-from json import dumps as json_dumps, loads as json_loads
-from marshal import dumps as marshal_dumps, loads as marshal_loads
-from kson import dumps as kson_dumps, loads as kson_loads, add_schema
-
-def mkd(n):
-    return {
-        'id': n,
-        'value_a': n * 2,
-        'value_b': str(n*n)
-    }
-l = [mkd(i) for i in range(1000)]
-
-add_schema('["schema", "test", ["id", "value_a", "value_b"], [0, 0, 0]]')
-
-raw_pickle = pickle_dumps(l)
-raw_marshal = marshal_dumps(l)
-raw_json = json_dumps(l)
-raw_kson = kson_dumps(l, '[]test')
-"""
+#!/usr/bin/env python
+"""KSON benchmarks
+
+Compares kson serialization (text, columnar, binary, streaming, codegen)
+with json/ujson/orjson for the fixtures in test_data and for generated
+codec heavy data. Reports time per call, throughput, peak allocations
+and serialized sizes. Text kson is measured with each available json
+backend, e.g. "dumps/movies/kson@orjson".
+
+Usage:
+    bench_kson.py [options] [<pattern>...]
 
+Options:
+    -h --help           Show help
+    -q --quick          Smaller generated datasets and fewer repetitions
+    -r --repeat=<n>     Number of timing repetitions [default: 5]
+    --save=<path>       Save results as a baseline
+    --compare=<path>    Compare results with a saved baseline
+    --threshold=<pct>   Slowdown reported as regression [default: 10]
+    --no-alloc          Skip measuring allocations
+"""
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import fnmatch
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
 from timeit import Timer
 
+import kson
+from kson.command import main as kson_main
+
+FIXTURES_PATH = os.path.abspath(os.path.dirname(__file__) + "/../test_data/")
+FIXTURES_PATH += "/"
+
+JSON_LIBS = {'json': (
+    lambda data: json.dumps(data, separators=(",", ":")), json.loads
+)}
+
+try:
+    import ujson
+    JSON_LIBS['ujson'] = (ujson.dumps, ujson.loads)
+except ImportError:
+    pass
+
+try:
+    import orjson
+    JSON_LIBS['orjson'] = (orjson.dumps, orjson.loads)
+except ImportError:
+    pass
+
+
+def _available_backends():
+    default = kson.get_backend()
+    backends = []
+    for name in sorted(kson.JSON_BACKENDS):
+        try:
+            kson.set_backend(name)
+            backends.append(name)
+        except ImportError:
+            pass
+    kson.set_backend(default)
+    return backends
+
+
+BACKENDS = _available_backends()
+
+BENCHMARKS = []
+
+
+def benchmark(name, backend=None):
+    """decorator to register a benchmark
+
+    The decorated function is called once for setup and returns the
+    function to time and a dict with the number of 'bytes' and
+    'records' which are processed per call. If backend is given, the
+    json backend is selected before setup.
+    """
+    def dec(setup):
+        BENCHMARKS.append((name, setup, backend))
+        return setup
+    return dec
+
+
+## datasets
+
+
+def _read_json(filename):
+    with open(FIXTURES_PATH + filename) as f:
+        return json.load(f)
+
+
+def _movies(quick):
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = _read_json("movies.json")['content']['movies']
+    return movies * (20 if quick else 200)
+
+
+def _fb_photos(quick):
+    kson.load_schemas(FIXTURES_PATH + "fb_photo_schemas_plain.json")
+    return _read_json("fb_photos.json")
+
+
+def _fb_photos_compressed(quick):
+    kson.load_schemas(FIXTURES_PATH + "fb_photo_schemas_uncompressed.json")
+    kson.load_schemas(FIXTURES_PATH + "fb_photo_schemas_compressed.json")
+    with open(FIXTURES_PATH + "fb_photos_nomin.kson") as f:
+        return kson.loads(f.read(), "uc-fb-photos")
+
+
+def _telemetry(quick, schema_id="bench-telemetry",
+               meta=("date|int36", "prefix:host-", "enum:cpu:io:net:disk",
+                     "bool", "int36", 0)):
+    kson.add_schema({
+        'id': schema_id,
+        'fields': ["time", "host", "kind", "ok", "count", "load"],
+        'meta': list(meta),
+    })
+    start = datetime(2013, 4, 2)
+    kinds = ["cpu", "io", "net", "disk"]
+    return [{
+        'time': start + timedelta(seconds=i * 15),
+        'host': "host-%d" % (i % 32),
+        'kind': kinds[i % 4],
+        'ok': i % 7 != 0,
+        'count': i * 7919,
+        'load': (i % 100) / 10.0,
+    } for i in range(10000 if quick else 100000)]
+
+
+def _telemetry_delta(quick):
+    return _telemetry(quick, "bench-telemetry-delta", (
+        "date|delta", "prefix:host-", "enum:cpu:io:net:disk", "bool",
+        "delta", 0
+    ))
+
+
+DATASETS = [
+    # name, loader, schema id, plain json compatible
+    ("movies", _movies, "[]movies-item", True),
+    ("fb_photos", _fb_photos, "fb-photos", True),
+    ("fb_photos_codecs", _fb_photos_compressed, "c-fb-photos", False),
+    ("telemetry", _telemetry, "[]bench-telemetry", False),
+    ("telemetry_delta", _telemetry_delta, "[]bench-telemetry-delta", False),
+]
+
+
+def _n_records(data):
+    return len(data) if isinstance(data, list) else 1
+
+
+def _register_dataset(name, loader, schema_id, is_json, quick):
+    try:
+        data = loader(quick)
+    except ImportError as err:
+        sys.stderr.write("skipping %s: %s\n" % (name, err))
+        return None
+
+    raw = kson.dumps(data, schema_id)
+    raw_bytes = raw.encode('utf-8')
+    raw_bin = kson.dumpb(data, schema_id)
+    info = {'bytes': len(raw_bytes), 'records': _n_records(data)}
+
+    for backend in BACKENDS:
+        @benchmark("dumps/%s/kson@%s" % (name, backend), backend)
+        def bench_dumps():
+            return lambda: kson.dumps(data, schema_id), info
+
+        @benchmark("dumps/%s/kson-bytes@%s" % (name, backend), backend)
+        def bench_dumps_bytes():
+            return lambda: kson.dumps(data, schema_id, as_bytes=True), info
+
+        @benchmark("loads/%s/kson@%s" % (name, backend), backend)
+        def bench_loads():
+            return lambda: kson.loads(raw), info
+
+        @benchmark("loads/%s/kson-bytes@%s" % (name, backend), backend)
+        def bench_loads_bytes():
+            return lambda: kson.loads(raw_bytes), info
+
+    @benchmark("loads/%s/kson-lazy" % name)
+    def bench_loads_lazy():
+        return lambda: kson.loads(raw, lazy=True), info
+
+    @benchmark("dumps/%s/kson-binary" % name)
+    def bench_dumpb():
+        return lambda: kson.dumpb(data, schema_id), info
+
+    @benchmark("loads/%s/kson-binary" % name)
+    def bench_loadb():
+        return lambda: kson.loadb(raw_bin), info
+
+    if schema_id.startswith("[]"):
+        raw_cols = kson.dumps(data, schema_id, layout="columnar")
+
+        @benchmark("dumps/%s/kson-columnar" % name)
+        def bench_dumps_columnar():
+            return lambda: kson.dumps(data, schema_id, layout="columnar"), info
+
+        @benchmark("loads/%s/kson-columnar" % name)
+        def bench_loads_columnar():
+            return lambda: kson.loads(raw_cols), info
+
+        @benchmark("dumps/%s/kson-stream" % name)
+        def bench_dump_iter():
+            return lambda: kson.dump_iter(iter(data), io.StringIO(),
+                                          schema_id), info
+
+        @benchmark("loads/%s/kson-stream" % name)
+        def bench_iterload():
+            return lambda: list(kson.iterload(io.StringIO(raw))), info
+
+    if is_json:
+        for lib_name, (lib_dumps, lib_loads) in sorted(JSON_LIBS.items()):
+            raw_json = lib_dumps(data)
+            json_info = dict(info, bytes=len(raw_json))
+
+            @benchmark("dumps/%s/%s" % (name, lib_name))
+            def bench_json_dumps(lib_dumps=lib_dumps):
+                return lambda: lib_dumps(data), json_info
+
+            @benchmark("loads/%s/%s" % (name, lib_name))
+            def bench_json_loads(lib_loads=lib_loads, raw_json=raw_json):
+                return lambda: lib_loads(raw_json), json_info
+
+    return data, schema_id, is_json
+
+
+def _register_codegen(datasets):
+    # registered last, since codegen changes the plans of the schemas
+    for name, data, schema_id, _ in datasets:
+        def setup_codegen(schema_id=schema_id):
+            for plan in list(kson.PLANS.values()):
+                kson.add_schema(kson.SCHEMAS[plan.schema_id], codegen=True)
+
+        raw = kson.dumps(data, schema_id)
+        info = {'bytes': len(raw.encode('utf-8')), 'records': _n_records(data)}
+
+        @benchmark("dumps/%s/kson-codegen" % name)
+        def bench_codegen_dumps(data=data, schema_id=schema_id, info=info,
+                                setup_codegen=setup_codegen):
+            setup_codegen()
+            return lambda: kson.dumps(data, schema_id), info
+
+        @benchmark("loads/%s/kson-codegen" % name)
+        def bench_codegen_loads(raw=raw, info=info,
+                                setup_codegen=setup_codegen):
+            setup_codegen()
+            return lambda: kson.loads(raw), info
+
+
+def _register_misc():
+    fb_photos = _read_json("fb_photos.json")
+    fb_raw = json.dumps(fb_photos)
+    fb_info = {'bytes': len(fb_raw), 'records': 1}
+
+    @benchmark("detect_schemas/fb_photos")
+    def bench_detect_schemas():
+        return lambda: kson.detect_schemas(
+            fb_photos, id_prefix="bench-detect"
+        ), fb_info
+
+    tmp_dir = tempfile.mkdtemp(prefix="kson_bench_")
+    out_path = os.path.join(tmp_dir, "fb_photos.kson")
+
+    @benchmark("cli/j2k/fb_photos")
+    def bench_cli_j2k():
+        args = [
+            "j2k", FIXTURES_PATH + "fb_photo_schemas_plain.json",
+            "--schema_id", "fb-photos",
+            "--input", FIXTURES_PATH + "fb_photos.json",
+            "--output", out_path,
+        ]
+        return lambda: kson_main(args), fb_info
+
+
+## sizes
+
+
+def print_sizes(datasets):
+    print("%-20s %-16s %10s %10s" % ("dataset", "format", "size", "gzipped"))
+    for name, data, schema_id, is_json in datasets:
+        sizes = [
+            ("kson", kson.dumps(data, schema_id).encode('utf-8')),
+            ("kson-binary", kson.dumpb(data, schema_id)),
+        ]
+        if schema_id.startswith("[]"):
+            raw_cols = kson.dumps(data, schema_id, layout="columnar")
+            sizes.append(("kson-columnar", raw_cols.encode('utf-8')))
+        if is_json:
+            sizes.append(("json", JSON_LIBS['json'][0](data).encode('utf-8')))
+
+        for fmt, raw in sizes:
+            gz_size = len(gzip.compress(raw))
+            print("%-20s %-16s %10d %10d" % (name, fmt, len(raw), gz_size))
+    print("")
+
+
+## running
+
+
+def _time(fn, repeat):
+    timer = Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def _peak_alloc(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(patterns, repeat, measure_alloc):
+    results = {}
+    header = "%-42s %10s %10s %12s %10s" % (
+        "benchmark", "ms/call", "MB/s", "records/s", "peak KB"
+    )
+    print(header)
+    print("-" * len(header))
+
+    default_backend = kson.get_backend()
+    for name, setup, backend in BENCHMARKS:
+        if patterns and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+
+        kson.set_backend(backend or default_backend)
+        fn, info = setup()
+        secs = _time(fn, repeat)
+        peak = _peak_alloc(fn) if measure_alloc else 0
+        results[name] = {
+            'seconds': secs,
+            'peak_alloc': peak,
+            'bytes': info['bytes'],
+            'records': info['records'],
+        }
+        print("%-42s %10.3f %10.1f %12.0f %10.0f" % (
+            name, secs * 1000, info['bytes'] / secs / 1e6,
+            info['records'] / secs, peak / 1024.0
+        ))
+        sys.stdout.flush()
+
+    kson.set_backend(default_backend)
+    print("")
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print("%-42s %10s %10s %8s" % ("benchmark", "base ms", "ms", "change"))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base_secs = baseline[name]['seconds']
+        change = (result['seconds'] - base_secs) / base_secs * 100
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print("%-42s %10.3f %10.3f %+7.1f%%%s" % (
+            name, base_secs * 1000, result['seconds'] * 1000, change, flag
+        ))
+    print("")
+    return regressions
+
+
+def main(args=sys.argv[1:]):
+    from docopt import docopt
+    opts = docopt(__doc__, args)
+    quick = opts['--quick']
+    repeat = 3 if quick else int(opts['--repeat'])
+
+    datasets = []
+    for name, loader, schema_id, is_json in DATASETS:
+        registered = _register_dataset(name, loader, schema_id, is_json, quick)
+        if registered:
+            datasets.append((name,) + registered)
+    _register_misc()
+    _register_codegen(datasets)
 
-def timeit(stmt):
-    return min(Timer(stmt, setup=_timer_setup).repeat(3, 100))
+    print_sizes(datasets)
+    started = time.time()
+    results = run(opts['<pattern>'], repeat, not opts['--no-alloc'])
+    print("total: %.1fs\n" % (time.time() - started))
 
+    if opts['--save']:
+        with open(opts['--save'], 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
 
-print "dumps json   ", timeit("json_dumps(l)")
-print "dumps kson   ", timeit("kson_dumps(l, '[]test')")
+    if opts['--compare']:
+        with open(opts['--compare']) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, float(opts['--threshold']))
+        if regressions:
+            return 1
 
-print "loads json   ", timeit("json_loads(raw_json)")
-print "loads kson   ", timeit("kson_loads(raw_kson)")
+    return 0
 
-print "dumps pickle ", timeit("pickle_dumps(l)")
-print "dumps marshal", timeit("marshal_dumps(l)")
 
-print "loads pickle ", timeit("pickle_loads(raw_pickle)")
-print "loads marshal", timeit("marshal_loads(raw_marshal)")
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,16 +24,24 @@
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
+import io
 import os
 import re
 import sys
 import json
+import mmap
 import string
-import collections
-from base64 import b64encode
+import weakref
+import threading
+from operator import attrgetter
 from datetime import datetime
 from calendar import timegm
 
+try:
+    from collections.abc import Iterable, Mapping, Sequence
+except ImportError:
+    from collections import Iterable, Mapping, Sequence
+
 __version__ = "0.1.0"
 
 PY2 = sys.version < '3'
@@ -45,27 +53,165 @@ def default_json_dumps(*args, **kwargs):
     kwargs['separators'] = (",", ":")
     return json.dumps(*args, **kwargs)
 
-try:
+
+## json backends
+#
+# Backend factories return (dumps, dumps_bytes, loads) functions. loads
+# accepts str, bytes, bytearray and memoryview objects.
+
+
+def _buffer_to_bytes(data):
+    if isinstance(data, (bytearray, memoryview)):
+        return bytes(data)
+    return data
+
+
+def _json_backend():
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"))
+
+    def dumps_bytes(obj):
+        return dumps(obj).encode('utf-8')
+
+    def loads(data):
+        return json.loads(_buffer_to_bytes(data))
+
+    return dumps, dumps_bytes, loads
+
+
+def _ujson_backend():
     import ujson
-    json_loads = ujson.loads
 
-    def json_dumps(*args, **kwargs):
-        kwargs['encode_html_chars'] = False
-        kwargs['ensure_ascii'] = False
-        return ujson.dumps(*args, **kwargs)
-except ImportError:
-    json_dumps = default_json_dumps
-    json_loads = default_json_loads
+    def dumps(obj):
+        return ujson.dumps(obj, encode_html_chars=False, ensure_ascii=False)
+
+    def dumps_bytes(obj):
+        return dumps(obj).encode('utf-8')
+
+    def loads(data):
+        return ujson.loads(_buffer_to_bytes(data))
+
+    return dumps, dumps_bytes, loads
+
+
+def _orjson_backend():
+    # orjson is only used if selected explicitly, since it is lossy:
+    # integers which don't fit into 64 bits are loaded as floats and
+    # NaN/Infinity are dumped as null.
+    import orjson
+
+    # datetimes and other types which json can't serialize are passed to
+    # the fallback, which raises the same TypeError as the json backend
+    option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+              orjson.OPT_PASSTHROUGH_DATACLASS)
+    fallback_dumps_bytes = _json_backend()[1]
+
+    def dumps_bytes(obj):
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            # e.g. integers which don't fit into 64 bits
+            return fallback_dumps_bytes(obj)
+
+    def dumps(obj):
+        return dumps_bytes(obj).decode('utf-8')
+
+    return dumps, dumps_bytes, orjson.loads
+
+
+def _simdjson_backend():
+    import simdjson
+
+    try:
+        dumps, dumps_bytes = _orjson_backend()[:2]
+    except ImportError:
+        dumps, dumps_bytes = _json_backend()[:2]
+
+    def loads(data):
+        return simdjson.loads(_buffer_to_bytes(data))
+
+    return dumps, dumps_bytes, loads
+
+
+JSON_BACKENDS = {
+    'json': _json_backend,
+    'ujson': _ujson_backend,
+    'orjson': _orjson_backend,
+    'simdjson': _simdjson_backend,
+}
 
+# backends tried in order by set_backend("auto"), only lossless ones
+AUTO_BACKENDS = ('ujson', 'json')
+
+# name, dumps, dumps_bytes, loads
+_backend = None
+
+# kson.stats.Stats which collects statistics, see kson.stats.enable_stats
+_stats = None
+
+
+def set_backend(name="auto"):
+    """select the json library which is used for kson documents
+
+    name is one of JSON_BACKENDS or "auto" for the first one of
+    AUTO_BACKENDS which can be imported. Raises ImportError if the
+    library isn't installed. Returns the name of the backend.
+    """
+    global _backend
+    if name == "auto":
+        for auto_name in AUTO_BACKENDS:
+            try:
+                return set_backend(auto_name)
+            except ImportError:
+                pass
+
+    if name not in JSON_BACKENDS:
+        raise ValueError("Invalid json backend: " + str(name))
+
+    _backend = (name,) + tuple(JSON_BACKENDS[name]())
+    if _stats is not None:
+        _backend = _stats.wrap_backend(_backend)
+    return name
+
+
+def get_backend():
+    return _backend[0]
+
+
+def json_dumps(obj):
+    return _backend[1](obj)
+
+
+def json_dumps_bytes(obj):
+    return _backend[2](obj)
+
+
+def json_loads(data):
+    return _backend[3](data)
+
+
+set_backend(os.environ.get('KSON_JSON_BACKEND', "auto"))
 
-DECODERS = {}
-ENCODERS = {}
 
 CODEC_FACTORIES = {}
-SCHEMAS = {}
+
+# factories of codecs whose values depend on previous values of the
+# document and of codecs whose *_many functions code a whole sequence
+STATEFUL_CODECS = set()
+SEQUENCE_CODECS = set()
 
 _verbose = False
 
+# all registries, their plans are recompiled when stats are enabled
+_REGISTRIES = weakref.WeakSet()
+
+# layouts of "[]schema" documents
+ROWS = "rows"
+COLUMNAR = "columnar"
+
+# schema id prefix of documents with columnar layout
+COLUMNAR_PREFIX = u"||"
+
 
 def _plain_id(id):
     return id[2:] if id and id[0] == u"[" else id
@@ -85,68 +231,84 @@ def baseN(num, b=36, digits=string.digits + string.ascii_letters):
 ## codec management
 
 
-def add_codec(codec_or_name):
-    """decorator to register a kson codec factory function"""
-    if not isinstance(codec_or_name, (str, bytes)):
-        # assume the argument is the factory function
-        codec = codec_or_name
-        name = codec.__name__
-        CODEC_FACTORIES[name] = codec
-        return codec
+def add_codec(codec_or_name, stateful=False, sequence=False):
+    """decorator to register a kson codec factory function
 
-    name = codec_or_name
+    The factory is called with the list of codec args and returns an
+    (encoder, decoder) tuple. It may also return an (encoder, decoder,
+    encode_many, decode_many) tuple, where the *_many functions code a
+    whole list of values at once and are used for "[]codec" fields.
+    Either of them may be None.
+
+    stateful codecs keep the state of a document using _document_tables,
+    the encoder/decoder of such codecs are created for each field.
 
+    The *_many functions of sequence codecs code the values in relation
+    to each other and may change the length of the list. They are also
+    used for the columns of fields with columnar layout.
+    """
     def dec(codec):
         CODEC_FACTORIES[name] = codec
+        if stateful:
+            STATEFUL_CODECS.add(codec)
+        if sequence:
+            SEQUENCE_CODECS.add(codec)
         return codec
 
+    if not isinstance(codec_or_name, (str, bytes)):
+        # assume the argument is the factory function
+        name = codec_or_name.__name__
+        return dec(codec_or_name)
+
+    name = codec_or_name
     return dec
 
 
-def coder_fn(coders):
-    def coder(val):
-        for c in coders:
-            val = c(val)
-        return val
-    return coder
+def _identity(val):
+    return val
 
 
-CODEC_RE = re.compile(r"(?:\\.|[^\|])+")
-ARGS_RE = re.compile(r"(?:\\.|[^:])+")
+def coder_fn(coders):
+    """fuse a chain of coders into a single function"""
+    if not coders:
+        return _identity
+    if len(coders) == 1:
+        return coders[0]
 
+    ns = dict(("c%d" % i, c) for i, c in enumerate(coders))
+    src = "val"
+    for i in range(len(coders)):
+        src = "c%d(%s)" % (i, src)
+    return eval("lambda val: " + src, ns)
 
-def init_codec(meta_id):
-    if not meta_id or meta_id in ENCODERS:
-        return
 
-    metas = CODEC_RE.findall(meta_id)
+def many_coder_fn(coders, many_coders):
+    """fuse a chain of coders into a function which codes lists"""
+    if not any(many_coders):
+        coder = coder_fn(coders)
 
-    encoders = []
-    decoders = []
+        def coder_many(vals):
+            return [None if v is None else coder(v) for v in vals]
 
-    for meta in metas:
-        args = ARGS_RE.findall(meta)
-        codec_id = args[0]
-        if codec_id not in CODEC_FACTORIES:
-            return
+        return coder_many
 
-        args = args[1:]
-        for j, arg in enumerate(args):
-            args[j] = arg.replace("\\", "")
+    return coder_fn([
+        many or many_coder_fn([coder], [None])
+        for coder, many in zip(coders, many_coders)
+    ])
 
-        enc, dec = CODEC_FACTORIES[codec_id](args)
-        encoders.append(enc)
-        decoders.append(dec)
 
-    ENCODERS[meta_id] = coder_fn(encoders)
-    DECODERS[meta_id] = coder_fn(list(reversed(decoders)))
+CODEC_RE = re.compile(r"(?:\\.|[^\|])+")
+ARGS_RE = re.compile(r"(?:\\.|[^:])+")
 
 
-def init_codecs(schema):
-    for meta_id in schema['meta']:
-        meta_id = _plain_id(meta_id)
-        if meta_id:
-            init_codec(meta_id)
+def parse_codecs(meta_id):
+    """split a codec chain into a list of (codec_id, args) tuples"""
+    codecs = []
+    for meta in CODEC_RE.findall(meta_id):
+        args = ARGS_RE.findall(meta)
+        codecs.append((args[0], [arg.replace("\\", "") for arg in args[1:]]))
+    return codecs
 
 
 # default codecs
@@ -155,31 +317,41 @@ def init_codecs(schema):
 @add_codec('suffix')
 def suffix_codec(args):
     suffix = args[0]
+    n = len(suffix)
+    if n == 0:
+        return _identity, _identity
 
     def encoder(val):
         if not val.endswith(suffix):
             raise ValueError("Expected %s to have suffix %s" % (val, suffix))
-        return val.rsplit(suffix, 1)[0]
+        return val[:-n]
 
     def decoder(raw):
         return raw + suffix
 
-    return encoder, decoder
+    def decode_many(raws):
+        return [raw + suffix for raw in raws]
+
+    return encoder, decoder, None, decode_many
 
 
 @add_codec('prefix')
 def prefix_codec(args):
     prefix = args[0]
+    n = len(prefix)
 
     def encoder(val):
         if not val.startswith(prefix):
             raise ValueError("Expected %s to have prefix %s" % (val, prefix))
-        return val.replace(prefix, "", 1)
+        return val[n:]
 
     def decoder(raw):
         return prefix + raw
 
-    return encoder, decoder
+    def decode_many(raws):
+        return [prefix + raw for raw in raws]
+
+    return encoder, decoder, None, decode_many
 
 
 @add_codec('bool')
@@ -187,29 +359,45 @@ def bool_codec(args):
     def encoder(val):
         return 1 if val else 0
 
-    def decoder(raw):
-        return bool(raw)
+    def encode_many(vals):
+        return [1 if val else 0 for val in vals]
 
-    return encoder, decoder
+    def decode_many(raws):
+        return list(map(bool, raws))
+
+    return encoder, bool, encode_many, decode_many
 
 
 @add_codec('enum')
 def enum_codec(args):
-    args = args[:]
-    args.insert(0, 0)
+    values = [0] + list(args)
+    indexes = {}
+    for i, val in enumerate(values):
+        indexes.setdefault(val, i)
+    get_index = indexes.get
 
     def encoder(val):
         try:
-            return args.index(val)
-        except ValueError:
+            return get_index(val, val)
+        except TypeError:
+            # unhashable values are not in the enum
             return val
 
     def decoder(raw):
         if isinstance(raw, int):
-            return args[raw]
+            return values[raw]
         return raw
 
-    return encoder, decoder
+    def encode_many(vals):
+        try:
+            return [get_index(val, val) for val in vals]
+        except TypeError:
+            return [encoder(val) for val in vals]
+
+    def decode_many(raws):
+        return [values[raw] if isinstance(raw, int) else raw for raw in raws]
+
+    return encoder, decoder, encode_many, decode_many
 
 
 @add_codec('int36')
@@ -220,7 +408,10 @@ def int36_codec(args):
     def decoder(val):
         return int(val, 36)
 
-    return encoder, decoder
+    def decode_many(vals):
+        return [int(val, 36) for val in vals]
+
+    return encoder, decoder, None, decode_many
 
 
 @add_codec('date')
@@ -228,10 +419,16 @@ def date_codec(args):
     def encoder(val):
         return timegm(val.utctimetuple())
 
-    def decoder(val):
-        return datetime.utcfromtimestamp(val)
+    def encode_many(vals):
+        return [None if val is None else timegm(val.utctimetuple())
+                for val in vals]
 
-    return encoder, decoder
+    decoder = datetime.utcfromtimestamp
+
+    def decode_many(vals):
+        return [None if val is None else decoder(val) for val in vals]
+
+    return encoder, decoder, encode_many, decode_many
 
 
 @add_codec('iso8601')
@@ -247,120 +444,1014 @@ def isodate_codec(args):
     return encoder, decoder
 
 
-## schema
+## string interning
+#
+# The intern codec writes the first occurrence of a string in a document
+# as it is and later occurrences as the index of the first one. Fields
+# with the same codec args (e.g. "intern" or "intern:names") share one
+# string table. Strings must not be transformed after interning, so
+# intern should be the last codec of a chain. The string tables of the
+# current document are kept in a thread local, which dumps, loads and
+# the streaming encoder/decoder set up for each document.
+#
+# Since values refer to previous values of the document, documents must
+# be decoded in order, which excludes lazy decoding, projection and
+# random access.
+
+_document = threading.local()
+
+STRING_TYPES = (str, unicode) if PY2 else (str,)
+
+
+def _enter_document(tables=None):
+    """sets up the string tables of a document, returns the previous ones"""
+    prev_tables = getattr(_document, 'tables', None)
+    _document.tables = {} if tables is None else tables
+    return prev_tables
+
+
+def _exit_document(prev_tables):
+    _document.tables = prev_tables
+
+
+def _in_document(registry, fn, *args):
+    """calls fn with the string tables of a new document, if needed"""
+    if not registry.stateful:
+        return fn(*args)
+    prev_tables = _enter_document()
+    try:
+        return fn(*args)
+    finally:
+        _exit_document(prev_tables)
+
+
+def _document_tables():
+    tables = getattr(_document, 'tables', None)
+    if tables is None:
+        raise ValueError("intern codec used outside of a document")
+    return tables
+
+
+@add_codec('intern', stateful=True)
+def intern_codec(args):
+    enc_key = ('intern-enc',) + tuple(args)
+    dec_key = ('intern-dec',) + tuple(args)
+
+    def encoder(val):
+        if not isinstance(val, STRING_TYPES):
+            raise ValueError("intern codec requires strings, got %r" % (val,))
+        indexes = _document_tables().get(enc_key)
+        if indexes is None:
+            indexes = _document_tables()[enc_key] = {}
+        index = indexes.get(val)
+        if index is not None:
+            return index
+        indexes[val] = len(indexes)
+        return val
+
+    def decoder(val):
+        strings = _document_tables().get(dec_key)
+        if strings is None:
+            strings = _document_tables()[dec_key] = []
+        if isinstance(val, int):
+            return strings[val]
+        strings.append(val)
+        return val
+
+    return encoder, decoder
+
+
+## sequence codecs
+#
+# For "[]codec" fields and columns of the columnar layout, the values of
+# a field are coded as a sequence. For other fields, delta and dod refer
+# to the value of the previous record of the document.
+
+
+# None is passed through and doesn't change the running value, like
+# None values of other fields, which aren't passed to the coder.
+
+
+def _deltas(vals):
+    prev = 0
+    result = []
+    append = result.append
+    for val in vals:
+        if val is None:
+            append(None)
+            continue
+        append(val - prev)
+        prev = val
+    return result
+
+
+def _sums(raws):
+    val = 0
+    result = []
+    append = result.append
+    for raw in raws:
+        if raw is None:
+            append(None)
+            continue
+        val += raw
+        append(val)
+    return result
 
 
-def add_schema(schema):
-    if isinstance(schema, (str, bytes)):
-        schema = loads(schema)
+@add_codec('delta', stateful=True, sequence=True)
+def delta_codec(args):
+    """differences to the previous value, for sorted integers and dates"""
+    # identifies the state of the field in the document tables
+    key = object()
+
+    def encoder(val):
+        tables = _document_tables()
+        prev = tables.get(key, 0)
+        tables[key] = val
+        return val - prev
+
+    def decoder(raw):
+        tables = _document_tables()
+        val = tables[key] = tables.get(key, 0) + raw
+        return val
+
+    return encoder, decoder, _deltas, _sums
+
+
+@add_codec('dod', stateful=True, sequence=True)
+def dod_codec(args):
+    """delta of delta, for integers and dates at (nearly) regular steps"""
+    key = object()
+
+    def encoder(val):
+        tables = _document_tables()
+        prev, prev_delta = tables.get(key, (0, 0))
+        delta = val - prev
+        tables[key] = (val, delta)
+        return delta - prev_delta
+
+    def decoder(raw):
+        tables = _document_tables()
+        prev, prev_delta = tables.get(key, (0, 0))
+        delta = prev_delta + raw
+        val = prev + delta
+        tables[key] = (val, delta)
+        return val
+
+    def encode_many(vals):
+        return _deltas(_deltas(vals))
+
+    def decode_many(raws):
+        return _sums(_sums(raws))
+
+    return encoder, decoder, encode_many, decode_many
+
+
+@add_codec('rle', sequence=True)
+def rle_codec(args):
+    """run length encoding, runs are written as [value, length]
+
+    Only sequences can be run length encoded, so it can't be used for
+    fields of records in row layout.
+    """
+    def encoder(val):
+        raise ValueError("rle codec requires a [] field or columnar layout")
+
+    decoder = encoder
+
+    def encode_many(vals):
+        result = []
+        append = result.append
+        n_vals = len(vals)
+        i = 0
+        while i < n_vals:
+            val = vals[i]
+            if isinstance(val, list):
+                raise ValueError("rle codec can't encode lists")
+            run_end = i + 1
+            while (run_end < n_vals and vals[run_end] == val and
+                   type(vals[run_end]) is type(val)):
+                run_end += 1
+            append(val if run_end - i == 1 else [val, run_end - i])
+            i = run_end
+        return result
+
+    def decode_many(raws):
+        result = []
+        for raw in raws:
+            if isinstance(raw, list):
+                result.extend(raw[:1] * raw[1])
+            else:
+                result.append(raw)
+        return result
+
+    return encoder, decoder, encode_many, decode_many
+
+
+## schema plans
+
+
+class SchemaPlan(object):
+    """Precompiled encoding/decoding instructions for a schema.
+
+    Nested schemas and codec chains are resolved when the plan is
+    compiled, so dumps and loads only execute the per field coders.
+    """
+
+    __slots__ = (
+        'schema_id', 'registry', 'fields', 'n_fields', 'encoders',
+        'decoders', 'column_encoders', 'column_decoders', 'field_index',
+        'field_decoders', 'attr_values', 'projection', 'stateful',
+        'dump_rows', 'load_rows',
+    )
+
+    def __init__(self, schema_id, fields, registry):
+        self.schema_id = schema_id
+        self.registry = registry
+        self.fields = tuple(fields)
+        self.n_fields = len(fields)
+        # (index, coder) and (field, coder) pairs for fields which
+        # are not plain values
+        self.encoders = ()
+        self.decoders = ()
+        # the same for coders of the columns of the columnar layout
+        self.column_encoders = ()
+        self.column_decoders = ()
+        self.field_index = dict((f, i) for i, f in enumerate(self.fields))
+        self.field_decoders = {}
+        # values of record objects (which aren't mappings) in field order
+        if self.n_fields == 1:
+            getter = attrgetter(self.fields[0])
+            self.attr_values = lambda obj: (getter(obj),)
+        elif self.n_fields:
+            self.attr_values = attrgetter(*self.fields)
+        else:
+            self.attr_values = lambda obj: ()
+        # (field, index, decoder, column decoder) of the fields which are
+        # decoded by plans of loads(..., fields=[...]), None for complete
+        # plans
+        self.projection = None
+        # True if the schema or its nested schemas use STATEFUL_CODECS
+        self.stateful = False
+        # replaced by generated functions for schemas added with codegen
+        self.dump_rows = _dump_rows
+        self.load_rows = _load_rows
+
+
+def _dump_rows(plan, data, result):
+    fields = plan.fields
+    encoders = plan.encoders
+    extend = result.extend
+
+    for obj in data:
+        if obj.__class__ is dict or isinstance(obj, Mapping):
+            vals = list(map(obj.get, fields))
+        else:
+            vals = list(plan.attr_values(obj))
+        for i, coder in encoders:
+            val = vals[i]
+            if val is not None:
+                vals[i] = coder(val)
+        extend(vals)
+
+
+def _load_rows(plan, data, start, result):
+    fields = plan.fields
+    n_fields = plan.n_fields
+    decoders = plan.decoders
+    append = result.append
+
+    for i in range(start, len(data), n_fields):
+        obj = dict(zip(fields, data[i:i + n_fields]))
+        for field, coder in decoders:
+            val = obj.get(field)
+            if val is not None:
+                obj[field] = coder(val)
+        append(obj)
+
+
+def _load_projected_rows(plan, data, start, result):
+    n_fields = plan.n_fields
+    n_data = len(data)
+    projection = plan.projection
+    plain = [(f, i) for f, i, coder, _ in projection if coder is None]
+    coded = [(f, i, c) for f, i, c, _ in projection if c is not None]
+    append = result.append
+
+    for row in range(start, n_data, n_fields):
+        if row + n_fields > n_data:
+            # incomplete trailing record
+            plain = [(f, i) for f, i in plain if row + i < n_data]
+            coded = [(f, i, c) for f, i, c in coded if row + i < n_data]
+        obj = {}
+        for field, i in plain:
+            obj[field] = data[row + i]
+        for field, i, coder in coded:
+            val = data[row + i]
+            obj[field] = val if val is None else coder(val)
+        append(obj)
+
+
+def _projection_tree(fields):
+    """nested dict of field paths, None selects the complete value
+
+    >>> _projection_tree(["title", "actors.name", "actors.role"])
+    {'title': None, 'actors': {'name': None, 'role': None}}
+    """
+    tree = {}
+    for path in fields:
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is None:
+                # the parent is selected completely
+                break
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def _column_coder(coder):
+    def column_coder(column):
+        return [None if v is None else coder(v) for v in column]
+    return column_coder
 
-    if not schema:
-        raise ValueError("Invalid Schema: " + str(schema))
 
-    if 'id' not in schema:
-        raise ValueError("Invalid Schema: Missing field 'id'")
-    if 'fields' not in schema:
-        raise ValueError("Invalid Schema: Missing field 'fields'")
-    if 'meta' not in schema:
-        raise ValueError("Invalid Schema: Missing field 'meta'")
+def _nested_encoder(plan, is_array):
+    def encoder(val):
+        return _dump_plan(val, plan, is_array)
+    return encoder
+
+
+def _nested_decoder(plan, is_array):
+    def decoder(val):
+        if not isinstance(val, list) or len(val) == 0:
+            return val
+        return _load_plan(val, plan, is_array)
+    return decoder
+
+
+def _schema_deps(schemas, schema_id, deps):
+    """appends schema_id and the ids of its nested schemas to deps"""
+    if schema_id in deps or schema_id not in schemas:
+        return
+    deps.append(schema_id)
+    for meta_id in schemas[schema_id]['meta']:
+        if meta_id:
+            _schema_deps(schemas, _plain_id(meta_id), deps)
 
-    assert len(schema['fields']) == len(schema['meta'])
 
-    if _verbose:
-        print("Adding new schema: ", schema['id'])
-        print("\t", schema['fields'])
-        print("\t", schema['meta'])
+def _plan_key(schema_id, record_type):
+    if not record_type or record_type == "dict":
+        return schema_id
+    return (schema_id, record_type)
 
-    init_codecs(schema)
-    SCHEMAS[schema['id']] = schema
-    return schema
 
+## schema registry
 
-add_schema({
+
+# schema of schema definitions, which every registry contains
+SCHEMA_SCHEMA = {
     'id': 'schema',
     'fields': ['id', 'fields', 'meta'],
     'meta': [0, "[]", "[]"]
-})
+}
+
+
+class SchemaRegistry(object):
+    """Schemas with their codec chains and compiled plans.
+
+    Registries are isolated from each other, so the same schema id may
+    refer to different schemas in different registries. The module level
+    functions (add_schema, dumps, loads, ...) use DEFAULT_REGISTRY unless
+    a registry is passed to them.
+
+    Changes are serialized by a lock, reads don't lock. snapshot returns
+    a read only copy which later changes don't affect, so a consistent
+    set of schemas can be shared between threads.
+    """
+
+    def __init__(self, codec_factories=None):
+        self.schemas = {}
+        self.plans = {}
+        self.codegen_schemas = set()
+        # generated record classes by schema id and kind
+        self.record_classes = {}
+        self.encoders = {}
+        self.decoders = {}
+        # coders of "[]codec" fields, which take and return a list of values
+        self.many_encoders = {}
+        self.many_decoders = {}
+        # the global CODEC_FACTORIES are used until a codec is added to
+        # the registry, which then gets its own copy.
+        self._own_codecs = codec_factories is not None
+        if codec_factories is None:
+            codec_factories = CODEC_FACTORIES
+        self.codec_factories = codec_factories
+        self.read_only = False
+        # True once a schema which uses STATEFUL_CODECS has been added
+        self.stateful = False
+        # guards initialization of codec chains and compilation of plans
+        self._lock = threading.RLock()
+        # plans which are being compiled, only published once complete
+        self._pending_plans = {}
+        _REGISTRIES.add(self)
+        self.add_schema(SCHEMA_SCHEMA)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError("Schema registry is read only")
+
+    def snapshot(self, read_only=True):
+        """returns a copy of the registry, later changes don't affect it"""
+        with self._lock:
+            snap = SchemaRegistry(dict(self.codec_factories))
+            snap.schemas.update(self.schemas)
+            snap.codegen_schemas.update(self.codegen_schemas)
+            for schema_id, classes in self.record_classes.items():
+                snap.record_classes[schema_id] = dict(classes)
+            # codec chains can be shared, plans are compiled on demand
+            snap.decoders.update(self.decoders)
+            snap.many_encoders.update(self.many_encoders)
+            snap.many_decoders.update(self.many_decoders)
+            snap.encoders.update(self.encoders)
+            snap.stateful = self.stateful
+        snap.read_only = read_only
+        return snap
+
+    ## codecs
+
+    def add_codec(self, name, factory):
+        """register a codec factory which is only used by this registry
+
+        Codecs must be added before the schemas which use them.
+        """
+        with self._lock:
+            self._check_writable()
+            if not self._own_codecs:
+                self.codec_factories = dict(self.codec_factories)
+                self._own_codecs = True
+            self.codec_factories[name] = factory
+        return factory
+
+    def _chain_coders(self, meta_id):
+        """returns the encoder, decoder, encode_many and decode_many of a
+        codec chain, or None if a codec isn't registered.
+        """
+        encoders = []
+        decoders = []
+        many_encoders = []
+        many_decoders = []
+
+        for codec_id, args in parse_codecs(meta_id):
+            if codec_id not in self.codec_factories:
+                return None
+
+            coders = tuple(self.codec_factories[codec_id](args))
+            enc, dec, enc_many, dec_many = (coders + (None, None))[:4]
+            encoders.append(enc)
+            decoders.append(dec)
+            many_encoders.append(enc_many)
+            many_decoders.append(dec_many)
+
+        decoders.reverse()
+        many_decoders.reverse()
+        return (
+            coder_fn(encoders), coder_fn(decoders),
+            many_coder_fn(encoders, many_encoders),
+            many_coder_fn(decoders, many_decoders),
+        )
+
+    def _chain_uses(self, meta_id, factories):
+        for codec_id, _ in parse_codecs(meta_id):
+            if self.codec_factories.get(codec_id) in factories:
+                return True
+        return False
+
+    def init_codec(self, meta_id):
+        if not meta_id or meta_id in self.encoders:
+            return
 
+        with self._lock:
+            if meta_id in self.encoders:
+                return
+
+            coders = self._chain_coders(meta_id)
+            if coders is None:
+                return
+
+            self.decoders[meta_id] = coders[1]
+            self.many_encoders[meta_id] = coders[2]
+            self.many_decoders[meta_id] = coders[3]
+            # published last, since it marks the chain as initialized
+            self.encoders[meta_id] = coders[0]
+
+    def init_codecs(self, schema):
+        for meta_id in schema['meta']:
+            meta_id = _plain_id(meta_id)
+            if meta_id:
+                self.init_codec(meta_id)
+
+    ## plans
+
+    def _field_coders(self, meta_id, record_type=None):
+        """returns the encoder, decoder, column encoder and column decoder
+        of a field. Column coders are None if the values of a column are
+        coded one by one.
+        """
+        if not meta_id:
+            return None, None, None, None
+
+        p_meta_id = _plain_id(meta_id)
+        is_array = p_meta_id != meta_id
+
+        if p_meta_id in self.schemas:
+            plan = self.get_plan(p_meta_id, record_type)
+            return (_nested_encoder(plan, is_array),
+                    _nested_decoder(plan, is_array), None, None)
+
+        if p_meta_id in self.encoders:
+            if self._chain_uses(p_meta_id, STATEFUL_CODECS):
+                # each field keeps its own state
+                coders = self._chain_coders(p_meta_id)
+            else:
+                coders = (
+                    self.encoders[p_meta_id], self.decoders[p_meta_id],
+                    self.many_encoders[p_meta_id],
+                    self.many_decoders[p_meta_id],
+                )
+            if is_array:
+                return coders[2], coders[3], None, None
+            if self._chain_uses(p_meta_id, SEQUENCE_CODECS):
+                # columns are coded as a sequence
+                return coders
+            return coders[0], coders[1], None, None
+
+        return None, None, None, None
+
+    def _compile_plan(self, schema_id, record_type=None):
+        schema = self.schemas[schema_id]
+        plan = SchemaPlan(schema_id, schema['fields'], self)
+        # register before resolving fields, so that self referencing
+        # schemas resolve to this plan.
+        self._pending_plans[_plan_key(schema_id, record_type)] = plan
+
+        encoders = []
+        decoders = []
+        column_encoders = []
+        column_decoders = []
+        fields_meta = zip(plan.fields, schema['meta'])
+        for i, (field, meta_id) in enumerate(fields_meta):
+            enc, dec, col_enc, col_dec = self._field_coders(meta_id,
+                                                            record_type)
+            if enc is not None and _stats is not None:
+                enc, dec, col_enc, col_dec = _stats.wrap_coders(
+                    self, meta_id, enc, dec, col_enc, col_dec
+                )
+            if enc is not None:
+                encoders.append((i, enc))
+                decoders.append((field, dec))
+                column_encoders.append((i, col_enc or _column_coder(enc)))
+                column_decoders.append((field, col_dec or _column_coder(dec)))
+
+        plan.encoders = tuple(encoders)
+        plan.decoders = tuple(decoders)
+        plan.column_encoders = tuple(column_encoders)
+        plan.column_decoders = tuple(column_decoders)
+        plan.field_decoders = dict(decoders)
+        plan.stateful = self._is_stateful(schema_id)
+        if plan.stateful:
+            self.stateful = True
+
+        if record_type:
+            from kson.records import record_class, record_rows_loader
+            cls = record_class(schema_id, record_type, self)
+            plan.load_rows = record_rows_loader(cls)
+        elif schema_id in self.codegen_schemas and _stats is None:
+            # generated functions inline codecs, which couldn't be counted
+            from kson.codegen import generate_rows_functions
+            plan.dump_rows, plan.load_rows = generate_rows_functions(
+                plan, schema
+            )
+
+        return plan
+
+    def get_plan(self, schema_id, record_type=None):
+        """returns the plan to decode records as dicts or a record_type"""
+        key = _plan_key(schema_id, record_type)
+        plan = self.plans.get(key)
+        if plan is not None:
+            return plan
+
+        with self._lock:
+            plan = self.plans.get(key) or self._pending_plans.get(key)
+            if plan is not None:
+                return plan
+
+            # plans of nested schemas are compiled recursively and are
+            # all published when the outermost plan is complete.
+            pending = self._pending_plans
+            is_outermost = not pending
+            try:
+                if record_type == "dict":
+                    record_type = None
+                plan = self._compile_plan(schema_id, record_type)
+                if is_outermost:
+                    self.plans.update(pending)
+            finally:
+                if is_outermost:
+                    pending.clear()
+        return plan
+
+    def _is_stateful(self, schema_id):
+        deps = []
+        _schema_deps(self.schemas, schema_id, deps)
+        for dep_id in deps:
+            for meta_id in self.schemas[dep_id]['meta']:
+                p_meta_id = _plain_id(meta_id) if meta_id else meta_id
+                if not p_meta_id or p_meta_id in self.schemas:
+                    continue
+                for codec_id, _ in parse_codecs(p_meta_id):
+                    factory = self.codec_factories.get(codec_id)
+                    if factory not in STATEFUL_CODECS:
+                        continue
+                    # lists are coded by sequence codecs without state
+                    if p_meta_id == meta_id or factory not in SEQUENCE_CODECS:
+                        return True
+        return False
+
+    def _compile_projection(self, schema_id, tree):
+        schema = self.schemas[schema_id]
+        plan = SchemaPlan(schema_id, schema['fields'], self)
+        full_plan = self.get_plan(schema_id)
+        if full_plan.stateful:
+            raise ValueError("Schema %s can only be decoded in order" % (
+                schema_id,
+            ))
 
-def load_schemas(fp_or_filename):
-    if isinstance(fp_or_filename, (str, bytes)):
-        with open(fp_or_filename, 'r') as f:
-            data = f.read()
-    else:
-        data = fp_or_filename.read()
-    return loads_schemas(data)
+        column_decoders = dict(full_plan.column_decoders)
+        projection = []
+        for i, (field, meta_id) in enumerate(zip(plan.fields, schema['meta'])):
+            if field not in tree:
+                continue
+            subtree = tree[field]
+            if subtree is None:
+                decoder = full_plan.field_decoders.get(field)
+                projection.append((field, i, decoder,
+                                   column_decoders.get(field)))
+                continue
 
+            p_meta_id = _plain_id(meta_id) if meta_id else meta_id
+            if p_meta_id not in self.schemas:
+                raise ValueError("Field %s of schema %s has no schema" % (
+                    field, schema_id
+                ))
+            sub_plan = self._compile_projection(p_meta_id, subtree)
+            is_array = p_meta_id != meta_id
+            decoder = _nested_decoder(sub_plan, is_array)
+            projection.append((field, i, decoder, _column_coder(decoder)))
+
+        unknown = set(tree) - set(plan.fields)
+        if unknown:
+            raise ValueError("Unknown fields of schema %s: %s" % (
+                schema_id, ", ".join(sorted(unknown))
+            ))
 
-def loads_schemas(schema_data):
-    schemas = loads(schema_data)
-    if isinstance(schemas, list):
-        return [add_schema(s) for s in schemas]
-    else:
-        return [add_schema(schemas)]
+        plan.projection = tuple(projection)
+        plan.load_rows = _load_projected_rows
+        return plan
+
+    def get_projection(self, schema_id, fields):
+        """returns a plan which only decodes the given fields
+
+        Fields of nested schemas are selected with dotted paths, e.g.
+        "actors.name". Values of other fields are skipped.
+        """
+        key = (schema_id, "fields", tuple(sorted(set(fields))))
+        plan = self.plans.get(key)
+        if plan is not None:
+            return plan
+
+        with self._lock:
+            plan = self._compile_projection(schema_id,
+                                            _projection_tree(key[2]))
+            self.plans[key] = plan
+        return plan
+
+    ## schemas
+
+    def add_schema(self, schema, codegen=False):
+        if isinstance(schema, (str, bytes)):
+            schema = loads(schema, registry=self)
+
+        if not schema:
+            raise ValueError("Invalid Schema: " + str(schema))
+
+        if 'id' not in schema:
+            raise ValueError("Invalid Schema: Missing field 'id'")
+        if 'fields' not in schema:
+            raise ValueError("Invalid Schema: Missing field 'fields'")
+        if 'meta' not in schema:
+            raise ValueError("Invalid Schema: Missing field 'meta'")
+
+        assert len(schema['fields']) == len(schema['meta'])
+        self._check_writable()
+
+        if _verbose:
+            print("Adding new schema: ", schema['id'])
+            print("\t", schema['fields'])
+            print("\t", schema['meta'])
+
+        self.init_codecs(schema)
+        with self._lock:
+            schema_id = schema['id']
+            old_schema = self.schemas.get(schema_id)
+            if old_schema and old_schema['fields'] != schema['fields']:
+                self.record_classes.pop(schema_id, None)
+            self.schemas[schema_id] = schema
+            if codegen:
+                self.codegen_schemas.add(schema_id)
+            else:
+                self.codegen_schemas.discard(schema_id)
+            # plans of other schemas may reference a previous (stub)
+            # version of this schema, so all of them are recompiled on
+            # demand.
+            self.plans.clear()
+            self.get_plan(schema_id)
+        return schema
+
+    def load_schemas(self, fp_or_filename, codegen=False):
+        if isinstance(fp_or_filename, (str, bytes)):
+            with open(fp_or_filename, 'rb') as f:
+                data = f.read()
+        else:
+            data = fp_or_filename.read()
+        from kson.compression import maybe_decompress
+        return self.loads_schemas(maybe_decompress(data), codegen)
+
+    def loads_schemas(self, schema_data, codegen=False):
+        schemas = loads(schema_data, registry=self)
+        if isinstance(schemas, list):
+            return [self.add_schema(s, codegen) for s in schemas]
+        else:
+            return [self.add_schema(schemas, codegen)]
+
+    def compact_schemas(self, base_schema_id):
+        with self._lock:
+            self._check_writable()
+            _compact_schemas(self.schemas, base_schema_id)
+            self.plans.clear()
+
+    ## (de)serialization
+
+    def dumps(self, data, schema_id, *args, **kwargs):
+        return dumps(data, schema_id, *args, registry=self, **kwargs)
+
+    def loads(self, data, schema_id=None, **kwargs):
+        return loads(data, schema_id, registry=self, **kwargs)
+
+    def dump(self, data, fp_or_filename, *args, **kwargs):
+        return dump(data, fp_or_filename, *args, registry=self, **kwargs)
+
+    def load(self, fp_or_filename, *args, **kwargs):
+        return load(fp_or_filename, *args, registry=self, **kwargs)
+
+    def dumpb(self, data, schema_id, **kwargs):
+        return dumpb(data, schema_id, registry=self, **kwargs)
+
+    def loadb(self, buf, schema_id=None, **kwargs):
+        return loadb(buf, schema_id, registry=self, **kwargs)
+
+    def iterload(self, fp_or_filename, schema_id=None, **kwargs):
+        return iterload(fp_or_filename, schema_id, registry=self, **kwargs)
+
+    def dump_iter(self, records, fp_or_filename, schema_id, **kwargs):
+        return dump_iter(records, fp_or_filename, schema_id, registry=self,
+                         **kwargs)
+
+    def dump_lines(self, records, fp_or_filename, schema_id, **kwargs):
+        return dump_lines(records, fp_or_filename, schema_id, registry=self,
+                          **kwargs)
+
+    def iter_lines(self, fp_or_filename, schema_id=None):
+        return iter_lines(fp_or_filename, schema_id, registry=self)
+
+    def record_class(self, schema_id, kind="slots"):
+        return record_class(schema_id, kind, self)
+
+    def detect_schemas(self, data, **kwargs):
+        return detect_schemas(data, registry=self, **kwargs)
+
+
+DEFAULT_REGISTRY = SchemaRegistry(CODEC_FACTORIES)
+
+# the state of the default registry
+SCHEMAS = DEFAULT_REGISTRY.schemas
+PLANS = DEFAULT_REGISTRY.plans
+CODEGEN_SCHEMAS = DEFAULT_REGISTRY.codegen_schemas
+RECORD_CLASSES = DEFAULT_REGISTRY.record_classes
+ENCODERS = DEFAULT_REGISTRY.encoders
+DECODERS = DEFAULT_REGISTRY.decoders
+MANY_ENCODERS = DEFAULT_REGISTRY.many_encoders
+MANY_DECODERS = DEFAULT_REGISTRY.many_decoders
 
 
-## (de)serialization
+## schema
 
 
-def _process_val(val, meta_id, recurse, coders):
-    if val is None:
-        return None
+def init_codec(meta_id):
+    DEFAULT_REGISTRY.init_codec(meta_id)
 
-    p_meta_id = _plain_id(meta_id)
-    if p_meta_id in SCHEMAS:
-        return recurse(val, meta_id, True)
 
-    if p_meta_id in coders:
-        coder = coders[p_meta_id]
+def init_codecs(schema):
+    DEFAULT_REGISTRY.init_codecs(schema)
 
-        if p_meta_id == meta_id:
-            return coder(val)
 
-        val = val[:]  # copy so argument isn't modified
-        for i, v in enumerate(val):
-            val[i] = coder(v)
+def get_plan(schema_id, record_type=None):
+    """returns the plan to decode records as dicts or a record_type"""
+    return DEFAULT_REGISTRY.get_plan(schema_id, record_type)
 
-    return val
 
+def add_schema(schema, codegen=False):
+    return DEFAULT_REGISTRY.add_schema(schema, codegen)
 
-def dumps(data, schema_id, is_recurse=False, *args, **kwargs):
-    is_array = schema_id[0] == u"["
-    schema_id = schema_id[2:] if is_array else schema_id
-    schema = SCHEMAS[schema_id]
-    fields = schema['fields']
-    meta = schema['meta']
+
+def load_schemas(fp_or_filename, codegen=False):
+    return DEFAULT_REGISTRY.load_schemas(fp_or_filename, codegen)
+
+
+def loads_schemas(schema_data, codegen=False):
+    return DEFAULT_REGISTRY.loads_schemas(schema_data, codegen)
+
+
+## (de)serialization
+
+
+def _dump_plan(data, plan, is_array, result=None):
+    err_arg = (plan.schema_id, type(data))
+    if is_array and not isinstance(data, Iterable):
+        raise ValueError("Schema %s specifies array, got %s" % err_arg)
+
+    if not is_array:
+        is_record = hasattr(data, '_kson_schema')
+        if not (is_record or isinstance(data, Mapping)):
+            raise ValueError("Schema %s specifies object, got %s" % err_arg)
+        data = (data,)
+
+    if result is None:
+        result = []
+
+    plan.dump_rows(plan, data, result)
+    return result
+
+
+def _load_plan(data, plan, is_array, start=0):
     result = []
+    plan.load_rows(plan, data, start, result)
+
+    if is_array:
+        return result
+
+    return result[-1] if result else None
+
 
-    err_arg = (schema_id, type(data))
-    if is_array and not isinstance(data, collections.Iterable):
+def _dump_columns(data, plan):
+    if not isinstance(data, Iterable):
+        err_arg = (plan.schema_id, type(data))
         raise ValueError("Schema %s specifies array, got %s" % err_arg)
 
-    if not is_array and not isinstance(data, collections.Mapping):
-        raise ValueError("Schema %s specifies object, got %s" % err_arg)
+    if not isinstance(data, (list, tuple)):
+        data = list(data)
 
-    if not is_recurse:
-        result.append("[]" + schema_id if is_array else schema_id)
+    fields = plan.fields
+    if all(obj.__class__ is dict for obj in data):
+        columns = [[obj.get(field) for obj in data] for field in fields]
+    else:
+        # records are accessed like in _dump_rows, namedtuples and
+        # objects with attributes are valid records too
+        attr_values = plan.attr_values
+        rows = [
+            list(map(obj.get, fields)) if isinstance(obj, Mapping)
+            else attr_values(obj)
+            for obj in data
+        ]
+        columns = [list(column) for column in zip(*rows)]
+    for i, coder in plan.column_encoders:
+        columns[i] = coder(columns[i])
+    return columns
+
+
+def _load_columns(columns, plan):
+    """returns a dict of decoded columns by field"""
+    result = dict(zip(plan.fields, columns))
+    for field, coder in plan.column_decoders:
+        column = result.get(field)
+        if column:
+            result[field] = coder(column)
+    return result
 
-    if not is_array:
-        data = [data]
 
-    for obj in data:
-        for field, meta_id in zip(fields, meta):
-            result.append(_process_val(
-                obj.get(field, None), meta_id, dumps, ENCODERS
-            ))
+def _load_projected_columns(columns, plan):
+    result = {}
+    for field, i, _, coder in plan.projection:
+        column = columns[i] if i < len(columns) else []
+        if coder is not None and column:
+            column = coder(column)
+        result[field] = column
+    return result
+
 
+def _columns_to_rows(columns, plan):
+    if plan.projection is None:
+        fields = plan.fields
+    else:
+        fields = [entry[0] for entry in plan.projection]
+    return [
+        dict(zip(fields, vals))
+        for vals in zip(*[columns[field] for field in fields])
+    ]
+
+
+def _dump_document(data, plan, is_array, is_recurse, layout):
     if is_recurse:
-        return result
+        return _dump_plan(data, plan, is_array)
+
+    schema_id = plan.schema_id
+    if layout == COLUMNAR:
+        if not is_array:
+            raise ValueError("Columnar layout requires an array schema")
+        result = [COLUMNAR_PREFIX + schema_id]
+        result.extend(_dump_columns(data, plan))
+    elif layout == ROWS:
+        result = ["[]" + schema_id if is_array else schema_id]
+        _dump_plan(data, plan, is_array, result)
+    else:
+        raise ValueError("Invalid layout: " + str(layout))
+    return result
+
+
+def dumps(data, schema_id, is_recurse=False, *args, **kwargs):
+    """serialize data to a KSON document
+
+    Additional arguments are passed to json.dumps, with as_bytes=True
+    the document is returned as utf-8 encoded bytes.
+    """
+    layout = kwargs.pop('layout', ROWS)
+    as_bytes = kwargs.pop('as_bytes', False)
+    registry = kwargs.pop('registry', None) or DEFAULT_REGISTRY
+    if _stats is not None and not is_recurse:
+        return _stats.dumps(_dumps, data, schema_id, layout, as_bytes,
+                            registry, args, kwargs)
+    return _dumps(data, schema_id, is_recurse, layout, as_bytes, registry,
+                  args, kwargs)
+
+
+def _dumps(data, schema_id, is_recurse, layout, as_bytes, registry, args,
+           kwargs):
+    is_array = schema_id[0] == u"["
+    schema_id = schema_id[2:] if is_array else schema_id
+    plan = registry.get_plan(schema_id)
 
+    result = _in_document(registry, _dump_document, data, plan, is_array,
+                          is_recurse, layout)
+
+    if is_recurse:
+        return result
     if args or kwargs:
-        return default_json_dumps(result, *args, **kwargs)
+        doc = default_json_dumps(result, *args, **kwargs)
+        return doc.encode('utf-8') if as_bytes else doc
+    if as_bytes:
+        return json_dumps_bytes(result)
     return json_dumps(result)
 
 
-def loads(data, schema_id=None, is_recurse=False):
-    data = json_loads(data) if isinstance(data, (str, bytes)) else data
+def loads(data, schema_id=None, is_recurse=False, columns=False,
+          as_arrays=False, lazy=False, record_type=None, registry=None,
+          fields=None):
+    """deserialize a KSON document
+
+    With fields=[...] only the given fields of the records are decoded,
+    fields of nested schemas are selected with dotted paths.
+    """
+    if _stats is not None and not is_recurse:
+        return _stats.loads(_loads, data, schema_id, dict(
+            columns=columns, as_arrays=as_arrays, lazy=lazy,
+            record_type=record_type, registry=registry, fields=fields,
+        ))
+    return _loads(data, schema_id, is_recurse, columns, as_arrays, lazy,
+                  record_type, registry, fields)
+
+
+def _loads(data, schema_id=None, is_recurse=False, columns=False,
+           as_arrays=False, lazy=False, record_type=None, registry=None,
+           fields=None):
+    registry = registry or DEFAULT_REGISTRY
+    if fields is not None and (lazy or as_arrays or record_type):
+        raise ValueError("fields can't be combined with lazy, as_arrays "
+                         "or record_type")
+    if isinstance(data, (str, bytes, bytearray, memoryview)):
+        data = json_loads(data)
 
     # plain json value or json object
     if not isinstance(data, list) or len(data) == 0:
@@ -377,84 +1468,159 @@ def loads(data, schema_id=None, is_recurse=False):
     if not is_recurse:
         data_start = 1
 
+    return _in_document(registry, _load_document, data, schema_id,
+                        data_start, columns, as_arrays, lazy, record_type,
+                        registry, fields)
+
+
+def _load_document(data, schema_id, data_start, columns, as_arrays, lazy,
+                   record_type, registry, fields):
+    if schema_id[:2] == COLUMNAR_PREFIX:
+        if lazy:
+            raise ValueError("Lazy decoding requires row layout")
+        raw_columns = data[data_start:]
+        if fields is not None:
+            plan = registry.get_projection(schema_id[2:], fields)
+            result = _load_projected_columns(raw_columns, plan)
+            return result if columns else _columns_to_rows(result, plan)
+        plan = registry.get_plan(schema_id[2:])
+        if as_arrays:
+            from kson.arrays import load_arrays
+            return load_arrays(raw_columns, plan)
+        result = _load_columns(raw_columns, plan)
+        return result if columns else _columns_to_rows(result, plan)
+
     is_array = schema_id[0] == u"["
     if is_array:
         schema_id = schema_id[2:]
-        result = []
 
-    schema = SCHEMAS[schema_id]
-    fields = schema['fields']
-    len_fields = len(fields)
-    meta = schema['meta']
-    obj = None
-
-    for i, val in enumerate(data[data_start:]):
-        j = i % len_fields
-        if j == 0:
-            if obj and is_array:
-                result.append(obj)
-            obj = {}
-
-        meta_id = meta[j]
+    if fields is not None:
+        plan = registry.get_projection(schema_id, fields)
+    else:
+        plan = registry.get_plan(schema_id, None if lazy else record_type)
 
-        obj[fields[j]] = _process_val(val, meta_id, loads, DECODERS)
+    if plan.stateful and (lazy or columns or as_arrays):
+        # values would be decoded in a different order than encoded
+        raise ValueError("Schema %s can only be decoded in order" % (
+            schema_id,
+        ))
 
-    if not is_array:
-        return obj
+    if columns or as_arrays:
+        n_fields = plan.n_fields
+        raw_columns = [data[data_start + i::n_fields] for i in range(n_fields)]
+        if fields is not None:
+            return _load_projected_columns(raw_columns, plan)
+        if as_arrays:
+            from kson.arrays import load_arrays
+            return load_arrays(raw_columns, plan)
+        return _load_columns(raw_columns, plan)
 
-    if obj:
-        result.append(obj)
+    if lazy:
+        from kson.records import lazy_records
+        return lazy_records(data, plan, is_array, data_start)
 
-    return result
+    return _load_plan(data, plan, is_array, data_start)
 
 
 ## helpers for dealing with files
 
 
 def dump(data, fp_or_filename, *args, **kwargs):
-    data = dumps(data, *args, **kwargs)
+    """serialize data as a KSON document to a file or file name
+
+    With compression="gzip", "zlib", "zstd" or "lz4" the document is
+    compressed, for file names the compression defaults to the one
+    implied by the extension (.gz, .zz, .zst, .lz4). A zstd dictionary
+    (see kson.compression.train_dictionary) can be passed as dictionary.
+    """
+    compression = kwargs.pop('compression', None)
+    dictionary = kwargs.pop('dictionary', None)
     if isinstance(fp_or_filename, (str, bytes)):
-        with open(fp_or_filename, 'w') as fp:
+        from kson.compression import compression_for_filename
+        compression = compression or compression_for_filename(fp_or_filename)
+        data = dumps(data, *args, as_bytes=True, **kwargs)
+        if compression:
+            from kson.compression import compress
+            data = compress(data, compression, dictionary=dictionary)
+        with open(fp_or_filename, 'wb') as fp:
             fp.write(data)
+    elif compression:
+        from kson.compression import compress
+        data = dumps(data, *args, as_bytes=True, **kwargs)
+        fp_or_filename.write(compress(data, compression,
+                                      dictionary=dictionary))
     else:
-        fp_or_filename.write(data)
+        is_binary = isinstance(fp_or_filename,
+                               (io.RawIOBase, io.BufferedIOBase))
+        fp_or_filename.write(dumps(data, *args, as_bytes=is_binary, **kwargs))
+
+
+def _map_file(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 def load(fp_or_filename, *args, **kwargs):
+    """deserialize a KSON document from a file, file name or buffer
+
+    Files are memory mapped and buffers (bytearray, memoryview, mmap) are
+    accepted as well. Only binary documents loaded with lazy=True are
+    decoded in place, other documents are copied while they are decoded
+    (text documents are decoded to a str first). The binary format and
+    compressed documents are detected by their header, a zstd dictionary
+    used to compress the document can be passed as dictionary.
+    """
+    dictionary = kwargs.pop('dictionary', None)
     if isinstance(fp_or_filename, (str, bytes)):
-        with open(fp_or_filename, 'r') as f:
-            data = f.read()
+        with open(fp_or_filename, 'rb') as f:
+            data = _map_file(f)
+    elif isinstance(fp_or_filename, (bytearray, memoryview, mmap.mmap)):
+        data = fp_or_filename
     else:
         data = fp_or_filename.read()
-    return loads(data, *args, **kwargs)
 
+    if not isinstance(data, (bytes, bytearray, memoryview, mmap.mmap)):
+        # file opened in text mode
+        return loads(data, *args, **kwargs)
 
-## schema detection
+    from kson.compression import maybe_decompress
+    data = maybe_decompress(data, dictionary)
 
+    from kson.binary import MAGIC, loadb
+    if data[:len(MAGIC)] == MAGIC:
+        return loadb(data, *args, **kwargs)
 
-def detect_codecs(data, schema_id):
-    return 0
+    if isinstance(data, mmap.mmap):
+        data = memoryview(data)
+    return loads(data, *args, **kwargs)
 
 
-def compact_schemas(base_schema_id):
+## schema detection
+
+
+def _compact_schemas(schemas, base_schema_id):
     def replace_schema(old_sid, new_sid):
-        for schema in SCHEMAS.values():
+        for schema in list(schemas.values()):
             meta = schema['meta']
-            for i, meta_id in enumerate(meta):
-                if meta_id == old_sid:
-                    meta[i] = new_sid
-        del SCHEMAS[old_sid]
+            if old_sid in meta:
+                # replaced rather than modified, snapshots may share it
+                schemas[schema['id']] = dict(schema, meta=[
+                    new_sid if meta_id == old_sid else meta_id
+                    for meta_id in meta
+                ])
+        del schemas[old_sid]
 
     done = False
     while not done:
         done = True
-        for a_sid, a_schema in SCHEMAS.items():
+        for a_sid, a_schema in schemas.items():
             if not a_sid.startswith(base_schema_id):
                 continue
 
             a_fields = a_schema['fields']
             a_meta = a_schema['meta']
-            for b_sid, b_schema in SCHEMAS.items():
+            for b_sid, b_schema in schemas.items():
                 if not b_sid.startswith(base_schema_id):
                     continue
                 if a_sid == b_sid:
@@ -471,61 +1637,29 @@ def compact_schemas(base_schema_id):
                 break
 
 
-def detect_meta(obj, id_prefix, lvl):
-    idx = 0
-    meta_map = {}
-    for field, value in obj.items():
-        if isinstance(value, dict) or isinstance(value, list):
-            sid, schemas = detect_schemas(value, id_prefix, lvl + 1, idx,
-                                          field)
-            meta_map[field] = sid
-            idx += 1
-    return meta_map
-
-
-def detect_schemas(data, id_prefix=None, lvl=0, idx=0, schema_ext=None):
-    if id_prefix is None:
-        id_prefix = "auto-schema-" + b64encode(os.urandom(6))
-    schema_id = id_prefix + "-" + str(lvl) + "-" + str(idx)
-    if schema_ext:
-        schema_id += "-" + schema_ext
-    fields = set()
-    meta_map = {}
-
-    if isinstance(data, (str, bytes)):
-        data = json_loads(data)
-
-    if isinstance(data, dict):
-        fields.update(data.keys())
-        meta_map.update(detect_meta(data, id_prefix, lvl))
-    elif isinstance(data, list):
-        for obj in data:
-            if isinstance(obj, dict):
-                fields.update(obj.keys())
-                meta_map.update(detect_meta(obj, id_prefix, lvl))
-    else:
-        raise ValueError("Top level must be a dict or list")
-
-    if len(fields) == 0:
-        if isinstance(data, list):
-            return "[]"
-        return 0, tuple()
-
-    fields = sorted(list(fields))
-
-    add_schema({
-        'id': schema_id,
-        'fields': fields,
-        'meta': [meta_map.get(f, 0) for f in fields]
-    })
-
-    if lvl == 0:
-        compact_schemas(id_prefix)
-        detect_codecs(data, schema_id)
-
-    if isinstance(data, list):
-        return "[]" + schema_id, tuple()
-
-    schemas = [s for s in SCHEMAS.values() if s['id'].startswith(id_prefix)]
-    schemas = sorted(schemas, key=lambda s: s['id'], reverse=True)
-    return schema_id, schemas
+def compact_schemas(base_schema_id):
+    DEFAULT_REGISTRY.compact_schemas(base_schema_id)
+
+
+def _set_stats(stats):
+    """install (or with None remove) the collector of kson.stats
+
+    Plans are recompiled on demand, with or without counting coders.
+    """
+    global _stats
+    _stats = stats
+    set_backend(get_backend())
+    for registry in list(_REGISTRIES):
+        with registry._lock:
+            registry.plans.clear()
+
+
+from kson.stream import iterload, dump_iter, KSONWriter  # noqa
+from kson.lines import dump_lines, iter_lines  # noqa
+from kson.binary import dumpb, loadb  # noqa
+from kson.records import record_class  # noqa
+from kson.detect import detect_schemas, detect_codecs  # noqa
+from kson.index import KSONFile  # noqa
+from kson.stats import (  # noqa
+    enable_stats, disable_stats, get_stats, collect_stats,
+)
@@ -0,0 +1,90 @@
+# coding: utf-8
+"""asyncio versions of iterload and dump_iter (python 3.6+).
+
+Readers are objects with a coroutine read(n), such as asyncio.StreamReader
+or async file objects. Writers are objects with a write method, which may
+be a coroutine, and an optional drain coroutine, such as
+asyncio.StreamWriter.
+
+Both functions use the incremental parser and encoder of kson.stream, so
+only the current chunk and record are kept in memory. This module is not
+imported by the kson package.
+"""
+import io
+import inspect
+
+from kson.stream import StreamDecoder, KSONWriter, CHUNK_SIZE
+
+
+async def aload_iter(reader, schema_id=None, chunk_size=CHUNK_SIZE,
+                     registry=None, dictionary=None):
+    """async generator which yields the records of a KSON document"""
+    decoder = StreamDecoder(schema_id, registry=registry,
+                            dictionary=dictionary)
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        for record in decoder.feed(chunk):
+            yield record
+
+    for record in decoder.close():
+        yield record
+
+
+class _WriteBuffer(io.RawIOBase):
+    """collects the output of a KSONWriter until it is sent"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def _send(writer, data):
+    if getattr(writer, 'encoding', None):
+        # async file opened in text mode
+        data = data.decode('utf-8')
+    result = writer.write(data)
+    if inspect.isawaitable(result):
+        await result
+    drain = getattr(writer, 'drain', None)
+    if drain is not None:
+        await drain()
+
+
+async def adump_iter(writer, records, schema_id, buffer_size=CHUNK_SIZE,
+                     registry=None, compression=None, dictionary=None):
+    """write an (async) iterable of records as a "[]schema" document
+
+    Output is sent to the writer whenever buffer_size bytes have been
+    encoded, waiting for writer.drain() before encoding more records.
+    """
+    buf = _WriteBuffer()
+    kson_writer = KSONWriter(buf, schema_id, buffer_size, registry,
+                             compression=compression, dictionary=dictionary)
+    await _send(writer, buf.take())
+
+    if hasattr(records, '__aiter__'):
+        async for record in records:
+            kson_writer.write(record)
+            if buf.chunks:
+                await _send(writer, buf.take())
+    else:
+        for record in records:
+            kson_writer.write(record)
+            if buf.chunks:
+                await _send(writer, buf.take())
+
+    kson_writer.close()
+    await _send(writer, buf.take())
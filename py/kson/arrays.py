@@ -0,0 +1,132 @@
+# coding: utf-8
+"""Decoding of "[]schema" documents to NumPy arrays.
+
+Used by loads(data, as_arrays=True). Columns of plain values are
+converted directly and the date, bool, int36, enum, delta and dod codecs
+are applied to a whole column at once rather than per value. Columns of
+other fields are decoded as usual and returned as object arrays.
+"""
+from kson import (
+    parse_codecs, _plain_id, date_codec, bool_codec, int36_codec, enum_codec,
+    delta_codec, dod_codec,
+)
+
+
+## vectorized decoders
+#
+# Take the (list or array) column and the codec args and return an array.
+
+
+def _decode_date(np, column, args):
+    return np.asarray(column, dtype='int64').astype('datetime64[s]')
+
+
+def _decode_bool(np, column, args):
+    return np.asarray(column).astype(bool)
+
+
+def _decode_int36(np, column, args):
+    return np.array([int(v, 36) for v in column], dtype='int64')
+
+
+def _decode_enum(np, column, args):
+    values = [0] + list(args)
+    column = np.asarray(column)
+    if column.dtype.kind not in "iu":
+        return None
+    if column.size and (column.min() < 0 or column.max() >= len(values)):
+        return None
+    return np.array(values, dtype=object)[column]
+
+
+def _decode_delta(np, column, args):
+    return np.cumsum(np.asarray(column))
+
+
+def _decode_dod(np, column, args):
+    return np.cumsum(np.cumsum(np.asarray(column)))
+
+
+# keyed by factory rather than codec id, so that codecs which are
+# overridden using add_codec aren't replaced.
+ARRAY_DECODERS = {
+    date_codec: _decode_date,
+    bool_codec: _decode_bool,
+    int36_codec: _decode_int36,
+    enum_codec: _decode_enum,
+    delta_codec: _decode_delta,
+    dod_codec: _decode_dod,
+}
+
+
+def _object_array(np, column):
+    arr = np.empty(len(column), dtype=object)
+    for i, val in enumerate(column):
+        arr[i] = val
+    return arr
+
+
+def _plain_array(np, column):
+    if None in column:
+        return _object_array(np, column)
+    try:
+        arr = np.array(column)
+    except ValueError:
+        return _object_array(np, column)
+    if arr.ndim != 1:
+        return _object_array(np, column)
+    return arr
+
+
+def _vectorized_decode(np, registry, column, meta_id):
+    codecs = parse_codecs(meta_id)
+    codecs.reverse()
+    for codec_id, args in codecs:
+        decoder = ARRAY_DECODERS.get(registry.codec_factories[codec_id])
+        if decoder is None:
+            return None
+        column = decoder(np, column, args)
+        if column is None:
+            return None
+    return column
+
+
+def _decode_column(np, registry, column, meta_id):
+    if not meta_id:
+        return _plain_array(np, column)
+
+    p_meta_id = _plain_id(meta_id)
+    if not p_meta_id:
+        # "[]", array of plain values
+        return _object_array(np, column)
+
+    is_codec = p_meta_id == meta_id and p_meta_id not in registry.schemas
+    if is_codec and p_meta_id in registry.encoders and None not in column:
+        arr = _vectorized_decode(np, registry, column, meta_id)
+        if arr is not None:
+            return arr
+
+    _, decoder, _, column_decoder = registry._field_coders(meta_id)
+    if decoder is None:
+        return _plain_array(np, column)
+
+    if column_decoder is not None:
+        # sequence codecs
+        column = column_decoder(column)
+    else:
+        column = [None if v is None else decoder(v) for v in column]
+    if p_meta_id in registry.decoders and p_meta_id == meta_id:
+        return _plain_array(np, column)
+    return _object_array(np, column)
+
+
+def load_arrays(columns, plan):
+    """returns a dict of numpy arrays for the raw columns of a plan"""
+    import numpy as np
+
+    registry = plan.registry
+    meta = registry.schemas[plan.schema_id]['meta']
+    return dict(
+        (field, _decode_column(np, registry, column, meta_id))
+        for field, column, meta_id in zip(plan.fields, columns, meta)
+    )
@@ -0,0 +1,380 @@
+# coding: utf-8
+"""Binary serialization of KSON documents.
+
+The binary format encodes the same flat value stream as the JSON based
+format, but numbers are written as varints/doubles and strings are
+length prefixed, so values can be skipped without decoding them.
+
+It isn't a faster alternative to the json backends: the values are coded
+in python, which is several times slower than the C json libraries, and
+documents are only slightly smaller. It is useful for lazy decoding, where
+only the records and fields which are accessed are read from a (mmapped)
+buffer, see loadb.
+
+    document    := MAGIC schema_ids values
+    schema_ids  := varint(n) string{n}     top level id, then nested ids
+    values      := varint(n) value{n}
+    value       := tag payload
+
+Integers in the range 0-127 are encoded in the tag itself. Other integers
+are zigzag encoded varints. Floats are big endian doubles.
+"""
+import struct
+from array import array
+
+from kson import (
+    PY2, DEFAULT_REGISTRY, COLUMNAR, COLUMNAR_PREFIX, ROWS, Mapping,
+    Sequence, loads, _dump_plan, _dump_columns, _schema_deps, _in_document,
+)
+from kson.records import lazy_records
+
+MAGIC = b"KSB\x01"
+
+NONE = 0x00
+FALSE = 0x01
+TRUE = 0x02
+INT = 0x03
+FLOAT = 0x04
+STR = 0x05
+LIST = 0x06
+DICT = 0x07
+# tags >= FIXINT encode the integer value (tag & 0x7F)
+FIXINT = 0x80
+
+_double = struct.Struct(">d")
+
+# offsets of values, 'L' is only 32 bits on windows
+_OFFSET_TYPECODE = 'L' if array('L').itemsize >= 8 else 'Q'
+_pack_double = _double.pack
+_unpack_double = _double.unpack_from
+
+if PY2:
+    _int_types = (int, long)
+    _str_types = (str, unicode)
+    _text_type = unicode
+else:
+    _int_types = (int,)
+    _str_types = (str,)
+    _text_type = str
+
+
+## encoding
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _write_str(out, val):
+    raw = val.encode('utf-8')
+    _write_varint(out, len(raw))
+    out += raw
+
+
+def _write_value(out, val):
+    t = type(val)
+    if t in _str_types:
+        out.append(STR)
+        _write_str(out, val)
+    elif t in _int_types:
+        if 0 <= val < 0x80:
+            out.append(FIXINT | val)
+        else:
+            out.append(INT)
+            _write_varint(out, val * 2 if val >= 0 else -val * 2 - 1)
+    elif val is None:
+        out.append(NONE)
+    elif t is bool:
+        out.append(TRUE if val else FALSE)
+    elif t is float:
+        out.append(FLOAT)
+        out += _double.pack(val)
+    elif t is list or t is tuple:
+        out.append(LIST)
+        _write_varint(out, len(val))
+        for v in val:
+            _write_value(out, v)
+    elif isinstance(val, Mapping):
+        out.append(DICT)
+        _write_varint(out, len(val))
+        for k, v in val.items():
+            _write_str(out, k)
+            _write_value(out, v)
+    elif isinstance(val, _str_types):
+        out.append(STR)
+        _write_str(out, val)
+    elif isinstance(val, _int_types):
+        _write_value(out, int(val))
+    elif isinstance(val, float):
+        _write_value(out, float(val))
+    elif isinstance(val, (list, tuple)):
+        _write_value(out, list(val))
+    else:
+        raise TypeError("%r is not KSON serializable" % (val,))
+
+
+def _write_values(out, values):
+    # _write_value with the common cases inlined
+    append = out.append
+    for val in values:
+        t = type(val)
+        if t is _text_type:
+            raw = val.encode('utf-8')
+            append(STR)
+            n = len(raw)
+            if n < 0x80:
+                append(n)
+            else:
+                _write_varint(out, n)
+            out += raw
+        elif t is int:
+            if 0 <= val < 0x80:
+                append(FIXINT | val)
+            else:
+                append(INT)
+                _write_varint(out, val * 2 if val >= 0 else -val * 2 - 1)
+        elif t is float:
+            append(FLOAT)
+            out += _pack_double(val)
+        elif t is list:
+            append(LIST)
+            _write_varint(out, len(val))
+            _write_values(out, val)
+        else:
+            _write_value(out, val)
+
+
+def _dump_values(data, plan, is_array, layout):
+    schema_id = plan.schema_id
+    if layout == COLUMNAR:
+        if not is_array:
+            raise ValueError("Columnar layout requires an array schema")
+        return COLUMNAR_PREFIX + schema_id, _dump_columns(data, plan)
+    elif layout == ROWS:
+        doc_id = "[]" + schema_id if is_array else schema_id
+        return doc_id, _dump_plan(data, plan, is_array)
+    raise ValueError("Invalid layout: " + str(layout))
+
+
+def dumpb(data, schema_id, layout=ROWS, registry=None):
+    """serialize data to the binary KSON format"""
+    registry = registry or DEFAULT_REGISTRY
+    is_array = schema_id[0] == u"["
+    schema_id = schema_id[2:] if is_array else schema_id
+    plan = registry.get_plan(schema_id)
+
+    doc_id, values = _in_document(registry, _dump_values, data, plan,
+                                  is_array, layout)
+
+    deps = []
+    _schema_deps(registry.schemas, schema_id, deps)
+
+    out = bytearray(MAGIC)
+    _write_varint(out, len(deps))
+    _write_str(out, doc_id)
+    for dep_id in deps[1:]:
+        _write_str(out, dep_id)
+
+    _write_varint(out, len(values))
+    _write_values(out, values)
+    return bytes(out)
+
+
+## decoding
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_str(buf, pos):
+    n, pos = _read_varint(buf, pos)
+    end = pos + n
+    return str(buf[pos:end], 'utf-8'), end
+
+
+def _read_value(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag >= FIXINT:
+        return tag & 0x7F, pos
+    if tag == STR:
+        return _read_str(buf, pos)
+    if tag == NONE:
+        return None, pos
+    if tag == INT:
+        n, pos = _read_varint(buf, pos)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+    if tag == FLOAT:
+        return _unpack_double(buf, pos)[0], pos + 8
+    if tag == FALSE:
+        return False, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == LIST:
+        n, pos = _read_varint(buf, pos)
+        result = []
+        return result, _read_values(buf, pos, n, result)
+    if tag == DICT:
+        n, pos = _read_varint(buf, pos)
+        result = {}
+        for _ in range(n):
+            key, pos = _read_str(buf, pos)
+            result[key], pos = _read_value(buf, pos)
+        return result, pos
+    raise ValueError("Invalid binary KSON tag %d at %d" % (tag, pos - 1))
+
+
+def _read_values(buf, pos, n, out):
+    """appends n values to out, returns the position after them"""
+    # _read_value with the common cases inlined
+    append = out.append
+    for _ in range(n):
+        tag = buf[pos]
+        if tag >= FIXINT:
+            append(tag & 0x7F)
+            pos += 1
+        elif tag == STR and buf[pos + 1] < 0x80:
+            end = pos + 2 + buf[pos + 1]
+            append(str(buf[pos + 2:end], 'utf-8'))
+            pos = end
+        elif tag == FLOAT:
+            append(_unpack_double(buf, pos + 1)[0])
+            pos += 9
+        else:
+            val, pos = _read_value(buf, pos)
+            append(val)
+    return pos
+
+
+def _skip_value(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag >= FIXINT or tag <= TRUE:
+        return pos
+    if tag == STR:
+        n, pos = _read_varint(buf, pos)
+        return pos + n
+    if tag == INT:
+        return _read_varint(buf, pos)[1]
+    if tag == FLOAT:
+        return pos + 8
+    if tag == LIST:
+        n, pos = _read_varint(buf, pos)
+        for _ in range(n):
+            pos = _skip_value(buf, pos)
+        return pos
+    if tag == DICT:
+        n, pos = _read_varint(buf, pos)
+        for _ in range(n):
+            key_len, pos = _read_varint(buf, pos)
+            pos = _skip_value(buf, pos + key_len)
+        return pos
+    raise ValueError("Invalid binary KSON tag %d at %d" % (tag, pos - 1))
+
+
+class BinaryValues(Sequence):
+    """Sequence of the values in a binary document.
+
+    Only the offsets of the values are read up front, values are
+    decoded directly from the buffer when they are accessed.
+    """
+
+    __slots__ = ('_buf', '_offsets', 'end')
+
+    def __init__(self, buf, pos, n_values):
+        offsets = array(_OFFSET_TYPECODE)
+        append = offsets.append
+        for _ in range(n_values):
+            append(pos)
+            pos = _skip_value(buf, pos)
+        self._buf = buf
+        self._offsets = offsets
+        self.end = pos
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return _read_value(self._buf, self._offsets[i])[0]
+
+    def __len__(self):
+        return len(self._offsets)
+
+
+def _read_header(buf, registry):
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a binary KSON document")
+
+    pos = len(MAGIC)
+    n_ids, pos = _read_varint(buf, pos)
+    schema_ids = []
+    for _ in range(n_ids):
+        schema_id, pos = _read_str(buf, pos)
+        schema_ids.append(schema_id)
+
+    for schema_id in schema_ids:
+        if schema_id[:2] in (u"[]", COLUMNAR_PREFIX):
+            schema_id = schema_id[2:]
+        if schema_id not in registry.schemas:
+            raise ValueError("Unknown schema '%s'" % schema_id)
+
+    return schema_ids, pos
+
+
+def _loadb_lazy(buf, pos, n_values, doc_id, registry):
+    if doc_id[:2] == COLUMNAR_PREFIX:
+        raise ValueError("Lazy decoding requires row layout")
+
+    values = BinaryValues(buf, pos, n_values)
+    if values.end != len(buf):
+        raise ValueError("Extra data after binary KSON document")
+
+    is_array = doc_id[0] == u"["
+    plan = registry.get_plan(doc_id[2:] if is_array else doc_id)
+    if plan.stateful:
+        raise ValueError("Schema %s can only be decoded in order" % (
+            plan.schema_id,
+        ))
+    return lazy_records(values, plan, is_array)
+
+
+def loadb(buf, schema_id=None, lazy=False, registry=None, **kwargs):
+    """deserialize a binary KSON document
+
+    Accepts any object supporting the buffer protocol (bytes, mmap, ...).
+    With lazy=True, records are returned as LazyRecord mappings, whose
+    values (including strings) are only decoded from the buffer, without
+    copying it, when a field is accessed. Additional keyword arguments are
+    passed to loads.
+    """
+    registry = registry or DEFAULT_REGISTRY
+    buf = memoryview(buf)
+    try:
+        schema_ids, pos = _read_header(buf, registry)
+        n_values, pos = _read_varint(buf, pos)
+
+        if lazy:
+            doc_id = schema_id or schema_ids[0]
+            return _loadb_lazy(buf, pos, n_values, doc_id, registry)
+
+        # slices of bytes decode faster than those of a memoryview
+        values = [schema_ids[0]]
+        pos = _read_values(bytes(buf), pos, n_values, values)
+    except (IndexError, struct.error):
+        raise ValueError("Truncated binary KSON document")
+
+    if pos != len(buf):
+        raise ValueError("Extra data after binary KSON document")
+
+    return loads(values, schema_id, registry=registry, **kwargs)
@@ -0,0 +1,267 @@
+# coding: utf-8
+"""Generated row functions for schemas added with codegen=True.
+
+Instead of looping over the fields of a SchemaPlan for every record,
+the python source of a dedicated dump/load function is generated for
+the schema and compiled with exec. Field access is unrolled and the
+built-in codecs are inlined into the generated function.
+"""
+import re
+from datetime import datetime
+from calendar import timegm
+
+from kson import (
+    baseN, parse_codecs, _plain_id, _dump_rows, _load_rows, suffix_codec,
+    prefix_codec, bool_codec, enum_codec, int36_codec, date_codec,
+)
+
+
+## inlined codecs
+#
+# Inliners return the source lines which transform the variable `v`,
+# or None if the codec can't be inlined for the given args.
+
+
+def _inline_suffix(args, v, encode, ns, name):
+    suffix = args[0]
+    if not encode:
+        return ["%s = %s + %r" % (v, v, suffix)]
+    if not suffix:
+        return None
+    return [
+        "if not %s.endswith(%r):" % (v, suffix),
+        "    raise ValueError(%r %% (%s, %r))" % (
+            "Expected %s to have suffix %s", v, suffix
+        ),
+        "%s = %s[:%d]" % (v, v, -len(suffix)),
+    ]
+
+
+def _inline_prefix(args, v, encode, ns, name):
+    prefix = args[0]
+    if not encode:
+        return ["%s = %r + %s" % (v, prefix, v)]
+    return [
+        "if not %s.startswith(%r):" % (v, prefix),
+        "    raise ValueError(%r %% (%s, %r))" % (
+            "Expected %s to have prefix %s", v, prefix
+        ),
+        "%s = %s[%d:]" % (v, v, len(prefix)),
+    ]
+
+
+def _inline_bool(args, v, encode, ns, name):
+    if encode:
+        return ["%s = 1 if %s else 0" % (v, v)]
+    return ["%s = bool(%s)" % (v, v)]
+
+
+def _inline_enum(args, v, encode, ns, name):
+    values = [0] + list(args)
+    if encode:
+        indexes = {}
+        for i, val in enumerate(values):
+            indexes.setdefault(val, i)
+        ns[name] = indexes
+        # like enum_codec, unhashable values are not in the enum
+        return [
+            "try:",
+            "    %s = %s.get(%s, %s)" % (v, name, v, v),
+            "except TypeError:",
+            "    pass",
+        ]
+
+    ns[name] = values
+    return [
+        "if isinstance(%s, int):" % v,
+        "    %s = %s[%s]" % (v, name, v),
+    ]
+
+
+def _inline_int36(args, v, encode, ns, name):
+    if encode:
+        ns['baseN'] = baseN
+        return ["%s = baseN(%s, 36)" % (v, v)]
+    return ["%s = int(%s, 36)" % (v, v)]
+
+
+def _inline_date(args, v, encode, ns, name):
+    if encode:
+        ns['timegm'] = timegm
+        return ["%s = timegm(%s.utctimetuple())" % (v, v)]
+    ns['utcfromtimestamp'] = datetime.utcfromtimestamp
+    return ["%s = utcfromtimestamp(%s)" % (v, v)]
+
+
+# keyed by factory rather than codec id, so that codecs which are
+# overridden using add_codec are not inlined.
+INLINERS = {
+    suffix_codec: _inline_suffix,
+    prefix_codec: _inline_prefix,
+    bool_codec: _inline_bool,
+    enum_codec: _inline_enum,
+    int36_codec: _inline_int36,
+    date_codec: _inline_date,
+}
+
+
+## source generation
+
+
+def _indent(lines, level=1):
+    return ["    " * level + line for line in lines]
+
+
+def _codec_lines(registry, meta_id, v, encode, ns, name):
+    codecs = parse_codecs(meta_id)
+    if not encode:
+        codecs.reverse()
+
+    lines = []
+    for k, (codec_id, args) in enumerate(codecs):
+        factory = registry.codec_factories[codec_id]
+        coder_name = "%s_%d" % (name, k)
+        inliner = INLINERS.get(factory)
+        coder_lines = inliner and inliner(args, v, encode, ns, coder_name)
+        if coder_lines is None:
+            ns[coder_name] = factory(args)[0 if encode else 1]
+            coder_lines = ["%s = %s(%s)" % (v, coder_name, v)]
+        lines.extend(coder_lines)
+    return lines
+
+
+def _field_lines(registry, meta_id, v, encode, ns, name, defs):
+    """source lines which code a field value (which is not None)
+
+    Returns None for plain fields. Functions which are needed by the
+    returned lines are appended to defs.
+    """
+    if not meta_id:
+        return None
+
+    p_meta_id = _plain_id(meta_id)
+    is_array = p_meta_id != meta_id
+
+    if p_meta_id in registry.schemas:
+        ns[name] = registry._field_coders(meta_id)[0 if encode else 1]
+        return ["%s = %s(%s)" % (v, name, v)]
+
+    if p_meta_id not in registry.encoders:
+        return None
+
+    if not is_array:
+        return _codec_lines(registry, p_meta_id, v, encode, ns, name)
+
+    factories = [
+        registry.codec_factories[c] for c, _ in parse_codecs(p_meta_id)
+    ]
+    if not all(f in INLINERS for f in factories):
+        # custom codecs may code the whole list at once
+        if encode:
+            ns[name] = registry.many_encoders[p_meta_id]
+        else:
+            ns[name] = registry.many_decoders[p_meta_id]
+        return ["%s = %s(%s)" % (v, name, v)]
+
+    defs.append("def %s(v):" % name)
+    defs.extend(_indent(
+        _codec_lines(registry, p_meta_id, "v", encode, ns, name)
+    ))
+    defs.append("    return v")
+    defs.append("")
+    return ["%s = [%s(x) for x in %s]" % (v, name, v)]
+
+
+def _dump_source(plan, meta, ns, func_name):
+    defs = []
+    body = []
+    vals = []
+    for i, (field, meta_id) in enumerate(zip(plan.fields, meta)):
+        v = "v%d" % i
+        lines = _field_lines(plan.registry, meta_id, v, True, ns,
+                             "enc_%d" % i, defs)
+        if lines is None:
+            vals.append("get(%r)," % field)
+            continue
+
+        body.append("%s = get(%r)" % (v, field))
+        body.append("if %s is not None:" % v)
+        body.extend(_indent(lines))
+        vals.append("%s," % v)
+
+    ns['dump_rows'] = _dump_rows
+    src = defs + [
+        "def %s(plan, data, result):" % func_name,
+        "    extend = result.extend",
+        "    for obj in data:",
+        "        if obj.__class__ is not dict:",
+        "            # other mappings and record objects",
+        "            dump_rows(plan, (obj,), result)",
+        "            continue",
+        "        get = obj.get",
+    ]
+    src.extend(_indent(body, 2))
+    src.append("        extend((")
+    src.extend(_indent(vals, 3))
+    src.append("        ))")
+    return src
+
+
+def _load_source(plan, meta, ns, func_name):
+    n_fields = plan.n_fields
+    defs = []
+    body = []
+    items = []
+    for i, (field, meta_id) in enumerate(zip(plan.fields, meta)):
+        v = "v%d" % i
+        lines = _field_lines(plan.registry, meta_id, v, False, ns,
+                             "dec_%d" % i, defs)
+        if lines is not None:
+            body.append("if %s is not None:" % v)
+            body.extend(_indent(lines))
+        items.append("%r: %s," % (field, v))
+
+    names = ", ".join("v%d" % i for i in range(n_fields))
+    if n_fields == 1:
+        names += ","
+
+    ns['load_rows'] = _load_rows
+    src = defs + [
+        "def %s(plan, data, start, result):" % func_name,
+        "    append = result.append",
+        "    n_data = len(data)",
+        "    end = n_data - (n_data - start) %% %d" % n_fields,
+        "    for i in range(start, end, %d):" % n_fields,
+        "        %s = data[i:i + %d]" % (names, n_fields),
+    ]
+    src.extend(_indent(body, 2))
+    src.append("        append({")
+    src.extend(_indent(items, 3))
+    src.append("        })")
+    src.extend([
+        "    if end < n_data:",
+        "        # incomplete trailing record",
+        "        load_rows(plan, data, end, result)",
+    ])
+    return src
+
+
+def generate_source(plan, schema):
+    """returns the source and namespace of the row functions of a plan"""
+    name = re.sub(r"\W", "_", plan.schema_id)
+    ns = {}
+    src = _dump_source(plan, schema['meta'], ns, "dump_" + name)
+    src.append("")
+    src.extend(_load_source(plan, schema['meta'], ns, "load_" + name))
+    return "\n".join(src) + "\n", ns
+
+
+def generate_rows_functions(plan, schema):
+    if plan.n_fields == 0:
+        return plan.dump_rows, plan.load_rows
+
+    name = re.sub(r"\W", "_", plan.schema_id)
+    src, ns = generate_source(plan, schema)
+    code = compile(src, "<kson codegen %s>" % plan.schema_id, "exec")
+    exec(code, ns)
+    return ns["dump_" + name], ns["load_" + name]
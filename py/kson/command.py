@@ -10,21 +10,47 @@ to describe arbitrarrily nested objects.
 
 Usage:
     kson introspect [-jp] [-i <input>] [-o <output>] [--schema_id <id>]
+        [--sample <n>] [--no-codecs] [--backend <name>]
+        [--compression <name>]
     kson (j2k|k2j|k2k|j2j) [<schemas>...] [-i <input>] [-o <output>] [-p]
-        [--schema_id <id>] [--out_schema_id=<id>]
+        [--schema_id <id>] [--out_schema_id=<id>] [--jobs <n>] [--lines]
+        [--backend <name>] [--compression <name>]
+    kson stats [<schemas>...] [-i <input>] [-o <output>] [-j]
+        [--schema_id <id>] [--backend <name>]
+
+Commands:
+    stats                   Decode and encode the input, reporting the time
+                            spent by schema, codec and json library
 
 Options:
     --version               Show version
     -h --help               Show help
     -i --input=<input>      Input file
     -o --output=<output>    Output file (defaults to)
-    -j --json               Write output as JSON instead of KSON
+    -j --json               Write output as JSON instead of KSON (for stats,
+                            write the report as JSON)
     -s --schema_id=<id>     Explicitly specify schema (required if schema
                             file is ambiguous about the top level schema.)
     -p --pretty             Indentat output
     --out_schema_id=<id>    Use different schema for output during conversion
+    --sample=<n>            Only inspect n elements of each array during
+                            introspection (the first n of a top level array)
+    --no-codecs             Don't detect codecs during introspection
+    --jobs=<n>              Convert the records of top level arrays with
+                            n worker processes [default: 1]
+    --lines                 Newline delimited input and output, JSONL for
+                            json and KSONL for kson
+    --backend=<name>        JSON library used for parsing and serialization:
+                            auto, json, ujson, orjson or simdjson (defaults
+                            to $KSON_JSON_BACKEND or auto, which picks ujson
+                            or json; orjson loses big ints and NaN)
+    --compression=<name>    Compress the output with gzip, zlib, zstd or lz4
+                            (defaults to the extension of the output file).
+                            Compressed input is detected automatically.
 """
 
+import io
+import re
 import sys
 import json
 
@@ -34,25 +60,90 @@ except ImportError:
     # some setup to run from dev environment
     from os.path import abspath, dirname, join, pardir
     sys.path.insert(0, abspath(join(dirname(__file__), pardir)))
+    import kson
 
-from kson import __version__, SCHEMAS
+from kson import __version__, SCHEMAS, STRING_TYPES, COLUMNAR_PREFIX
+from kson.stream import StreamDecoder, CHUNK_SIZE
+from kson.lines import header_line, encode_line, decode_line
+from kson.stats import format_stats
+from kson.compression import (
+    FORMATS as COMPRESSIONS, CompressedWriter, open_compressed,
+    maybe_decompress, compression_for_filename,
+)
 
 
 def read(opts):
+    """returns the raw (decompressed) input, as bytes if possible"""
     if opts['--input']:
-        with open(opts['--input'], 'r') as f:
-            return f.read()
-
-    return sys.stdin.read()
+        with open(opts['--input'], 'rb') as f:
+            return maybe_decompress(f.read())
+
+    return maybe_decompress(getattr(sys.stdin, 'buffer', sys.stdin).read())
+
+
+def _open_input(opts):
+    """opens the input as text, compressed files are decompressed"""
+    if not opts['--input']:
+        return sys.stdin
+    return io.TextIOWrapper(open_compressed(opts['--input']),
+                            encoding='utf-8')
+
+
+def _open_output(opts):
+    """opens the output as text, compressed if --compression is given or
+    implied by the extension of the output file
+    """
+    compression = opts['--compression']
+    if not opts['--output']:
+        if not compression:
+            return sys.stdout
+        fp = io.BufferedWriter(CompressedWriter(sys.stdout.buffer,
+                                                compression))
+        return io.TextIOWrapper(fp, encoding='utf-8')
+
+    compression = compression or compression_for_filename(opts['--output'])
+    if not compression:
+        return open(opts['--output'], 'w')
+    return io.TextIOWrapper(open_compressed(opts['--output'], 'wb',
+                                            compression), encoding='utf-8')
+
+
+def iter_json_input(opts):
+    """returns the parsed input, top level arrays are decoded lazily"""
+    f = _open_input(opts)
+    head = f.read(CHUNK_SIZE)
+    if head.lstrip()[:1] != "[":
+        try:
+            return kson.json_loads(head + f.read())
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def iter_elements():
+        decoder = StreamDecoder(plain=True)
+        chunk = head
+        try:
+            while chunk:
+                for elem in decoder.feed(chunk):
+                    yield elem
+                chunk = f.read(CHUNK_SIZE)
+            for elem in decoder.close():
+                yield elem
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    return iter_elements()
 
 
 def write(opts, data):
-    if opts['--output']:
-        with open(opts['--output'], 'w') as f:
-            f.write(data)
-    else:
+    f = _open_output(opts)
+    if f is sys.stdout:
         sys.stdout.write(data)
         sys.stdout.write("\n")
+    else:
+        with f:
+            f.write(data)
 
 
 def find_top_schema(schemas):
@@ -84,24 +175,61 @@ def load_opts_schemas(opts):
     return schemas
 
 
-def introspect(opts, in_data, schema_id=None):
+def introspect(opts):
+    sample = opts['--sample']
+    savings = []
     sid, schemas = kson.detect_schemas(
-        read(opts), id_prefix=opts['--schema_id']
+        iter_json_input(opts),
+        id_prefix=opts['--schema_id'],
+        sample=int(sample) if sample else None,
+        codecs=not opts['--no-codecs'],
+        savings=savings,
     )
 
+    for schema_id, field, meta_id, n_bytes in savings:
+        sys.stderr.write("%s.%s: %s (~%d bytes saved)\n" % (
+            schema_id, field, meta_id, n_bytes
+        ))
+
     if opts['--json']:
         schema_data = json.dumps(schemas, indent=4)
     else:
-        schema_data = kson.dumps(schemas, 'schema')
+        schema_data = kson.dumps(schemas, '[]schema')
 
     write(opts, schema_data)
     return 0
 
 
-def init_schemas(opts):
+def stats(opts):
+    in_schema, _, ok = init_schemas(opts)
+    if not ok:
+        return 1
+
+    in_data = read(opts)
+    header = kson.json_loads(in_data)
+    header = header[0] if isinstance(header, list) and header else None
+    if not isinstance(header, STRING_TYPES):
+        sys.stderr.write("Input is not a KSON document\n")
+        return 1
+
+    # the schema of the document is replaced by the input schema
+    prefix = header[:2] if header[:2] in ("[]", COLUMNAR_PREFIX) else ""
+    layout = kson.COLUMNAR if prefix == COLUMNAR_PREFIX else kson.ROWS
+    with kson.collect_stats() as collected:
+        data = kson.loads(in_data, prefix + in_schema['id'])
+        kson.dumps(data, doc_schema_id(data, in_schema), layout=layout)
+
+    if opts['--json']:
+        write(opts, json.dumps(collected.as_dict(), indent=4))
+    else:
+        write(opts, format_stats(collected.as_dict()))
+    return 0
+
+
+def init_schemas(opts, header_id=None):
     loaded_schemas = load_opts_schemas(opts)
 
-    in_schema_id = opts['--schema_id']
+    in_schema_id = opts['--schema_id'] or header_id
 
     if loaded_schemas and not in_schema_id:
         in_schema_id, ok = find_top_schema(loaded_schemas)
@@ -131,28 +259,329 @@ def init_schemas(opts):
     return in_schema, out_schema, True
 
 
+def doc_schema_id(data, schema):
+    return "[]" + schema['id'] if isinstance(data, list) else schema['id']
+
+
+## parallel conversion
+#
+# The input is streamed and the raw text of the records of top level
+# arrays is split into chunks, which are parsed and converted by worker
+# processes. Each worker returns its part of the output array (without
+# brackets), which are written in order.
+
+# minimum number of records per chunk of newline delimited input
+MIN_CHUNK_RECORDS = 1000
+
+# approximate size of the chunks of top level arrays
+PARALLEL_CHUNK_CHARS = 256 * 1024
+
+
+def _init_worker(schemas, backend):
+    kson.set_backend(backend)
+    for schema in schemas:
+        kson.add_schema(schema)
+
+
+def _convert_chunk(args):
+    mode, text, in_id, out_id = args
+    # the raw elements are parsed by the workers
+    values = kson.json_loads("[" + text + "]")
+    if mode == 'j2k':
+        records = values
+    else:
+        records = kson.loads(values, "[]" + in_id, is_recurse=True)
+
+    if mode == 'k2j':
+        return kson.json_dumps(records)[1:-1]
+    return kson.json_dumps(kson.dumps(records, "[]" + out_id, True))[1:-1]
+
+
+# whitespace and the comma which precede an element of a json array
+_SEPARATOR_RE = re.compile(r"[ \t\n\r,]*")
+_ELEMENT_ENDS = frozenset(" \t\n\r,]")
+
+# commas at which chunks of scalars and of objects or arrays are cut
+_CUT_RES = (re.compile(r","), re.compile(r"[}\]][ \t\n\r]*,"))
+
+
+def _split_array(text, in_f, group, skip, chunk_chars):
+    """yields the raw text of the elements of a top level json array
+
+    text is the beginning of the array (starting with "["), the rest is
+    read from in_f. The first skip elements are yielded one by one, the
+    following ones as comma separated chunks of about chunk_chars, which
+    contain a multiple of group elements. The text is only scanned by
+    the json module to find the ends of chunks, the values are discarded.
+    """
+    loads = json.loads
+    raw_decode = json.JSONDecoder().raw_decode
+    match_separator = _SEPARATOR_RE.match
+    cut_patterns = list(_CUT_RES)
+    buf = text
+    pos = start = buf.index("[") + 1
+    n = 0
+    eof = False
+    while True:
+        if pos == start and not skip and cut_patterns:
+            if not eof and len(buf) - start < 2 * chunk_chars:
+                more = in_f.read(max(CHUNK_SIZE, 2 * chunk_chars))
+                eof = not more
+                buf = buf[start:] + more
+                pos = start = 0
+                continue
+            # Scanning many small elements one by one is slow, so the
+            # chunk is cut at a comma after chunk_chars, if the text up
+            # to it parses as elements of the array (a comma in a string
+            # or a nested value leaves it incomplete).
+            match = cut_patterns[0].search(buf, start + chunk_chars)
+            if match:
+                cut = match.end() - 1
+                try:
+                    n = len(loads("[" + buf[start:cut].lstrip(" \t\n\r,")
+                                  + "]"))
+                    pos = cut
+                except ValueError:
+                    # without a matching pattern, the elements are
+                    # scanned one by one
+                    cut_patterns.pop(0)
+                    continue
+
+        pos = match_separator(buf, pos).end()
+        if pos < len(buf) and buf[pos] == "]":
+            part = buf[start:pos].lstrip(" \t\n\r,")
+            if part:
+                yield part
+            return
+
+        try:
+            if pos == len(buf):
+                raise ValueError("Unexpected end of json array")
+            end = raw_decode(buf, pos)[1]
+            if not eof and buf[end:end + 1] not in _ELEMENT_ENDS:
+                # a number may continue in the next chunk
+                raise ValueError("Incomplete element")
+        except ValueError:
+            if eof:
+                raise
+            # incomplete element, larger elements are read faster
+            more = in_f.read(max(CHUNK_SIZE, len(buf) - start))
+            eof = not more
+            buf = buf[start:] + more
+            pos -= start
+            start = 0
+            continue
+
+        pos = end
+        n += 1
+        if skip:
+            skip -= 1
+        elif n % group or pos - start < chunk_chars:
+            continue
+        yield buf[start:pos].lstrip(" \t\n\r,")
+        start = pos
+        n = 0
+
+
+def _imap(fn, tasks, jobs):
+    """yields fn(task) for each task, using jobs worker processes"""
+    if jobs <= 1:
+        for task in tasks:
+            yield fn(task)
+        return
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    initargs = (list(SCHEMAS.values()), kson.get_backend())
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=initargs) as executor:
+        # only a few chunks are submitted ahead, so that the input
+        # doesn't have to be read completely
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(fn, task))
+            if len(pending) > jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def convert_parallel(opts, mode, head, in_f, in_schema, out_schema):
+    """converts the input, whose first characters are head, with worker
+    processes. Returns False if it can't be split, without reading more
+    of the input.
+    """
+    if any(kson.get_plan(s['id']).stateful for s in (in_schema, out_schema)):
+        # values may refer to values of previous chunks
+        return False
+
+    stripped = head.lstrip()
+    if mode == 'j2k':
+        if stripped[:1] != "[":
+            return False
+        group, skip = 1, 0
+    else:
+        if stripped[:4] != '["[]':
+            return False
+        group, skip = len(in_schema['fields']), 1
+        if group == 0:
+            return False
+
+    elements = _split_array(head, in_f, group, skip, PARALLEL_CHUNK_CHARS)
+    if skip:
+        # the schema of the document is replaced by the input schema
+        next(elements)
+    tasks = (
+        (mode, chunk, in_schema['id'], out_schema['id'])
+        for chunk in elements
+    )
+
+    out_f = _open_output(opts)
+    try:
+        if mode == 'k2j':
+            out_f.write("[")
+        else:
+            out_f.write(kson.json_dumps(["[]" + out_schema['id']])[:-1])
+        sep = "" if mode == 'k2j' else ","
+        for part in _imap(_convert_chunk, tasks, int(opts['--jobs'])):
+            if part:
+                out_f.write(sep + part)
+                sep = ","
+        out_f.write("]")
+        if out_f is sys.stdout:
+            out_f.write("\n")
+    finally:
+        if out_f is not sys.stdout:
+            out_f.close()
+    return True
+
+
+## newline delimited conversion
+
+
+def _convert_lines_chunk(args):
+    mode, lines, in_id, out_id = args
+    in_plan = kson.get_plan(in_id)
+    out_plan = kson.get_plan(out_id)
+
+    out = []
+    for line in lines:
+        if not line.strip():
+            continue
+        if mode == 'j2k':
+            record = kson.json_loads(line)
+        else:
+            record = decode_line(line, in_plan)
+
+        if mode == 'k2j':
+            out.append(kson.json_dumps(record) + "\n")
+        else:
+            out.append(encode_line(record, out_plan))
+    return "".join(out)
+
+
+def _line_chunks(lines, n_lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == n_lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _read_header_line(in_f):
+    for line in in_f:
+        if line.strip():
+            header = kson.json_loads(line)
+            if len(header) > 1:
+                # embedded schemas
+                kson.loads_schemas(header[1])
+            return header[0][2:]
+    return None
+
+
+def convert_lines(opts, mode):
+    """convert JSONL and KSONL line by line"""
+    in_f = _open_input(opts)
+    out_f = _open_output(opts)
+    try:
+        header_id = None if mode == 'j2k' else _read_header_line(in_f)
+        in_schema, out_schema, ok = init_schemas(opts, header_id)
+        if not ok:
+            return 1
+
+        if mode != 'k2j':
+            out_f.write(header_line(out_schema['id']))
+
+        tasks = (
+            (mode, lines, in_schema['id'], out_schema['id'])
+            for lines in _line_chunks(in_f, MIN_CHUNK_RECORDS)
+        )
+        for part in _imap(_convert_lines_chunk, tasks, int(opts['--jobs'])):
+            out_f.write(part)
+    finally:
+        if in_f is not sys.stdin:
+            in_f.close()
+        if out_f is not sys.stdout:
+            out_f.close()
+    return 0
+
+
 def convert(opts):
+    mode = [m for m in ('j2k', 'k2j', 'k2k') if opts[m]]
+    if opts['--lines']:
+        if not mode:
+            sys.stderr.write("--lines requires j2k, k2j or k2k\n")
+            return 1
+        return convert_lines(opts, mode[0])
+
     if not opts['j2j']:
         in_schema, out_schema, ok = init_schemas(opts)
 
         if not ok:
             return 1
 
-    in_data = read(opts)
+    if mode and int(opts['--jobs']) > 1 and not opts['--pretty']:
+        # the input is streamed to the workers
+        in_f = _open_input(opts)
+        try:
+            head = in_f.read(CHUNK_SIZE)
+            if convert_parallel(opts, mode[0], head, in_f, in_schema,
+                                out_schema):
+                return 0
+            in_data = head + in_f.read()
+        finally:
+            if in_f is not sys.stdin:
+                in_f.close()
+    else:
+        in_data = read(opts)
 
     if opts['j2k'] or opts['j2j']:
-        in_data = json.loads(in_data)
+        in_data = kson.json_loads(in_data)
 
     if opts['k2j'] or opts['k2k']:
-        in_data = kson.loads(in_data, in_schema['id'])
-
-    indent = 4 if opts['--pretty'] else None
+        # the schema of the document is replaced by the input schema
+        in_data = kson.json_loads(in_data)
+        is_array = isinstance(in_data, list) and in_data[:1] and \
+            in_data[0][:2] == "[]"
+        in_id = "[]" + in_schema['id'] if is_array else in_schema['id']
+        in_data = kson.loads(in_data, in_id)
 
     if opts['k2j'] or opts['j2j']:
-        out_data = json.dumps(in_data, indent=indent)
+        if opts['--pretty']:
+            out_data = json.dumps(in_data, indent=4)
+        else:
+            out_data = kson.json_dumps(in_data)
 
     if opts['j2k'] or opts['k2k']:
-        out_data = kson.dumps(in_data, out_schema['id'], indent=indent)
+        out_id = doc_schema_id(in_data, out_schema)
+        if opts['--pretty']:
+            out_data = kson.dumps(in_data, out_id, indent=4)
+        else:
+            out_data = kson.dumps(in_data, out_id)
 
     write(opts, out_data)
     return 0
@@ -161,10 +590,24 @@ def convert(opts):
 def main(args=sys.argv[1:]):
     from docopt import docopt
     opts = docopt(__doc__, args, version=__version__)
+    if opts['--compression'] and opts['--compression'] not in COMPRESSIONS:
+        sys.stderr.write("--compression: invalid compression %s\n" % (
+            opts['--compression'],
+        ))
+        return 1
+    if opts['--backend']:
+        try:
+            kson.set_backend(opts['--backend'])
+        except (ValueError, ImportError) as err:
+            sys.stderr.write("--backend: %s\n" % err)
+            return 1
 
     if opts['introspect']:
         return introspect(opts)
 
+    if opts['stats']:
+        return stats(opts)
+
     return convert(opts)
 
 
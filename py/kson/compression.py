@@ -0,0 +1,337 @@
+# coding: utf-8
+"""Transparent compression of KSON files.
+
+Supports gzip and zlib (from the standard library), zstd (requires the
+zstandard package) and lz4 (requires the lz4 package). Compressed data is
+recognized by its magic bytes, files written by dump are compressed
+according to the extension of their name (.gz, .zz, .zst, .lz4).
+
+All formats are coded incrementally, so that iterload and dump_iter
+only keep the current chunk in memory. For small messages, zstd can use
+a dictionary trained from sample records of a schema, see
+train_dictionary.
+"""
+import io
+import zlib
+
+from kson import DEFAULT_REGISTRY, dumps
+
+
+## formats
+#
+# Formats provide functions which return a compressor (with compress and
+# flush methods) and a decompressor (with a decompress method), like the
+# objects of zlib.compressobj and zlib.decompressobj.
+
+
+def _gzip_compressor(level, dictionary):
+    if dictionary is not None:
+        raise ValueError("Dictionaries are only supported by zstd")
+    return zlib.compressobj(9 if level is None else level, zlib.DEFLATED, 31)
+
+
+def _gzip_decompressor(dictionary):
+    return zlib.decompressobj(31)
+
+
+def _zlib_compressor(level, dictionary):
+    if dictionary is not None:
+        raise ValueError("Dictionaries are only supported by zstd")
+    return zlib.compressobj(9 if level is None else level)
+
+
+def _zlib_decompressor(dictionary):
+    return zlib.decompressobj()
+
+
+def _zstd_dict(zstandard, dictionary):
+    if dictionary is None or isinstance(dictionary,
+                                        zstandard.ZstdCompressionDict):
+        return dictionary
+    return zstandard.ZstdCompressionDict(dictionary)
+
+
+def _zstd_compressor(level, dictionary):
+    import zstandard
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level,
+        dict_data=_zstd_dict(zstandard, dictionary),
+    ).compressobj()
+
+
+def _zstd_decompressor(dictionary):
+    import zstandard
+    return zstandard.ZstdDecompressor(
+        dict_data=_zstd_dict(zstandard, dictionary),
+    ).decompressobj()
+
+
+class _LZ4Compressor(object):
+    def __init__(self, level):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=0 if level is None else level
+        )
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, b""
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, b""
+        return header + self._compressor.flush()
+
+
+def _lz4_compressor(level, dictionary):
+    if dictionary is not None:
+        raise ValueError("Dictionaries are only supported by zstd")
+    return _LZ4Compressor(level)
+
+
+def _lz4_decompressor(dictionary):
+    import lz4.frame
+    return lz4.frame.LZ4FrameDecompressor()
+
+
+def _is_zlib(head):
+    # deflate with a 32K window and one of the standard compression levels,
+    # any valid header would also match plain documents like "80"
+    return head[:1] == b"\x78" and head[1:2] in (
+        b"\x01", b"\x5e", b"\x9c", b"\xda",
+    )
+
+
+# name: (extensions, is_format(head), compressor, decompressor)
+FORMATS = {
+    'gzip': (
+        (".gz",), lambda head: head[:2] == b"\x1f\x8b",
+        _gzip_compressor, _gzip_decompressor,
+    ),
+    'zlib': (
+        (".zz", ".zlib"), _is_zlib, _zlib_compressor, _zlib_decompressor,
+    ),
+    'zstd': (
+        (".zst", ".zstd"), lambda head: head[:4] == b"\x28\xb5\x2f\xfd",
+        _zstd_compressor, _zstd_decompressor,
+    ),
+    'lz4': (
+        (".lz4",), lambda head: head[:4] == b"\x04\x22\x4d\x18",
+        _lz4_compressor, _lz4_decompressor,
+    ),
+}
+
+# number of bytes required by detect
+MAGIC_SIZE = 4
+
+
+def _format(compression):
+    if compression not in FORMATS:
+        raise ValueError("Invalid compression: " + str(compression))
+    return FORMATS[compression]
+
+
+def detect(head):
+    """returns the compression of data starting with head, or None"""
+    if not isinstance(head, bytes):
+        return None
+    for name, (_, is_format, _, _) in FORMATS.items():
+        if is_format(head):
+            return name
+    return None
+
+
+def _detect_start(chunk, dictionary=None):
+    """detect for the first chunk of a stream, returns None if the chunk
+    doesn't decompress as zlib data
+    """
+    compression = detect(bytes(chunk[:MAGIC_SIZE]))
+    if compression == 'zlib':
+        try:
+            _zlib_decompressor(dictionary).decompress(bytes(chunk[:1024]))
+        except zlib.error:
+            return None
+    return compression
+
+
+def compression_for_filename(filename):
+    """returns the compression implied by the extension of a file name"""
+    if isinstance(filename, bytes):
+        filename = filename.decode('utf-8')
+    for name, (extensions, _, _, _) in FORMATS.items():
+        if filename.endswith(extensions):
+            return name
+    return None
+
+
+def compress(data, compression="gzip", level=None, dictionary=None):
+    compressor = _format(compression)[2](level, dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, compression=None, dictionary=None):
+    """decompresses data, the compression is detected if not given"""
+    compression = compression or detect(bytes(data[:MAGIC_SIZE]))
+    if compression is None:
+        raise ValueError("Unknown compression")
+    return _format(compression)[3](dictionary).decompress(bytes(data))
+
+
+def maybe_decompress(data, dictionary=None):
+    """decompresses data if it's compressed, otherwise returns it as is"""
+    if isinstance(data, str) and not isinstance(data, bytes):
+        return data
+    compression = detect(bytes(data[:MAGIC_SIZE]))
+    if compression is None:
+        return data
+    if compression != 'zlib':
+        return decompress(data, compression, dictionary)
+    try:
+        # unlike decompressobj, this raises for incomplete data
+        return zlib.decompress(bytes(data))
+    except zlib.error:
+        # a plain document which starts like a zlib header
+        return data
+
+
+## streams
+
+
+class CompressedWriter(io.RawIOBase):
+    """file object which compresses the data written to it
+
+    Closing the writer writes the end of the compressed stream, the
+    underlying file object is only closed if close_fp is True.
+    """
+
+    def __init__(self, fp, compression="gzip", level=None, dictionary=None,
+                 close_fp=False):
+        io.RawIOBase.__init__(self)
+        self.fp = fp
+        self.close_fp = close_fp
+        self._compressor = _format(compression)[2](level, dictionary)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.fp.write(compressed)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.fp.write(self._compressor.flush())
+        if self.close_fp:
+            self.fp.close()
+        elif hasattr(self.fp, 'flush'):
+            self.fp.flush()
+        io.RawIOBase.close(self)
+
+
+class DecompressedReader(io.RawIOBase):
+    """file object which reads the decompressed data of a file object
+
+    The compression is detected from the first chunk of the file, data
+    which isn't compressed is read as it is.
+    """
+
+    def __init__(self, fp, dictionary=None, chunk_size=64 * 1024,
+                 close_fp=False):
+        io.RawIOBase.__init__(self)
+        self.fp = fp
+        self.close_fp = close_fp
+        self.compression = None
+        self._dictionary = dictionary
+        self._chunk_size = chunk_size
+        self._decompressor = None
+        self._started = False
+        self._buf = b""
+
+    def readable(self):
+        return True
+
+    def _start(self, chunk):
+        self._started = True
+        while chunk and len(chunk) < MAGIC_SIZE:
+            more = self.fp.read(self._chunk_size)
+            if not more:
+                break
+            chunk += more
+        self.compression = _detect_start(chunk, self._dictionary)
+        if self.compression:
+            decompressor = _format(self.compression)[3]
+            self._decompressor = decompressor(self._dictionary)
+        return chunk
+
+    def readinto(self, buf):
+        data = self._buf
+        while not data:
+            chunk = self.fp.read(self._chunk_size)
+            if not self._started:
+                chunk = self._start(chunk)
+            if not chunk:
+                return 0
+            if self._decompressor is None:
+                data = chunk
+            else:
+                # a compressed chunk may not produce any output yet
+                data = self._decompressor.decompress(chunk)
+        n = min(len(buf), len(data))
+        buf[:n] = data[:n]
+        self._buf = data[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        if self.close_fp:
+            self.fp.close()
+        io.RawIOBase.close(self)
+
+
+def open_compressed(filename, mode="rb", compression=None, level=None,
+                    dictionary=None):
+    """opens a (possibly) compressed file as a binary file object
+
+    For reading, the compression is detected from the content of the file.
+    For writing, it defaults to the compression implied by the extension
+    of the file name, if there is none, the file isn't compressed.
+    """
+    if "r" in mode:
+        return io.BufferedReader(DecompressedReader(
+            open(filename, 'rb'), dictionary, close_fp=True
+        ))
+
+    compression = compression or compression_for_filename(filename)
+    fp = open(filename, mode.replace("b", "") + "b")
+    if compression is None:
+        return fp
+    return io.BufferedWriter(CompressedWriter(
+        fp, compression, level, dictionary, close_fp=True
+    ))
+
+
+## zstd dictionaries
+
+
+def train_dictionary(records, schema_id, dict_size=16 * 1024,
+                     registry=None):
+    """trains a zstd dictionary for small messages of a schema
+
+    The records are encoded as individual documents with schema_id,
+    which are the samples the dictionary is trained with. The returned
+    zstandard.ZstdCompressionDict can be passed as dictionary to dump
+    and load, dictionary.as_bytes() returns its data for storage.
+    """
+    import zstandard
+    registry = registry or DEFAULT_REGISTRY
+    samples = [
+        dumps(record, schema_id, as_bytes=True, registry=registry)
+        for record in records
+    ]
+    return zstandard.train_dictionary(dict_size, samples)
@@ -0,0 +1,484 @@
+# coding: utf-8
+"""Inference of schemas from example data.
+
+The data is walked once, objects at the same position (the same field
+of a parent schema, or the elements of an array) are merged into a
+single node. Once all data has been seen, nodes with the same fields
+and meta are merged by their signature and only then are the resulting
+schemas registered.
+
+The plain values of each field are summarized on the way, which is used
+to pick codecs (prefix, suffix, enum, bool, int36, date) that reduce the
+size of the serialized data. Codecs are only picked if they are lossless
+for all values which were seen. With sampling, prefix and suffix codecs
+aren't picked, since values which weren't inspected would fail to
+encode if they don't share the affix.
+"""
+import os
+import re
+from base64 import urlsafe_b64encode
+from calendar import timegm
+from datetime import datetime
+from itertools import islice
+from os.path import commonprefix
+
+from kson import (
+    PY2, DEFAULT_REGISTRY, json_loads, baseN, Mapping, _plain_id,
+)
+
+if PY2:
+    _str_types = (str, unicode)
+    _text_type = unicode
+    _int_types = (int, long)
+else:
+    _str_types = (str, bytes)
+    _text_type = str
+    _int_types = (int,)
+
+# kinds of values seen for a field
+_PLAIN = 1
+_OBJECT = 2
+_OBJECT_ARRAY = 4
+_PLAIN_ARRAY = 8
+_EMPTY_ARRAY = 16
+
+_ARRAY_KINDS = _OBJECT_ARRAY | _PLAIN_ARRAY | _EMPTY_ARRAY
+
+
+class _Node(object):
+    """merged fields of all objects seen at one position"""
+
+    __slots__ = ('fields',)
+
+    def __init__(self):
+        # field -> [kinds, child node, value stats]
+        self.fields = {}
+
+
+## codec detection
+
+
+# types of plain values seen for a field
+_BOOL = 1
+_INT = 2
+_STR = 4
+_DATE = 8
+_OTHER = 16
+
+# string fields with more distinct values are not considered for enum
+MAX_ENUM_VALUES = 32
+
+_ESCAPE_RE = re.compile(r"([:|])")
+
+
+def _escape_arg(arg):
+    return _ESCAPE_RE.sub(r"\\\1", arg)
+
+
+def _common_suffix(a, b):
+    n = 0
+    max_n = min(len(a), len(b))
+    while n < max_n and a[-1 - n] == b[-1 - n]:
+        n += 1
+    return a[len(a) - n:]
+
+
+def _int36_savings(val):
+    # the int36 codec encodes to a string, which requires quotes
+    return len(str(val)) - len(baseN(val, 36)) - 2
+
+
+def _is_utc_seconds(val):
+    # the date codec stores whole seconds since the epoch in UTC
+    offset = val.utcoffset()
+    return val.microsecond == 0 and not offset
+
+
+class _ValueStats(object):
+    """summary of the plain values of a field, used to pick codecs"""
+
+    __slots__ = (
+        'types', 'n_values', 'counts', 'prefix', 'suffix', 'min_len',
+        'bool_savings', 'int36_savings', 'date_savings',
+        'date_int36_savings', 'affixes',
+    )
+
+    def __init__(self, affixes=True):
+        # False if only a sample of the values is seen
+        self.affixes = affixes
+        self.types = 0
+        self.n_values = 0
+        self.counts = {}
+        self.prefix = None
+        self.suffix = None
+        self.min_len = 0
+        self.bool_savings = 0
+        self.int36_savings = 0
+        self.date_savings = 0
+        self.date_int36_savings = 0
+
+    def add(self, val):
+        self.n_values += 1
+        if val is True or val is False:
+            self.types |= _BOOL
+            # "true" -> 1, "false" -> 0
+            self.bool_savings += 3 if val else 4
+        elif isinstance(val, _int_types):
+            self.types |= _INT
+            self.int36_savings += _int36_savings(val)
+        elif isinstance(val, _text_type):
+            self.types |= _STR
+            self._add_str(val)
+        elif isinstance(val, datetime) and _is_utc_seconds(val):
+            self.types |= _DATE
+            timestamp = timegm(val.utctimetuple())
+            self.date_savings += len(val.isoformat()) + 2 - len(str(timestamp))
+            self.date_int36_savings += _int36_savings(timestamp)
+        else:
+            self.types |= _OTHER
+
+    def _add_str(self, val):
+        counts = self.counts
+        if counts is not None:
+            if val in counts:
+                counts[val] += 1
+            elif len(counts) < MAX_ENUM_VALUES and u"\\" not in val:
+                counts[val] = 1
+            else:
+                self.counts = None
+
+        if self.prefix is None:
+            self.prefix = self.suffix = val
+            self.min_len = len(val)
+            return
+        if self.prefix:
+            self.prefix = commonprefix((self.prefix, val))
+        if self.suffix:
+            self.suffix = _common_suffix(self.suffix, val)
+        self.min_len = min(self.min_len, len(val))
+
+    def _enum_codec(self):
+        if not self.counts:
+            return None, 0
+        values = sorted(self.counts, key=lambda v: (-self.counts[v], v))
+        meta_id = u":".join([u"enum"] + [_escape_arg(v) for v in values])
+        savings = -len(meta_id)
+        for i, val in enumerate(values):
+            savings += self.counts[val] * (len(val) + 2 - len(str(i + 1)))
+        return meta_id, savings
+
+    def _affix_codec(self):
+        if not self.affixes:
+            return None, 0
+        prefix = (self.prefix or u"").split(u"\\")[0]
+        # the suffix is removed from the value without the prefix
+        max_suffix = self.min_len - len(prefix)
+        suffix = (self.suffix or u"")[-max_suffix:] if max_suffix > 0 else u""
+        suffix = suffix.split(u"\\")[-1]
+
+        codecs = []
+        if prefix:
+            codecs.append(u"prefix:" + _escape_arg(prefix))
+        if suffix:
+            codecs.append(u"suffix:" + _escape_arg(suffix))
+        if not codecs:
+            return None, 0
+
+        meta_id = u"|".join(codecs)
+        savings = self.n_values * (len(prefix) + len(suffix)) - len(meta_id)
+        return meta_id, savings
+
+    def codec(self):
+        """returns the meta id of the best codec and its savings in bytes
+
+        The savings are an estimate for the values which were seen,
+        the size of the codec in the schema is subtracted.
+        """
+        types = self.types
+        if types == _BOOL:
+            return u"bool", self.bool_savings - len(u"bool")
+        if types == _INT:
+            return u"int36", self.int36_savings - len(u"int36")
+        if types == _DATE:
+            # datetime values can't be serialized without a codec
+            if self.date_int36_savings > len(u"|int36"):
+                return (u"date|int36", self.date_savings +
+                        self.date_int36_savings - len(u"date|int36"))
+            return u"date", self.date_savings - len(u"date")
+        if types == _STR:
+            enum = self._enum_codec()
+            affix = self._affix_codec()
+            return enum if enum[1] >= affix[1] else affix
+        return None, 0
+
+
+def _pick_codec(stats):
+    if stats is None:
+        return None, 0
+    meta_id, savings = stats.codec()
+    if meta_id is None or (savings <= 0 and meta_id[:4] != u"date"):
+        return None, 0
+    return meta_id, savings
+
+
+def _check_sample(sample):
+    if sample is not None and sample < 1:
+        raise ValueError("sample must be at least 1, got %r" % (sample,))
+
+
+def _sampled(values, sample):
+    if sample is None or len(values) <= sample:
+        return values
+    # spread the samples over the whole array
+    step = len(values) // sample
+    return values[:step * sample:step]
+
+
+def _infer_object(node, obj, sample):
+    fields = node.fields
+    for field, val in obj.items():
+        info = fields.get(field)
+        if info is None:
+            info = fields[field] = [0, None, None]
+        if val is None:
+            continue
+
+        if isinstance(val, Mapping):
+            info[0] |= _OBJECT
+            if info[1] is None:
+                info[1] = _Node()
+            _infer_object(info[1], val, sample)
+        elif isinstance(val, list):
+            if not val:
+                info[0] |= _EMPTY_ARRAY
+                continue
+            info[0] |= _infer_array(info, val, sample)
+        else:
+            info[0] |= _PLAIN
+            if info[2] is None:
+                info[2] = _ValueStats(sample is None)
+            info[2].add(val)
+
+
+def _infer_array(info, values, sample):
+    values = _sampled(values, sample)
+    if not all(isinstance(v, Mapping) for v in values):
+        if info[2] is None:
+            info[2] = _ValueStats(sample is None)
+        add = info[2].add
+        for val in values:
+            if val is not None:
+                add(val)
+        return _PLAIN_ARRAY
+
+    if info[1] is None:
+        info[1] = _Node()
+    for obj in values:
+        _infer_object(info[1], obj, sample)
+    return _OBJECT_ARRAY
+
+
+def _signature(node, signatures, codecs):
+    """returns a hashable signature of the fields and meta of node"""
+    sig = signatures.get(id(node))
+    if sig is None:
+        sig = signatures[id(node)] = tuple(
+            (field, kind, codec[0],
+             None if child is None else _signature(child, signatures, codecs))
+            for field, kind, child, codec in _resolved_fields(node, codecs)
+        )
+    return sig
+
+
+def _resolved_fields(node, codecs):
+    """yields field, kind, child node, codec for each field of node
+
+    kind is _OBJECT, _OBJECT_ARRAY, _PLAIN_ARRAY or 0 for plain values.
+    Fields with conflicting kinds of values are treated as plain values.
+    codec is a (meta_id, savings) tuple for plain values and arrays of
+    plain values.
+    """
+    no_codec = (None, 0)
+    for field in sorted(node.fields):
+        kinds, child, stats = node.fields[field]
+        if child is not None and not child.fields:
+            # only empty objects, which are kept as plain values
+            if kinds & _OBJECT:
+                kinds |= _PLAIN
+            if kinds & _OBJECT_ARRAY:
+                kinds |= _PLAIN_ARRAY
+            kinds &= ~(_OBJECT | _OBJECT_ARRAY)
+            child = None
+
+        if kinds == _OBJECT and child is not None:
+            yield field, _OBJECT, child, no_codec
+        elif kinds & ~_EMPTY_ARRAY == _OBJECT_ARRAY:
+            yield field, _OBJECT_ARRAY, child, no_codec
+        elif kinds and kinds & ~_ARRAY_KINDS == 0:
+            codec = no_codec
+            if codecs and kinds & ~_EMPTY_ARRAY == _PLAIN_ARRAY:
+                codec = _pick_codec(stats)
+            yield field, _PLAIN_ARRAY, None, codec
+        elif codecs and kinds == _PLAIN:
+            yield field, 0, None, _pick_codec(stats)
+        else:
+            yield field, 0, None, no_codec
+
+
+def _build_schemas(node, schema_id, ctx, lvl):
+    id_prefix, codecs, signatures, ids, taken, schemas, savings = ctx
+    sig = _signature(node, signatures, codecs)
+    if sig in ids:
+        return ids[sig]
+
+    # fields with the same name of different parents may have different
+    # schemas
+    base_id = schema_id
+    n = 1
+    while schema_id in taken:
+        n += 1
+        schema_id = "%s-%d" % (base_id, n)
+    ids[sig] = schema_id
+    taken.add(schema_id)
+
+    fields = []
+    meta = []
+    idx = 0
+    for field, kind, child, codec in _resolved_fields(node, codecs):
+        fields.append(field)
+        codec_id, codec_savings = codec
+        if codec_id:
+            savings.append((schema_id, field, codec_id, codec_savings))
+
+        if kind == _PLAIN_ARRAY:
+            meta.append("[]" + (codec_id or ""))
+        elif kind:
+            child_id = "%s-%d-%d-%s" % (id_prefix, lvl + 1, idx, field)
+            idx += 1
+            child_id = _build_schemas(child, child_id, ctx, lvl + 1)
+            meta.append("[]" + child_id if kind == _OBJECT_ARRAY
+                        else child_id)
+        else:
+            meta.append(codec_id or 0)
+
+    # nested schemas are appended first, so that a schema only refers
+    # to schemas which precede it.
+    schemas.append({'id': schema_id, 'fields': fields, 'meta': meta})
+    return schema_id
+
+
+def _collect_stats(data, schema_id, sample, schemas, stats):
+    is_array = schema_id[0] == u"["
+    schema_id = _plain_id(schema_id)
+    schema = schemas[schema_id]
+    fields = list(zip(schema['fields'], schema['meta']))
+
+    for obj in (_sampled(data, sample) if is_array else (data,)):
+        if not isinstance(obj, Mapping):
+            continue
+        for field, meta_id in fields:
+            val = obj.get(field)
+            if val is None:
+                continue
+            if meta_id and _plain_id(meta_id) in schemas:
+                _collect_stats(val, meta_id, sample, schemas, stats)
+                continue
+            if meta_id not in (0, u"[]"):
+                # fields with codecs are left alone
+                continue
+
+            key = (schema_id, field)
+            if key not in stats:
+                stats[key] = _ValueStats(sample is None)
+            add = stats[key].add
+            if meta_id:
+                for v in _sampled(val, sample):
+                    if v is not None:
+                        add(v)
+            else:
+                add(val)
+
+
+def detect_codecs(data, schema_id, sample=None, registry=None):
+    """find codecs for the plain fields of a schema and its sub schemas
+
+    Returns a list of (schema_id, field, meta_id, savings) tuples, where
+    savings is the estimated number of bytes saved for data, sorted by
+    savings. The schemas are not modified.
+    """
+    _check_sample(sample)
+    if isinstance(data, _str_types):
+        data = json_loads(data)
+
+    schemas = (registry or DEFAULT_REGISTRY).schemas
+    stats = {}
+    _collect_stats(data, schema_id, sample, schemas, stats)
+
+    result = []
+    for (sid, field), field_stats in stats.items():
+        meta_id, savings = _pick_codec(field_stats)
+        if meta_id:
+            schema = schemas[sid]
+            is_array = schema['meta'][schema['fields'].index(field)] == u"[]"
+            result.append((sid, field, u"[]" + meta_id if is_array
+                           else meta_id, savings))
+
+    result.sort(key=lambda item: -item[3])
+    return result
+
+
+def detect_schemas(data, id_prefix=None, sample=None, codecs=True,
+                   savings=None, registry=None):
+    """infer the schemas of data and add them
+
+    data may be a dict or list (or a json string of either), any other
+    iterable is consumed as a stream of records. With sample=N only N
+    elements of each array (the first N records of a stream) are
+    inspected. Returns the top level schema id ("[]id" for arrays) and
+    the list of schemas, nested schemas preceding their parents. The
+    schemas are only added once the whole input has been processed.
+
+    Unless codecs is False, codecs are detected for plain fields. If a
+    list is passed as savings, (schema_id, field, meta_id, savings)
+    tuples of the detected codecs are appended to it.
+    """
+    _check_sample(sample)
+    if id_prefix is None:
+        id_prefix = "auto-schema-" + urlsafe_b64encode(os.urandom(6)).decode()
+
+    if isinstance(data, _str_types):
+        data = json_loads(data)
+
+    root = _Node()
+    if isinstance(data, Mapping):
+        is_array = False
+        _infer_object(root, data, sample)
+    elif isinstance(data, list):
+        is_array = True
+        for obj in _sampled(data, sample):
+            if isinstance(obj, Mapping):
+                _infer_object(root, obj, sample)
+    elif hasattr(data, '__iter__'):
+        is_array = True
+        records = iter(data)
+        if sample is not None:
+            records = islice(records, sample)
+        for obj in records:
+            if isinstance(obj, Mapping):
+                _infer_object(root, obj, sample)
+    else:
+        raise ValueError("Top level must be a dict or list")
+
+    if not root.fields:
+        raise ValueError("No objects found to detect schemas from")
+
+    schemas = []
+    if savings is None:
+        savings = []
+    ctx = (id_prefix, codecs, {}, {}, set(), schemas, savings)
+    schema_id = _build_schemas(root, id_prefix + "-0-0", ctx, 0)
+    registry = registry or DEFAULT_REGISTRY
+    for schema in schemas:
+        registry.add_schema(schema)
+
+    return ("[]" + schema_id if is_array else schema_id), schemas
@@ -0,0 +1,144 @@
+# coding: utf-8
+"""Random access to the records of large "[]schema" documents.
+
+KSONWriter (and dump_iter) can record the byte offset of every n-th
+record of a document. The index is stored in a sidecar json file
+
+    {
+        "schema_id": "schema_id",
+        "n_records": 10000,
+        "block_size": 1000,
+        "offsets": [16, 52311, ...],
+        "end": 523090
+    }
+
+where each offset points to the ',' which precedes the first value of a
+block and end points to the closing ']' of the document. KSONFile uses
+the index to only read and decode the blocks of the requested records.
+"""
+import mmap
+
+from kson import DEFAULT_REGISTRY, json_dumps_bytes, json_loads, _map_file
+
+INDEX_SUFFIX = ".idx"
+
+
+def index_path(filename):
+    if isinstance(filename, bytes):
+        return filename + INDEX_SUFFIX.encode('ascii')
+    return filename + INDEX_SUFFIX
+
+
+def write_index(index, fp_or_filename):
+    if isinstance(fp_or_filename, (str, bytes)):
+        with open(fp_or_filename, 'wb') as fp:
+            return write_index(index, fp)
+    fp_or_filename.write(json_dumps_bytes(index))
+
+
+def read_index(fp_or_filename):
+    if isinstance(fp_or_filename, (str, bytes)):
+        with open(fp_or_filename, 'rb') as fp:
+            return read_index(fp)
+    return json_loads(fp_or_filename.read())
+
+
+class KSONFile(object):
+    """Indexed "[]schema" document with random access to its records.
+
+    Supports len(), indexing, slicing and iteration. Only the blocks which
+    contain the requested records are read from the (memory mapped) file
+    and decoded. The most recently decoded block is kept, so records
+    which are read repeatedly may be the same objects.
+
+    The index is read from the sidecar file of the document, unless an
+    index (or the path of one) is given. With fields=[...], records are
+    decoded as with loads(..., fields=[...]).
+    """
+
+    def __init__(self, filename, index=None, fields=None, registry=None):
+        if index is None:
+            index = index_path(filename)
+        if not isinstance(index, dict):
+            index = read_index(index)
+
+        registry = registry or DEFAULT_REGISTRY
+        schema_id = index['schema_id']
+        if fields is None:
+            self._plan = registry.get_plan(schema_id)
+        else:
+            self._plan = registry.get_projection(schema_id, fields)
+        if self._plan.stateful:
+            raise ValueError("Schema %s can only be decoded in order" % (
+                schema_id,
+            ))
+
+        self.filename = filename
+        self.index = index
+        self.schema_id = schema_id
+        self.block_size = index['block_size']
+        self._offsets = index['offsets']
+        self._n_records = index['n_records']
+        self._block = (None, None)
+        with open(filename, 'rb') as f:
+            self._buf = _map_file(f)
+
+    def __len__(self):
+        return self._n_records
+
+    def _read_block(self, block):
+        cached_block, records = self._block
+        if cached_block == block:
+            return records
+
+        offsets = self._offsets
+        start = offsets[block]
+        if block + 1 < len(offsets):
+            end = offsets[block + 1]
+        else:
+            end = self.index['end']
+
+        # the block starts with the ',' which precedes its first value
+        values = json_loads(b"[" + self._buf[start + 1:end] + b"]")
+        records = []
+        self._plan.load_rows(self._plan, values, 0, records)
+        self._block = (block, records)
+        return records
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self.iter_range(*i.indices(self._n_records)))
+
+        if i < 0:
+            i += self._n_records
+        if not 0 <= i < self._n_records:
+            raise IndexError("KSONFile index out of range")
+
+        block, offset = divmod(i, self.block_size)
+        return self._read_block(block)[offset]
+
+    def iter_range(self, start=0, stop=None, step=1):
+        """yields the records of range(start, stop, step)
+
+        Each block is only read once.
+        """
+        if stop is None:
+            stop = self._n_records
+        for i in range(start, stop, step):
+            block, offset = divmod(i, self.block_size)
+            yield self._read_block(block)[offset]
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def close(self):
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        self._buf = b""
+        self._block = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
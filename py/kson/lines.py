@@ -0,0 +1,139 @@
+# coding: utf-8
+"""Newline delimited KSON (KSONL).
+
+The first line of a KSONL document declares the schema of the records,
+each following line contains the values of one record.
+
+    ["[]schema_id"]
+    [value_1,value_2,...]
+    [value_1,value_2,...]
+
+The header may embed the definitions of the schema and its nested
+schemas as a "[]schema" document, so that it can be decoded without
+loading them separately.
+
+    ["[]schema_id",["[]schema","schema_id",[...],[...],...]]
+
+Since records don't share an envelope, records can be appended to an
+existing document and documents can be split at any line.
+"""
+import io
+
+from kson import (
+    DEFAULT_REGISTRY, json_dumps, json_loads, dumps, loads, _schema_deps,
+    _in_document,
+)
+from kson.compression import open_compressed
+
+
+def _plan(schema_id, registry):
+    schema_id = schema_id[2:] if schema_id[0] == u"[" else schema_id
+    return schema_id, registry.get_plan(schema_id)
+
+
+def header_line(schema_id, embed_schemas=False, registry=None):
+    registry = registry or DEFAULT_REGISTRY
+    schema_id, plan = _plan(schema_id, registry)
+    header = ["[]" + schema_id]
+    if embed_schemas:
+        deps = []
+        _schema_deps(registry.schemas, schema_id, deps)
+        schemas = [registry.schemas[dep_id] for dep_id in deps]
+        header.append(json_loads(dumps(schemas, "[]schema",
+                                       registry=registry)))
+    return json_dumps(header) + u"\n"
+
+
+def encode_line(record, plan):
+    """returns the line of a record, including the newline
+
+    Each line is a separate document for the intern codec.
+    """
+    vals = []
+    _in_document(plan.registry, plan.dump_rows, plan, (record,), vals)
+    return json_dumps(vals) + u"\n"
+
+
+def decode_line(line, plan):
+    result = []
+    _in_document(plan.registry, plan.load_rows, plan, json_loads(line), 0,
+                 result)
+    return result[0] if result else None
+
+
+def _is_empty(fp):
+    try:
+        return fp.tell() == 0
+    except (AttributeError, IOError, ValueError):
+        return True
+
+
+def dump_lines(records, fp_or_filename, schema_id, embed_schemas=False,
+               append=False, registry=None):
+    """write records as a KSONL document
+
+    With append=True, records are appended to the file and the header is
+    only written if the file is empty. For file objects, the header is
+    written unless append is True and the file position isn't zero.
+    """
+    if isinstance(fp_or_filename, (str, bytes)):
+        with io.open(fp_or_filename, 'a' if append else 'w',
+                     encoding='utf-8') as fp:
+            return dump_lines(records, fp, schema_id, embed_schemas, append,
+                              registry)
+
+    registry = registry or DEFAULT_REGISTRY
+    fp = fp_or_filename
+    schema_id, plan = _plan(schema_id, registry)
+    if not append or _is_empty(fp):
+        fp.write(header_line(schema_id, embed_schemas, registry))
+
+    write = fp.write
+    for record in records:
+        write(encode_line(record, plan))
+
+    if hasattr(fp, 'flush'):
+        fp.flush()
+
+
+def read_header(line, registry=None):
+    """returns the schema id and registry of a header line
+
+    If the header embeds schemas, they are added to a copy of the
+    registry, which is returned.
+    """
+    registry = registry or DEFAULT_REGISTRY
+    header = json_loads(line)
+    if not (isinstance(header, list) and header and header[0][:2] == "[]"):
+        raise ValueError("Invalid KSONL header")
+
+    if len(header) > 1:
+        registry = registry.snapshot(read_only=False)
+        for schema in loads(header[1], registry=registry):
+            registry.add_schema(schema)
+    return header[0], registry
+
+
+def iter_lines(fp_or_filename, schema_id=None, registry=None):
+    """generator which yields the records of a KSONL document
+
+    If schema_id is given, it is used instead of the schema declared by
+    the header.
+    """
+    if isinstance(fp_or_filename, (str, bytes)):
+        # compressed documents are detected by open_compressed
+        with io.TextIOWrapper(open_compressed(fp_or_filename),
+                              encoding='utf-8') as fp:
+            for record in iter_lines(fp, schema_id, registry):
+                yield record
+        return
+
+    plan = None
+    for line in fp_or_filename:
+        if not line.strip():
+            continue
+        if plan is None:
+            header_id, registry = read_header(line, registry)
+            _, plan = _plan(schema_id or header_id, registry)
+            continue
+        yield decode_line(line, plan)
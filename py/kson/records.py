@@ -0,0 +1,266 @@
+# coding: utf-8
+"""Record objects which decode their fields on first access."""
+import re
+import keyword
+from operator import attrgetter
+from collections import namedtuple
+
+from kson import DEFAULT_REGISTRY, Mapping, Sequence
+
+_MISSING = object()
+
+
+class LazyRecord(Mapping):
+    """Read only mapping over the values of a record in a flat sequence.
+
+    Values are only decoded (and for binary documents only materialized)
+    when a field is first accessed. Decoded values are cached.
+    """
+
+    __slots__ = ('_values', '_offset', '_plan', '_cache')
+
+    def __init__(self, values, offset, plan):
+        self._values = values
+        self._offset = offset
+        self._plan = plan
+        self._cache = None
+
+    def __getitem__(self, field):
+        plan = self._plan
+        i = plan.field_index[field]
+
+        cache = self._cache
+        if cache is None:
+            cache = self._cache = [_MISSING] * plan.n_fields
+        else:
+            val = cache[i]
+            if val is not _MISSING:
+                return val
+
+        values = self._values
+        offset = self._offset + i
+        val = values[offset] if offset < len(values) else None
+        if val is not None:
+            decoder = plan.field_decoders.get(field)
+            if decoder is not None:
+                val = decoder(val)
+
+        cache[i] = val
+        return val
+
+    def __iter__(self):
+        return iter(self._plan.fields)
+
+    def __len__(self):
+        return self._plan.n_fields
+
+    def __repr__(self):
+        return "%s(%r)" % (self._plan.schema_id, dict(self))
+
+
+class RecordArray(Sequence):
+    """Sequence of LazyRecord objects over a flat list of values.
+
+    Records are only created when they are accessed, so iterating over
+    a single field with column doesn't allocate a record per row.
+    """
+
+    __slots__ = ('_values', '_start', '_plan', '_records')
+
+    def __init__(self, values, plan, start=0):
+        self._values = values
+        self._start = start
+        self._plan = plan
+        self._records = None
+
+    def __len__(self):
+        n_fields = self._plan.n_fields
+        if n_fields == 0:
+            return 0
+        return (len(self._values) - self._start + n_fields - 1) // n_fields
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        n_records = len(self)
+        if i < 0:
+            i += n_records
+        if not 0 <= i < n_records:
+            raise IndexError("RecordArray index out of range")
+
+        records = self._records
+        if records is None:
+            records = self._records = [None] * n_records
+
+        record = records[i]
+        if record is None:
+            offset = self._start + i * self._plan.n_fields
+            record = records[i] = LazyRecord(self._values, offset, self._plan)
+        return record
+
+    def column(self, field):
+        """returns the decoded values of a field for all records"""
+        plan = self._plan
+        values = self._values
+        n_values = len(values)
+        offset = self._start + plan.field_index[field]
+        decoder = plan.field_decoders.get(field)
+
+        column = []
+        for i in range(offset, offset + len(self) * plan.n_fields,
+                       plan.n_fields):
+            val = values[i] if i < n_values else None
+            if val is not None and decoder is not None:
+                val = decoder(val)
+            column.append(val)
+        return column
+
+    def __repr__(self):
+        return "RecordArray(%s, %d)" % (self._plan.schema_id, len(self))
+
+
+def lazy_records(values, plan, is_array, start=0):
+    """returns a RecordArray, or a LazyRecord for object schemas"""
+    if is_array:
+        return RecordArray(values, plan, start)
+    n_fields = plan.n_fields
+    if len(values) <= start or n_fields == 0:
+        return None
+    # for consistency with loads, the last record is returned
+    offset = start + (len(values) - start - 1) // n_fields * n_fields
+    return LazyRecord(values, offset, plan)
+
+
+## record classes
+
+
+_SLOTS_TEMPLATE = """
+class {name}(object):
+    __slots__ = {fields!r}
+    _kson_schema = {schema_id!r}
+
+    def __init__(self, {params}):
+{assignments}
+
+    def _asdict(self):
+        return dict(zip(self.__slots__, values(self)))
+
+    def __iter__(self):
+        return iter(values(self))
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return values(self) == values(other)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % item for item in zip(self.__slots__, values(self))
+        ))
+"""
+
+
+def _class_name(schema_id):
+    name = "".join(p.capitalize() for p in re.split(r"\W|_", schema_id))
+    if not name or not re.match(r"[A-Za-z_]", name):
+        name = "Record" + name
+    return name
+
+
+def _slots_class(schema_id, fields):
+    for field in fields:
+        if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", field):
+            raise ValueError(
+                "Field '%s' of schema '%s' is not a valid attribute name"
+                % (field, schema_id)
+            )
+
+    # keywords (e.g. a field named "from") can't be used as parameter
+    # names or in assignments.
+    params = []
+    assignments = []
+    for field in fields:
+        if keyword.iskeyword(field):
+            params.append(field + "_=None")
+            assignments.append(
+                "        setattr(self, %r, %s_)" % (field, field)
+            )
+        else:
+            params.append(field + "=None")
+            assignments.append("        self.%s = %s" % (field, field))
+
+    name = _class_name(schema_id)
+    src = _SLOTS_TEMPLATE.format(
+        name=name,
+        fields=tuple(fields),
+        schema_id=schema_id,
+        params=", ".join(params),
+        assignments="\n".join(assignments) or "        pass",
+    )
+    ns = {}
+    exec(compile(src, "<kson record %s>" % schema_id, "exec"), ns)
+    cls = ns[name]
+    if len(fields) == 1:
+        getter = attrgetter(fields[0])
+        ns['values'] = lambda obj: (getter(obj),)
+    elif fields:
+        ns['values'] = attrgetter(*fields)
+    else:
+        ns['values'] = lambda obj: ()
+    return cls
+
+
+def record_class(schema_id, kind="slots", registry=None):
+    """returns the record class of a schema
+
+    kind is either "slots", for a class with __slots__ for each field
+    of the schema, or "namedtuple". Classes are cached until the fields
+    of the schema change.
+    """
+    registry = registry or DEFAULT_REGISTRY
+    classes = registry.record_classes.setdefault(schema_id, {})
+    cls = classes.get(kind)
+    if cls is not None:
+        return cls
+
+    fields = list(registry.schemas[schema_id]['fields'])
+    if kind == "slots":
+        cls = _slots_class(schema_id, fields)
+    elif kind == "namedtuple":
+        cls = namedtuple(_class_name(schema_id), fields)
+        cls.__new__.__defaults__ = (None,) * len(fields)
+        cls._kson_schema = schema_id
+    else:
+        raise ValueError("Invalid record type: " + str(kind))
+
+    classes[kind] = cls
+    return cls
+
+
+def record_rows_loader(cls):
+    """returns a plan.load_rows function which creates cls instances"""
+
+    def load_rows(plan, data, start, result):
+        n_fields = plan.n_fields
+        field_index = plan.field_index
+        decoders = [(field_index[f], coder) for f, coder in plan.decoders]
+        append = result.append
+
+        for i in range(start, len(data), n_fields):
+            row = data[i:i + n_fields]
+            n_vals = len(row)
+            for j, coder in decoders:
+                if j < n_vals:
+                    val = row[j]
+                    if val is not None:
+                        row[j] = coder(val)
+            append(cls(*row))
+
+    return load_rows
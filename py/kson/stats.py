@@ -0,0 +1,309 @@
+# coding: utf-8
+"""Statistics about where dumps and loads spend their time.
+
+While stats are enabled, the following is collected
+
+    schemas     dumps/loads calls of documents by schema id, their time,
+                bytes in/out and the size of the plain json of dumped
+                data, from which the ratio of the keyless encoding is
+                computed. Values of nested schemas are counted as
+                encode/decode calls.
+    codecs      encode/decode calls of codec chains by meta id and their
+                (cumulative) time. Calls of *_many and column coders code
+                a whole list.
+    json        calls of the json backend, their time and bytes.
+
+    >>> with kson.collect_stats() as stats:
+    ...     kson.loads(kson.dumps(data, "[]schema_id"))
+    >>> stats.as_dict()['schemas']['schema_id']['ratio']
+
+Enabling and disabling stats recompiles the plans of all registries,
+coders are only wrapped while stats are enabled, so that there is no
+overhead otherwise. Schemas added with codegen use the plain plans
+while stats are enabled. Documents of dumpb/loadb and kson.stream are
+only counted by their codecs.
+"""
+import time
+from contextlib import contextmanager
+
+import kson
+from kson import STRING_TYPES, COLUMNAR_PREFIX, default_json_dumps, _plain_id
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+SCHEMA_COUNTERS = (
+    'dumps', 'dumps_time', 'dumps_bytes', 'loads', 'loads_time',
+    'loads_bytes', 'encode', 'encode_time', 'decode', 'decode_time',
+    # kson and plain json bytes of the documents whose size was compared
+    'ratio_bytes', 'json_bytes',
+)
+CODEC_COUNTERS = ('encode', 'encode_time', 'decode', 'decode_time')
+JSON_COUNTERS = (
+    'dumps', 'dumps_time', 'dumps_bytes', 'loads', 'loads_time',
+    'loads_bytes',
+)
+
+
+def _new_counters(names):
+    return dict((name, 0) for name in names)
+
+
+def _n_bytes(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    return len(data.encode('utf-8'))
+
+
+def _plain_default(obj):
+    if hasattr(obj, '_asdict'):
+        return obj._asdict()
+    if hasattr(obj, 'items'):
+        return dict(obj.items())
+    return str(obj)
+
+
+def _doc_schema_id(schema_id):
+    if schema_id[:2] in ("[]", COLUMNAR_PREFIX):
+        return schema_id[2:]
+    return schema_id
+
+
+class Stats(object):
+    """Collects the statistics, see the module docstring.
+
+    With measure_ratio=True, data passed to dumps (dicts, lists and
+    tuples) is also serialized as plain json to compare its size, which
+    isn't included in the timings.
+    """
+
+    def __init__(self, measure_ratio=True):
+        self.measure_ratio = measure_ratio
+        self.reset()
+
+    def reset(self):
+        self.schemas = {}
+        self.codecs = {}
+        self.json = _new_counters(JSON_COUNTERS)
+
+    def _schema(self, schema_id):
+        counters = self.schemas.get(schema_id)
+        if counters is None:
+            counters = self.schemas[schema_id] = _new_counters(
+                SCHEMA_COUNTERS
+            )
+        return counters
+
+    def _codec(self, meta_id):
+        counters = self.codecs.get(meta_id)
+        if counters is None:
+            counters = self.codecs[meta_id] = _new_counters(CODEC_COUNTERS)
+        return counters
+
+    ## instrumentation
+
+    def _counting(self, counters, name, coder):
+        if coder is None:
+            return None
+        name_time = name + '_time'
+
+        def counting_coder(val):
+            start = _timer()
+            result = coder(val)
+            counters[name_time] += _timer() - start
+            counters[name] += 1
+            return result
+
+        return counting_coder
+
+    def wrap_coders(self, registry, meta_id, enc, dec, col_enc, col_dec):
+        """returns the coders of a field, which count their calls"""
+        p_meta_id = _plain_id(meta_id)
+        if p_meta_id in registry.schemas:
+            counters = self._schema(p_meta_id)
+        else:
+            counters = self._codec(p_meta_id)
+        return (
+            self._counting(counters, 'encode', enc),
+            self._counting(counters, 'decode', dec),
+            self._counting(counters, 'encode', col_enc),
+            self._counting(counters, 'decode', col_dec),
+        )
+
+    def wrap_backend(self, backend):
+        """returns a json backend tuple whose functions are counted"""
+        counters = self.json
+        name, dumps, dumps_bytes, loads = backend
+
+        def counting_dumps(dumps):
+            def counting_dumps(obj):
+                start = _timer()
+                result = dumps(obj)
+                counters['dumps_time'] += _timer() - start
+                counters['dumps'] += 1
+                counters['dumps_bytes'] += len(result)
+                return result
+            return counting_dumps
+
+        def counting_loads(data):
+            start = _timer()
+            result = loads(data)
+            counters['loads_time'] += _timer() - start
+            counters['loads'] += 1
+            counters['loads_bytes'] += len(data)
+            return result
+
+        return (name, counting_dumps(dumps), counting_dumps(dumps_bytes),
+                counting_loads)
+
+    def dumps(self, dumps, data, schema_id, layout, as_bytes, registry, args,
+              kwargs):
+        start = _timer()
+        doc = dumps(data, schema_id, False, layout, as_bytes, registry, args,
+                    kwargs)
+        elapsed = _timer() - start
+
+        counters = self._schema(_doc_schema_id(schema_id))
+        counters['dumps'] += 1
+        counters['dumps_time'] += elapsed
+        n_bytes = _n_bytes(doc)
+        counters['dumps_bytes'] += n_bytes
+
+        # iterators have been consumed by dumps
+        if self.measure_ratio and isinstance(data, (dict, list, tuple)):
+            try:
+                plain = default_json_dumps(data, default=_plain_default)
+            except (TypeError, ValueError):
+                return doc
+            counters['ratio_bytes'] += n_bytes
+            counters['json_bytes'] += _n_bytes(plain)
+        return doc
+
+    def loads(self, loads, data, schema_id, kwargs):
+        n_bytes = 0
+        start = _timer()
+        if isinstance(data, (bytes, bytearray, memoryview) + STRING_TYPES):
+            n_bytes = _n_bytes(data)
+            data = kson.json_loads(data)
+        result = loads(data, schema_id, False, **kwargs)
+        elapsed = _timer() - start
+
+        doc_id = schema_id
+        if not doc_id and isinstance(data, list) and data:
+            doc_id = data[0]
+        if not isinstance(doc_id, STRING_TYPES):
+            # plain json
+            return result
+
+        counters = self._schema(_doc_schema_id(doc_id))
+        counters['loads'] += 1
+        counters['loads_time'] += elapsed
+        counters['loads_bytes'] += n_bytes
+        return result
+
+    ## results
+
+    def as_dict(self):
+        """returns a copy of the counters
+
+        The schema counters include the ratio of the size of the dumped
+        documents to their plain json size (None if it wasn't measured).
+        """
+        schemas = {}
+        for schema_id, counters in self.schemas.items():
+            counters = dict(counters)
+            json_bytes = counters['json_bytes']
+            counters['ratio'] = (
+                counters['ratio_bytes'] / float(json_bytes)
+                if json_bytes else None
+            )
+            schemas[schema_id] = counters
+        return {
+            'schemas': schemas,
+            'codecs': dict((k, dict(v)) for k, v in self.codecs.items()),
+            'json': dict(self.json),
+        }
+
+
+def enable_stats(measure_ratio=True):
+    """start collecting stats, returns the new Stats object"""
+    stats = Stats(measure_ratio)
+    kson._set_stats(stats)
+    return stats
+
+
+def disable_stats():
+    """stop collecting stats, returns the Stats object which was active"""
+    stats = kson._stats
+    if stats is not None:
+        kson._set_stats(None)
+    return stats
+
+
+def get_stats():
+    """returns the counters of the active Stats, or None"""
+    stats = kson._stats
+    return None if stats is None else stats.as_dict()
+
+
+@contextmanager
+def collect_stats(measure_ratio=True):
+    """context manager which collects stats of the enclosed block
+
+    The previously active Stats (if any) are restored afterwards.
+    """
+    prev_stats = kson._stats
+    stats = Stats(measure_ratio)
+    kson._set_stats(stats)
+    try:
+        yield stats
+    finally:
+        kson._set_stats(prev_stats)
+
+
+## report
+
+
+def _ms(seconds):
+    return "%.2f" % (seconds * 1000)
+
+
+def format_stats(stats):
+    """returns a text report of the dict returned by Stats.as_dict"""
+    lines = []
+    schemas = stats['schemas']
+    if schemas:
+        lines.append("%-24s %8s %10s %8s %10s %8s %10s %10s %6s" % (
+            "schema", "dumps", "dumps ms", "loads", "loads ms",
+            "nested", "nested ms", "bytes", "ratio",
+        ))
+        for schema_id in sorted(schemas):
+            c = schemas[schema_id]
+            ratio = "-" if c['ratio'] is None else "%.2f" % c['ratio']
+            lines.append("%-24s %8d %10s %8d %10s %8d %10s %10d %6s" % (
+                schema_id, c['dumps'], _ms(c['dumps_time']), c['loads'],
+                _ms(c['loads_time']), c['encode'] + c['decode'],
+                _ms(c['encode_time'] + c['decode_time']),
+                c['dumps_bytes'] + c['loads_bytes'], ratio,
+            ))
+        lines.append("")
+
+    codecs = stats['codecs']
+    if codecs:
+        # codec chains can be long, so they are the last column
+        lines.append("%8s %10s %8s %10s  %s" % (
+            "encode", "encode ms", "decode", "decode ms", "codec",
+        ))
+        for meta_id in sorted(codecs):
+            c = codecs[meta_id]
+            lines.append("%8d %10s %8d %10s  %s" % (
+                c['encode'], _ms(c['encode_time']), c['decode'],
+                _ms(c['decode_time']), meta_id,
+            ))
+        lines.append("")
+
+    c = stats['json']
+    lines.append("json (%s): %d dumps %s ms %d bytes, %d loads %s ms %d bytes"
+                 % (kson.get_backend(), c['dumps'], _ms(c['dumps_time']),
+                    c['dumps_bytes'], c['loads'], _ms(c['loads_time']),
+                    c['loads_bytes']))
+    return "\n".join(lines)
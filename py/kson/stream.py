@@ -0,0 +1,423 @@
+# coding: utf-8
+"""Incremental (de)serialization of KSON documents.
+
+The functions in this module don't require the whole document to be
+in memory. Records of a top level "[]schema" array are decoded as soon
+as all of their values have been read.
+"""
+import io
+import json
+import codecs
+
+from kson import (
+    PY2, DEFAULT_REGISTRY, COLUMNAR_PREFIX, json_dumps, json_dumps_bytes,
+    _load_columns, _enter_document, _exit_document,
+    _columns_to_rows,
+)
+from kson.compression import (
+    MAGIC_SIZE, CompressedWriter, compression_for_filename,
+    _format as _compression_format, _detect_start,
+)
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = u" \t\n\r"
+_DELIMITERS = _WHITESPACE + u",]"
+
+_START, _HEADER, _VALUES, _DONE = range(4)
+
+# returned by _decode_value if the buffer doesn't contain a complete value
+_INCOMPLETE = object()
+
+# errors this close to the end of the buffer may be caused by a literal or
+# an escape sequence ("-Infinity", "\ud83d\ude00") which continues in the
+# next chunk
+_MAX_TOKEN = 12
+
+
+class StreamDecoder(object):
+    """Push parser for KSON documents.
+
+    Chunks of the document are passed to feed, which returns the
+    records which could be completely decoded so far. With plain=True
+    the document is parsed as a plain json array, whose elements are
+    returned as they are.
+
+    Compressed documents (see kson.compression) are detected by the
+    first bytes which are fed and decompressed as they arrive.
+    """
+
+    def __init__(self, schema_id=None, plain=False, registry=None,
+                 dictionary=None):
+        self.schema_id = schema_id
+        self.plain = plain
+        self.registry = registry or DEFAULT_REGISTRY
+        self.dictionary = dictionary
+        self.compression = None
+        # leading bytes which are kept until the compression is detected
+        self._head = b""
+        self._decompressor = None
+        self._buf = u""
+        self._state = _START
+        self._plan = None
+        self._row = []
+        self._columnar = False
+        self._text_decoder = None
+        self._json_decoder = json.JSONDecoder()
+        # string tables of the intern codec
+        self._tables = {}
+
+    def _decode_value(self, buf, pos, eof):
+        try:
+            val, end = self._json_decoder.raw_decode(buf, pos)
+        except ValueError as err:
+            if eof:
+                raise
+            # syntax errors inside of the buffer are raised right away,
+            # so that invalid documents aren't buffered until close
+            err_pos = getattr(err, 'pos', None)
+            if (err_pos is not None and len(buf) - err_pos > _MAX_TOKEN and
+                    not err.args[0].startswith("Unterminated string")):
+                raise
+            return _INCOMPLETE, pos
+        if not eof and (end == len(buf) or buf[end] not in _DELIMITERS):
+            # a number at the end of the buffer may continue in the
+            # next chunk.
+            return _INCOMPLETE, pos
+        return val, end
+
+    def _init_header(self, header):
+        if self.plain:
+            return [header]
+        schema_id = self.schema_id
+        if not schema_id:
+            if not (PY2 and isinstance(header, unicode) or
+                    isinstance(header, str)):
+                # plain json array, elements are passed through
+                return [header]
+            schema_id = header
+
+        if schema_id[:2] == COLUMNAR_PREFIX:
+            # records can only be decoded once all columns have been read
+            self._columnar = True
+            self._plan = self.registry.get_plan(schema_id[2:])
+            return []
+
+        is_array = schema_id[0] == u"["
+        self._plan = self.registry.get_plan(
+            schema_id[2:] if is_array else schema_id
+        )
+        return []
+
+    def _add_value(self, val):
+        plan = self._plan
+        if plan is None:
+            return [val]
+
+        row = self._row
+        row.append(val)
+        if self._columnar or len(row) < plan.n_fields:
+            return []
+        return self._flush_row()
+
+    def _flush_row(self):
+        row = self._row
+        if self._plan is None or not row:
+            return []
+        self._row = []
+        if not self._plan.stateful:
+            return self._load_row(row)
+        prev_tables = _enter_document(self._tables)
+        try:
+            return self._load_row(row)
+        finally:
+            _exit_document(prev_tables)
+
+    def _load_row(self, row):
+        if self._columnar:
+            return _columns_to_rows(_load_columns(row, self._plan), self._plan)
+        records = []
+        self._plan.load_rows(self._plan, row, 0, records)
+        return records
+
+    def _parse(self, eof):
+        buf = self._buf
+        len_buf = len(buf)
+        pos = 0
+        records = []
+
+        while True:
+            while pos < len_buf and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len_buf:
+                break
+
+            state = self._state
+            if state == _START:
+                if buf[pos] != u"[":
+                    raise ValueError("KSON document must be an array")
+                pos += 1
+                self._state = _HEADER
+            elif state == _HEADER:
+                if buf[pos] == u"]":
+                    pos += 1
+                    self._state = _DONE
+                    continue
+                val, pos = self._decode_value(buf, pos, eof)
+                if val is _INCOMPLETE:
+                    break
+                records.extend(self._init_header(val))
+                self._state = _VALUES
+            elif state == _VALUES:
+                char = buf[pos]
+                if char == u"]":
+                    pos += 1
+                    records.extend(self._flush_row())
+                    self._state = _DONE
+                    continue
+                if char != u",":
+                    raise ValueError("Expected ',' at position %d" % pos)
+
+                val_pos = pos + 1
+                while val_pos < len_buf and buf[val_pos] in _WHITESPACE:
+                    val_pos += 1
+                if val_pos == len_buf:
+                    break
+
+                val, end = self._decode_value(buf, val_pos, eof)
+                if val is _INCOMPLETE:
+                    break
+                pos = end
+                records.extend(self._add_value(val))
+            else:
+                raise ValueError("Extra data after KSON document")
+
+        self._buf = buf[pos:]
+        return records
+
+    def _decompress(self, chunk, eof=False):
+        if self._head is not None:
+            chunk = self._head + chunk
+            if len(chunk) < MAGIC_SIZE and not eof:
+                self._head = chunk
+                return b""
+            self._head = None
+            self.compression = _detect_start(chunk, self.dictionary)
+            if self.compression:
+                decompressor = _compression_format(self.compression)[3]
+                self._decompressor = decompressor(self.dictionary)
+        if self._decompressor is None:
+            return chunk
+        return self._decompressor.decompress(chunk)
+
+    def feed(self, chunk):
+        if isinstance(chunk, (bytearray, memoryview)):
+            chunk = bytes(chunk)
+        if isinstance(chunk, bytes) and (self._head is not None or
+                                         self._decompressor is not None):
+            chunk = self._decompress(chunk)
+        if isinstance(chunk, bytes) and not PY2:
+            if self._text_decoder is None:
+                self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+            chunk = self._text_decoder.decode(chunk)
+        self._buf += chunk
+        return self._parse(False)
+
+    def close(self):
+        records = []
+        if self._head:
+            # documents shorter than MAGIC_SIZE
+            records = self.feed(self._decompress(b"", eof=True))
+        records.extend(self._parse(True))
+        if self._state != _DONE:
+            raise ValueError("Unexpected end of KSON document")
+        return records
+
+
+def iterload(fp_or_filename, schema_id=None, chunk_size=CHUNK_SIZE,
+             registry=None, dictionary=None):
+    """generator which yields the records of a KSON document
+
+    Only the current chunk and record are kept in memory, so arbitrarily
+    large "[]schema" documents can be decoded. Compressed documents are
+    decompressed chunk by chunk.
+    """
+    if isinstance(fp_or_filename, (str, bytes)):
+        with open(fp_or_filename, 'rb') as fp:
+            for record in iterload(fp, schema_id, chunk_size, registry,
+                                   dictionary):
+                yield record
+        return
+
+    decoder = StreamDecoder(schema_id, registry=registry,
+                            dictionary=dictionary)
+    read = fp_or_filename.read
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        for record in decoder.feed(chunk):
+            yield record
+
+    for record in decoder.close():
+        yield record
+
+
+class KSONWriter(object):
+    """Writes the records of a "[]schema" document to a file object.
+
+    The envelope is written immediately and records are encoded as they
+    are passed to write, so only the current record and the write
+    buffer are held in memory.
+
+    With index_block=n, the byte offset of every n-th record is recorded
+    and the index is available as writer.index once the writer is
+    closed (see kson.index.KSONFile).
+
+    With compression="gzip", "zlib", "zstd" or "lz4", the output is
+    compressed as it is written. Since offsets refer to the uncompressed
+    document, compression can't be combined with index_block.
+    """
+
+    def __init__(self, fp, schema_id, buffer_size=CHUNK_SIZE, registry=None,
+                 index_block=None, compression=None, dictionary=None):
+        schema_id = schema_id[2:] if schema_id[0] == u"[" else schema_id
+        if compression and index_block:
+            raise ValueError("Compressed documents can't be indexed")
+        self._compressed = None
+        if compression:
+            fp = self._compressed = CompressedWriter(fp, compression,
+                                                     dictionary=dictionary)
+        self.fp = fp
+        self.schema_id = schema_id
+        self.buffer_size = buffer_size
+        self.closed = False
+        self.n_records = 0
+        self.index = None
+        self._index_block = index_block
+        self._offsets = []
+        self._pos = 0
+        if index_block:
+            try:
+                self._pos = fp.tell()
+            except (AttributeError, IOError, ValueError):
+                pass
+        self._plan = (registry or DEFAULT_REGISTRY).get_plan(schema_id)
+        self._binary = isinstance(fp, (io.RawIOBase, io.BufferedIOBase))
+        # binary files are written using the bytes output of the json
+        # backend, which saves encoding every record
+        if self._binary:
+            self._dumps = json_dumps_bytes
+            self._empty, self._sep, self._end = b"", b",", b"]"
+        else:
+            self._dumps = json_dumps
+            self._empty, self._sep, self._end = u"", u",", u"]"
+        self._buf = []
+        self._buf_size = 0
+        # string tables of the intern codec
+        self._tables = {}
+
+        self._write_raw(self._dumps(["[]" + schema_id])[:-1])
+        self.flush()
+
+    def _write_raw(self, data):
+        if self._index_block:
+            self._pos += len(data) if self._binary else len(
+                data.encode('utf-8')
+            )
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size >= self.buffer_size:
+            self._write_buf()
+
+    def _write_buf(self):
+        if not self._buf:
+            return
+        data = self._empty.join(self._buf)
+        self._buf = []
+        self._buf_size = 0
+        self.fp.write(data)
+
+    def write(self, record):
+        if self.closed:
+            raise ValueError("write to closed KSONWriter")
+        vals = []
+        if self._plan.stateful:
+            prev_tables = _enter_document(self._tables)
+            try:
+                self._plan.dump_rows(self._plan, (record,), vals)
+            finally:
+                _exit_document(prev_tables)
+        else:
+            self._plan.dump_rows(self._plan, (record,), vals)
+        if not vals:
+            return
+        if self._index_block and self.n_records % self._index_block == 0:
+            self._offsets.append(self._pos)
+        self.n_records += 1
+        self._write_raw(self._sep + self._dumps(vals)[1:-1])
+
+    def writerows(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        self._write_buf()
+        if hasattr(self.fp, 'flush'):
+            self.fp.flush()
+
+    def close(self):
+        """terminates the document, the file object is not closed"""
+        if self.closed:
+            return
+        if self._index_block:
+            self.index = {
+                'schema_id': self.schema_id,
+                'n_records': self.n_records,
+                'block_size': self._index_block,
+                'offsets': self._offsets,
+                'end': self._pos,
+            }
+        self._write_raw(self._end)
+        self.flush()
+        if self._compressed is not None:
+            self._compressed.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # the document is incomplete, so it isn't terminated
+            self.closed = True
+
+
+def dump_iter(records, fp_or_filename, schema_id, buffer_size=CHUNK_SIZE,
+              registry=None, index_block=None, compression=None,
+              dictionary=None):
+    """write an iterable of records as a "[]schema" document
+
+    With index_block=n, an index of the offsets of every n-th record is
+    returned. For file names, it is also written to a sidecar file with
+    the suffix kson.index.INDEX_SUFFIX.
+
+    The output is compressed with compression (see KSONWriter), for file
+    names it defaults to the compression implied by the extension.
+    """
+    if isinstance(fp_or_filename, (str, bytes)):
+        compression = compression or compression_for_filename(fp_or_filename)
+        with open(fp_or_filename, 'wb') as fp:
+            index = dump_iter(records, fp, schema_id, buffer_size, registry,
+                              index_block, compression, dictionary)
+        if index is not None:
+            from kson.index import write_index, index_path
+            write_index(index, index_path(fp_or_filename))
+        return index
+
+    with KSONWriter(fp_or_filename, schema_id, buffer_size, registry,
+                    index_block, compression, dictionary) as writer:
+        writer.writerows(records)
+    return writer.index
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
+import io
 import os
+import sys
 import json
 import kson
 from kson.command import main
-from datetime import datetime
+from datetime import datetime, timedelta, tzinfo
 
 BASEPATH = os.path.abspath(os.path.dirname(__file__) + "/..")
 FIXTURES_PATH = BASEPATH + "/test_data/"
@@ -209,3 +211,879 @@ def test_command_j2k():
         "--schema_id", "uc-fb-photos",
         "--out_schema_id", "c-fb-photos",
     ])
+
+
+def test_schema_replacement():
+    kson.add_schema({'id': 'tree', 'fields': [], 'meta': []})
+    kson.add_schema({
+        'id': 'forest',
+        'fields': ['name', 'trees'],
+        'meta': [0, "[]tree"]
+    })
+    kson.add_schema({
+        'id': 'tree',
+        'fields': ['height', 'branches'],
+        'meta': ["int36", "[]tree"]
+    })
+    forest = {
+        'name': "black",
+        'trees': [
+            {'height': 100, 'branches': [{'height': 35, 'branches': []}]},
+            {'height': 12, 'branches': None},
+        ]
+    }
+    raw = kson.dumps(forest, 'forest')
+    assert raw == '["forest","black",["2s",["z",[]],"c",null]]'
+    assert kson.loads(raw) == forest
+
+
+def test_codegen_round_trip():
+    kson.add_schema({
+        'id': 'cg_role',
+        'fields': ['name', 'lead'],
+        'meta': [0, "bool"]
+    }, codegen=True)
+    kson.add_schema({
+        'id': 'cg_movie',
+        'fields': ['title', 'cover', 'genres', 'released', 'actors'],
+        'meta': [
+            0,
+            "prefix:http\\://movies.db/covers/|suffix:.jpg",
+            "[]enum:drama:comedy",
+            "date|int36",
+            "[]cg_role",
+        ]
+    }, codegen=True)
+    assert kson.PLANS['cg_movie'].dump_rows.__name__ == "dump_cg_movie"
+
+    movies = [{
+        'title': "Forrest Gump",
+        'cover': "http://movies.db/covers/8.jpg",
+        'genres': ["drama", "comedy", "romance"],
+        'released': datetime(1994, 7, 6),
+        'actors': [
+            {'name': "Tom Hanks", 'lead': True},
+            {'name': "Gary Sinise", 'lead': False},
+        ]
+    }, {
+        'title': "Unknown",
+        'cover': None,
+        'genres': [],
+        'released': None,
+        'actors': None,
+    }]
+    raw = kson.dumps(movies, "[]cg_movie")
+    assert raw == (
+        '["[]cg_movie","Forrest Gump","8",[1,2,"romance"],"cshs00",'
+        '["Tom Hanks",1,"Gary Sinise",0],"Unknown",null,[],null,null]'
+    )
+    assert kson.loads(raw) == movies
+
+    # like enum_codec, unhashable values are passed through
+    movies[1]['genres'] = [["drama"], "comedy"]
+    raw = kson.dumps(movies, "[]cg_movie")
+    assert '[["drama"],2]' in raw
+    assert kson.loads(raw) == movies
+
+    try:
+        kson.dumps([{'cover': "8.jpg"}], "[]cg_movie")
+        assert False, "fail for missing prefix"
+    except ValueError:
+        pass
+
+
+def test_iterload():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = MOVIE_DATA['content']['movies']
+    raw = kson.dumps(movies, "[]movies-item", indent=2)
+
+    for chunk_size in (1, 7, 4096):
+        records = kson.iterload(io.StringIO(raw), chunk_size=chunk_size)
+        assert list(records) == kson.loads(raw)
+
+    records = kson.iterload(io.BytesIO(raw.encode('utf-8')), chunk_size=3)
+    assert data_eq(list(records), movies)
+
+    try:
+        list(kson.iterload(io.StringIO(raw[:-10])))
+        assert False, "fail for truncated document"
+    except ValueError:
+        pass
+
+    # invalid values raise as soon as they are followed by more data
+    from kson.stream import StreamDecoder
+    decoder = StreamDecoder(plain=True)
+    decoder.feed(u'[1, {bad')
+    try:
+        decoder.feed(u" " * 1000)
+        assert False, "fail for invalid value before close"
+    except ValueError:
+        pass
+
+
+def test_dump_iter():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = MOVIE_DATA['content']['movies']
+
+    fp = io.StringIO()
+    kson.dump_iter((m for m in movies), fp, "[]movies-item", buffer_size=64)
+    assert fp.getvalue() == kson.dumps(movies, "[]movies-item")
+
+    fp = io.BytesIO()
+    with kson.KSONWriter(fp, "movies-item") as writer:
+        assert fp.getvalue() == b'["[]movies-item"'
+        writer.writerows(movies)
+    assert data_eq(kson.loads(fp.getvalue()), movies)
+
+    # a document isn't terminated when writing fails
+    fp = io.BytesIO()
+    try:
+        with kson.KSONWriter(fp, "movies-item", buffer_size=0,
+                             index_block=1) as writer:
+            writer.write(movies[0])
+            raise KeyError("fail")
+    except KeyError:
+        pass
+    else:
+        assert False, "expected KeyError"
+    assert writer.closed and writer.index is None
+    try:
+        kson.loads(fp.getvalue())
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_columnar_layout():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = MOVIE_DATA['content']['movies']
+    raw = kson.dumps(movies, "[]movies-item", layout="columnar")
+    data = kson.loads(raw)
+    assert json.loads(raw)[0] == "||movies-item"
+    assert data_eq(data, movies)
+
+    columns = kson.loads(raw, columns=True)
+    assert columns == kson.loads(kson.dumps(movies, "[]movies-item"),
+                                 columns=True)
+    assert columns['title'] == [m['title'] for m in movies]
+    assert columns['cover_big'] == [m['cover_big'] for m in movies]
+    assert list(kson.iterload(io.StringIO(raw), chunk_size=16)) == data
+
+
+def test_as_arrays():
+    try:
+        import numpy
+    except ImportError:
+        return
+
+    kson.add_schema("""[
+        "schema",
+        "telemetry",
+        ["time", "ok", "count", "load", "kind"],
+        ["date|int36", "bool", "int36", 0, "enum:cpu:io"]
+    ]""")
+    records = [{
+        'time': datetime(2013, 4, 2, 12, i),
+        'ok': i % 3 != 0,
+        'count': i * 12345,
+        'load': i / 4.0,
+        'kind': "cpu" if i % 2 else "io",
+    } for i in range(10)]
+
+    for layout in ("rows", "columnar"):
+        raw = kson.dumps(records, "[]telemetry", layout=layout)
+        arrays = kson.loads(raw, as_arrays=True)
+        assert arrays['time'].dtype == numpy.dtype('datetime64[s]')
+        assert arrays['ok'].dtype == numpy.dtype(bool)
+        assert arrays['count'].dtype == numpy.dtype('int64')
+        assert arrays['load'].dtype == numpy.dtype(float)
+        assert list(arrays['time']) == [
+            numpy.datetime64(r['time']) for r in records
+        ]
+        assert list(arrays['ok']) == [r['ok'] for r in records]
+        assert list(arrays['count']) == [r['count'] for r in records]
+        assert list(arrays['load']) == [r['load'] for r in records]
+        assert list(arrays['kind']) == [r['kind'] for r in records]
+
+
+def test_binary_round_trip():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    raw = kson.dumpb(MOVIE_DATA, "movies")
+    assert raw.startswith(b"KSB\x01")
+    assert len(raw) < len(kson.dumps(MOVIE_DATA, "movies"))
+    assert data_eq(kson.loadb(raw), MOVIE_DATA)
+    assert data_eq(kson.loadb(bytearray(raw)), MOVIE_DATA)
+
+    kson.add_schema({
+        'id': 'binary_values',
+        'fields': ["a", "b", "c", "d", "e"],
+        'meta': [0, 0, 0, 0, "[]"]
+    })
+    values = [
+        {'a': -5, 'b': 2 ** 70, 'c': 1.5, 'd': None, 'e': [True, u"\xfc"]},
+        {'a': 127, 'b': -2 ** 70, 'c': -0.0, 'd': {'x': [1]}, 'e': []},
+    ]
+    assert kson.loadb(kson.dumpb(values, "[]binary_values")) == values
+
+    try:
+        kson.loadb(raw[:-1])
+        assert False, "fail for truncated document"
+    except ValueError:
+        pass
+
+
+def test_load_buffers():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = MOVIE_DATA['content']['movies']
+    raw = kson.dumpb(movies, "[]movies-item")
+
+    path = "/tmp/kson_test_movies.ksb"
+    with open(path, 'wb') as fp:
+        fp.write(raw)
+
+    assert data_eq(kson.load(path), movies)
+    assert data_eq(kson.load(memoryview(raw)), movies)
+    assert data_eq(kson.load(bytearray(kson.dumps(movies, "[]movies-item"),
+                                       'utf-8')), movies)
+
+    records = kson.load(path, lazy=True)
+    assert len(records) == len(movies)
+    assert records[3]['title'] == movies[3]['title']
+    assert records[3]['cover_big'] == movies[3]['cover_big']
+    assert data_eq([dict(r) for r in records], movies)
+
+
+def test_lazy_loads():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = MOVIE_DATA['content']['movies']
+    raw = kson.dumps(movies, "[]movies-item")
+
+    records = kson.loads(raw, lazy=True)
+    assert isinstance(records, kson.records.RecordArray)
+    assert len(records) == len(movies)
+    assert records[-1]['title'] == movies[-1]['title']
+    assert records[2] is records[2]
+    assert records.column('cover_small') == [
+        m['cover_small'] for m in movies
+    ]
+    assert [dict(r) for r in records] == kson.loads(raw)
+
+    movie = kson.loads(kson.dumps(movies[0], "movies-item"), lazy=True)
+    assert dict(movie) == movies[0]
+
+
+def test_record_types():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    raw = kson.dumps(MOVIE_DATA, "movies")
+
+    for record_type in ("slots", "namedtuple"):
+        data = kson.loads(raw, record_type=record_type)
+        movie_cls = kson.record_class("movies-item", record_type)
+        movie = data.content.movies[0]
+        assert isinstance(movie, movie_cls)
+        assert movie.title == MOVIE_DATA['content']['movies'][0]['title']
+        assert movie._asdict() == kson.loads(raw)['content']['movies'][0]
+        assert kson.dumps(data, "movies") == raw
+        movies = data.content.movies
+        assert kson.dumps(movies, "[]movies-item", layout="columnar") == (
+            kson.dumps(kson.loads(raw)['content']['movies'], "[]movies-item",
+                       layout="columnar")
+        )
+
+    slots_cls = kson.record_class("movies-status")
+    assert slots_cls.__slots__ == ('code', 'text')
+    assert not hasattr(slots_cls(), '__dict__')
+    assert slots_cls(200, "OK") == slots_cls(code=200, text="OK")
+
+
+def test_detect_schemas():
+    records = [
+        {'id': i, 'user': {'id': i, 'name': "u%d" % i},
+         'reply_to': {'id': i, 'name': "r%d" % i},
+         'tags': ["a", "b"], 'likes': [{'id': i, 'name': "l"}]}
+        for i in range(100)
+    ]
+    sid, schemas = kson.detect_schemas(records, id_prefix="t-detect",
+                                       codecs=False)
+    assert sid == "[]t-detect-0-0"
+    # structurally identical sub schemas are merged
+    assert len(schemas) == 2
+    assert schemas[-1] == {
+        'id': "t-detect-0-0",
+        'fields': ["id", "likes", "reply_to", "tags", "user"],
+        'meta': [0, "[]t-detect-1-0-likes", "t-detect-1-0-likes", "[]",
+                 "t-detect-1-0-likes"],
+    }
+    assert kson.loads(kson.dumps(records, sid)) == records
+
+    consumed = []
+
+    def stream():
+        for record in records:
+            consumed.append(record)
+            yield record
+
+    sid, schemas = kson.detect_schemas(stream(), "t-detect-s", sample=10)
+    assert sid == "[]t-detect-s-0-0"
+    assert len(consumed) == 10
+
+    def failing_stream():
+        yield records[0]
+        raise IOError()
+
+    try:
+        kson.detect_schemas(failing_stream(), "t-detect-f")
+        assert False
+    except IOError:
+        pass
+    assert not [s for s in kson.SCHEMAS if s.startswith("t-detect-f")]
+
+    # children of different parents with the same name and other fields
+    data = {'a': {'data': {'x': 1}}, 'b': {'data': {'y': "s"}}}
+    sid, schemas = kson.detect_schemas(data, "t-detect-n")
+    assert len(set(s['id'] for s in schemas)) == len(schemas) == 5
+    assert kson.loads(kson.dumps(data, sid)) == data
+
+    try:
+        kson.detect_schemas(records, "t-detect-z", sample=0)
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_detect_codecs():
+    kinds = ["cpu", "io", "net"]
+    records = [{
+        'kind': kinds[i % 3],
+        'ok': i % 2 == 0,
+        'count': 10 ** 9 + i,
+        'time': datetime(2013, 4, 2, 0, i % 60),
+        'cover': "http://movies.db/covers/%d.jpg" % i,
+        'load': i / 10.0,
+    } for i in range(50)]
+
+    savings = []
+    sid, schemas = kson.detect_schemas(records, "t-codecs", savings=savings)
+    assert schemas[0]['fields'] == [
+        "count", "cover", "kind", "load", "ok", "time"
+    ]
+    assert schemas[0]['meta'] == [
+        "int36", "prefix:http\\://movies.db/covers/|suffix:.jpg",
+        "enum:cpu:io:net", 0, "bool", "date|int36",
+    ]
+    assert all(item[3] > 0 for item in savings)
+    assert kson.loads(kson.dumps(records, sid)) == records
+
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = MOVIE_DATA['content']['movies']
+    assert kson.detect_codecs(movies, "[]movies-item") == [
+        ("movies-item", "description", "prefix:<p>|suffix:</p>", 41)
+    ]
+
+    # values outside of the sample may lack the affixes
+    records[-1]['cover'] = "none"
+    sid, schemas = kson.detect_schemas(records, "t-codecs-s", sample=10)
+    assert schemas[0]['meta'][1] == 0
+    assert kson.loads(kson.dumps(records, sid)) == records
+
+    # the date codec would drop microseconds and utc offsets
+    class Offset(tzinfo):
+        def utcoffset(self, dt):
+            return timedelta(hours=2)
+
+    records = [
+        {'time': datetime(2020, 1, 1, 0, 0, 0, 123456)},
+        {'time': datetime(2021, 1, 1, tzinfo=Offset())},
+    ]
+    sid, schemas = kson.detect_schemas(records, "t-codecs-t")
+    assert schemas[0]['meta'] == [0]
+    raw = kson.dumps(records, sid, default=datetime.isoformat)
+    assert kson.loads(raw) == [
+        {'time': r['time'].isoformat()} for r in records
+    ]
+
+
+def test_codec_chains():
+    enc, dec = kson.ENCODERS["enum:a:b:c"], kson.DECODERS["enum:a:b:c"]
+    assert [enc(v) for v in ["a", "c", "x", ["y"]]] == [1, 3, "x", ["y"]]
+    assert [dec(v) for v in [1, 3, "x"]] == ["a", "c", "x"]
+
+    kson.init_codec("prefix:ab|suffix:ba")
+    assert kson.ENCODERS["prefix:ab|suffix:ba"]("abxba") == "x"
+    assert kson.DECODERS["prefix:ab|suffix:ba"]("x") == "abxba"
+
+    calls = []
+
+    @kson.add_codec("t_scale")
+    def scale_codec(args):
+        factor = int(args[0])
+
+        def encode_many(vals):
+            calls.append(len(vals))
+            return [v * factor for v in vals]
+
+        return (lambda v: v * factor), (lambda v: v // factor), encode_many
+
+    kson.add_schema({
+        'id': "t-scaled",
+        'fields': ["vals", "tags"],
+        'meta': ["[]t_scale:10", "[]enum:x:y"],
+    })
+    data = {'vals': [1, 2, 3], 'tags': ["y", "x", "z"]}
+    raw = kson.dumps(data, "t-scaled")
+    assert raw == '["t-scaled",[10,20,30],[2,1,"z"]]'
+    assert calls == [3]
+    assert kson.loads(raw) == data
+
+
+def test_schema_registry():
+    tenant_a = kson.SchemaRegistry()
+    tenant_b = kson.SchemaRegistry()
+    tenant_a.add_schema({'id': "t-user", 'fields': ["a", "b"], 'meta': [0, 0]})
+    tenant_b.add_schema({'id': "t-user", 'fields': ["b"], 'meta': ["bool"]})
+    assert "t-user" not in kson.SCHEMAS
+
+    data = {'a': 1, 'b': True}
+    assert tenant_a.dumps(data, "t-user") == '["t-user",1,true]'
+    assert tenant_b.dumps(data, "t-user") == '["t-user",1]'
+    assert tenant_b.loads('["t-user",1]') == {'b': True}
+    assert tenant_a.loadb(tenant_a.dumpb(data, "t-user")) == data
+
+    snapshot = tenant_a.snapshot()
+    tenant_a.add_schema({'id': "t-user", 'fields': ["a"], 'meta': [0]})
+    assert snapshot.loads('["t-user",1,true]') == data
+    assert tenant_a.loads('["t-user",1,true]') == {'a': True}
+    try:
+        snapshot.add_schema({'id': "t-other", 'fields': [], 'meta': []})
+        assert False
+    except ValueError:
+        pass
+
+    tenant_b.add_codec("t_upper", lambda args: (
+        lambda v: v.upper(), lambda v: v.lower()
+    ))
+    assert "t_upper" not in kson.CODEC_FACTORIES
+    tenant_b.add_schema({'id': "t-name", 'fields': ["n"], 'meta': ["t_upper"]},
+                        codegen=True)
+    assert tenant_b.dumps({'n': "ab"}, "t-name") == '["t-name","AB"]'
+    assert tenant_b.loads('["t-name","AB"]') == {'n': "ab"}
+
+
+def test_cli_parallel_convert():
+    from kson import command
+
+    movies = MOVIE_DATA['content']['movies'] * 3
+    # delimiters in strings don't split elements
+    movies.append(dict(movies[0], title=u'a "[b]", {c}\\'))
+    json_path = "/tmp/kson_test_movies.json"
+    with open(json_path, 'w') as f:
+        json.dump(movies, f)
+
+    schemas_path = FIXTURES_PATH + "movie_schemas.json"
+    chunk_sizes = (command.PARALLEL_CHUNK_CHARS, command.CHUNK_SIZE)
+    command.PARALLEL_CHUNK_CHARS, command.CHUNK_SIZE = 2000, 7
+    try:
+        outputs = []
+        for jobs in ("1", "2"):
+            out_path = "/tmp/kson_test_movies_%s.kson" % jobs
+            args = ["j2k", schemas_path, "--schema_id", "movies-item",
+                    "-i", json_path, "-o", out_path, "--jobs", jobs]
+            assert command.main(args) == 0
+            with open(out_path) as f:
+                outputs.append(f.read())
+
+        assert outputs[0] == outputs[1]
+        assert kson.loads(outputs[1]) == movies
+
+        args = ["k2j", schemas_path, "--schema_id", "movies-item",
+                "-i", out_path, "-o", json_path, "--jobs", "2"]
+        assert command.main(args) == 0
+        with open(json_path) as f:
+            assert json.load(f) == movies
+    finally:
+        command.PARALLEL_CHUNK_CHARS, command.CHUNK_SIZE = chunk_sizes
+
+
+def test_kson_lines():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = kson.loads(kson.dumps(MOVIE_DATA, "movies"))['content']['movies']
+    path = "/tmp/kson_test_movies.ksonl"
+
+    kson.dump_lines(movies[:2], path, "[]movies-item")
+    kson.dump_lines(movies[2:], path, "movies-item", append=True)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == '["[]movies-item"]'
+    assert len(lines) == len(movies) + 1
+    assert lines[1] == kson.json_dumps(
+        kson.dumps(movies[0], "movies-item", is_recurse=True)
+    )
+    assert list(kson.iter_lines(path)) == movies
+
+    # files are written as utf-8, whatever the locale
+    movie = dict(movies[0], title=u"Am\xe9lie")
+    default = kson.get_backend()
+    try:
+        for name in sorted(kson.JSON_BACKENDS):
+            try:
+                kson.set_backend(name)
+            except ImportError:
+                continue
+            kson.dump_lines([movie], path, "[]movies-item")
+            with open(path, 'rb') as f:
+                f.read().decode('utf-8')
+            assert list(kson.iter_lines(path)) == [movie]
+    finally:
+        kson.set_backend(default)
+
+    # embedded schemas are only added to a copy of the registry
+    registry = kson.SchemaRegistry()
+    buf = io.StringIO()
+    kson.dump_lines(movies, buf, "movies-item", embed_schemas=True)
+    buf.seek(0)
+    assert list(registry.iter_lines(buf)) == movies
+    assert "movies-item" not in registry.schemas
+
+
+def test_json_backends():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    default = kson.get_backend()
+    try:
+        for name in sorted(kson.JSON_BACKENDS):
+            try:
+                kson.set_backend(name)
+            except ImportError:
+                continue
+            assert kson.get_backend() == name
+            raw = kson.dumps(MOVIE_DATA, "movies", as_bytes=True)
+            assert isinstance(raw, bytes)
+            assert raw.decode('utf-8') == kson.dumps(MOVIE_DATA, "movies")
+            assert data_eq(kson.loads(raw), MOVIE_DATA)
+            assert data_eq(kson.loads(bytearray(raw)), MOVIE_DATA)
+            # types json can't serialize raise the same error
+            try:
+                kson.json_dumps([datetime(2013, 4, 2)])
+                assert False, "expected TypeError"
+            except TypeError:
+                pass
+
+        # the default backend is lossless
+        assert kson.set_backend("auto") in ("ujson", "json")
+        raw = '[123456789012345678901234567890,1.5]'
+        assert kson.loads(raw) == [123456789012345678901234567890, 1.5]
+    finally:
+        kson.set_backend(default)
+
+    try:
+        kson.set_backend("nope")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_loads_fields():
+    kson.load_schemas(FIXTURES_PATH + "fb_photo_schemas_plain.json")
+    with open(FIXTURES_PATH + "fb_photos.json", 'r') as f:
+        photos = json.load(f)
+    raw = kson.dumps(photos, "fb-photos")
+
+    result = kson.loads(raw, fields=["paging", "data.id", "data.likes.data"])
+    assert result['paging'] == photos['paging']
+    assert list(result) == ["data", "paging"]
+    for photo, expected in zip(result['data'], photos['data']):
+        assert list(photo) == ["id", "likes"]
+        assert photo['id'] == expected['id']
+        if 'likes' in expected:
+            assert photo['likes'] == {'data': expected['likes']['data']}
+
+    # the complete field is selected if also a sub field is given
+    result = kson.loads(raw, fields=["data.from", "data.from.id", "data"])
+    assert data_eq(result['data'], kson.loads(raw)['data'])
+
+    try:
+        kson.loads(raw, fields=["data.nope"])
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_kson_file():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = kson.loads(kson.dumps(MOVIE_DATA, "movies"))['content']['movies']
+    movies = [dict(movie, title=u"%s \u2603 %d" % (movie['title'], i))
+              for i in range(50) for movie in movies]
+    path = "/tmp/kson_test_movies_indexed.kson"
+
+    index = kson.dump_iter(iter(movies), path, "[]movies-item", index_block=7)
+    assert index['n_records'] == len(movies)
+    with kson.KSONFile(path) as kf:
+        assert len(kf) == len(movies)
+        assert kf[0] == movies[0]
+        assert kf[123] == movies[123]
+        assert kf[-1] == movies[-1]
+        assert kf[5:100:9] == movies[5:100:9]
+        assert kf[::-1] == movies[::-1]
+        assert list(kf) == movies
+        try:
+            kf[len(movies)]
+            assert False, "expected IndexError"
+        except IndexError:
+            pass
+
+    # offsets of text files are counted in bytes
+    with io.open(path, 'w', encoding='utf-8') as fp:
+        with kson.KSONWriter(fp, "movies-item", index_block=10) as writer:
+            writer.writerows(movies)
+    kf = kson.KSONFile(path, index=writer.index, fields=["title"])
+    assert kf[77] == {'title': movies[77]['title']}
+    kf.close()
+
+
+def test_compression():
+    from kson.compression import (
+        compress, decompress, detect, maybe_decompress, CompressedWriter,
+        train_dictionary,
+    )
+    from kson.stream import StreamDecoder
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = kson.loads(kson.dumps(MOVIE_DATA, "movies"))['content']['movies']
+    movies = movies * 30
+    raw = kson.dumps(movies, "[]movies-item", as_bytes=True)
+
+    for compression in ("gzip", "zlib"):
+        data = compress(raw, compression)
+        assert detect(data[:4]) == compression
+        assert len(data) < len(raw)
+        assert decompress(data) == raw
+    assert detect(raw[:4]) is None
+
+    # plain documents which look like a zlib header
+    assert detect(b"80") is None
+    assert maybe_decompress(b"x\x9cnot compressed") == b"x\x9cnot compressed"
+    path = "/tmp/kson_test_number.kson"
+    with open(path, 'wb') as fp:
+        fp.write(b"80")
+    assert kson.load(path) == 80
+    assert kson.load(io.BytesIO(b"80")) == 80
+
+    path = "/tmp/kson_test_movies.kson.gz"
+    kson.dump(movies, path, "[]movies-item")
+    with open(path, 'rb') as fp:
+        assert fp.read(2) == b"\x1f\x8b"
+    assert kson.load(path) == movies
+    assert list(kson.iterload(path, chunk_size=100)) == movies
+
+    buf = io.BytesIO()
+    kson.dump(movies, buf, "[]movies-item", compression="zlib")
+    assert kson.load(io.BytesIO(buf.getvalue())) == movies
+
+    # streaming compression, decompressed as the chunks are fed
+    buf = io.BytesIO()
+    kson.dump_iter(iter(movies), buf, "[]movies-item", buffer_size=500,
+                   compression="gzip")
+    data = buf.getvalue()
+    decoder = StreamDecoder()
+    records = []
+    for i in range(0, len(data), 3):
+        records.extend(decoder.feed(data[i:i + 3]))
+    records.extend(decoder.close())
+    assert decoder.compression == "gzip"
+    assert records == movies
+
+    schema_path = "/tmp/kson_test_schemas.json.zz"
+    with open(FIXTURES_PATH + "movie_schemas.json", 'rb') as fp:
+        with CompressedWriter(open(schema_path, 'wb'), "zlib",
+                              close_fp=True) as out:
+            out.write(fp.read())
+    assert kson.load_schemas(schema_path)
+
+    try:
+        kson.dump(movies, io.BytesIO(), "[]movies-item", compression="xz")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+    try:
+        import zstandard  # noqa
+    except ImportError:
+        return
+    dictionary = train_dictionary(movies, "movies-item", dict_size=1024)
+    buf = io.BytesIO()
+    kson.dump(movies[0], buf, "movies-item", compression="zstd",
+              dictionary=dictionary)
+    assert kson.load(io.BytesIO(buf.getvalue()),
+                     dictionary=dictionary) == movies[0]
+
+
+def test_aio():
+    if sys.version_info < (3, 6):
+        return
+    import asyncio
+    from kson.aio import aload_iter, adump_iter
+
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = kson.loads(kson.dumps(MOVIE_DATA, "movies"))['content']['movies']
+    movies = movies * 20
+
+    class Writer(object):
+        def __init__(self):
+            self.chunks = []
+            self.n_drains = 0
+
+        def write(self, data):
+            self.chunks.append(data)
+
+        def drain(self):
+            self.n_drains += 1
+            return asyncio.sleep(0)
+
+    loop = asyncio.new_event_loop()
+    try:
+        writer = Writer()
+        loop.run_until_complete(adump_iter(writer, iter(movies),
+                                           "[]movies-item", buffer_size=256))
+        raw = b"".join(writer.chunks)
+        assert writer.n_drains > 2
+        assert kson.loads(raw) == movies
+
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(raw)
+        reader.feed_eof()
+        records = aload_iter(reader, chunk_size=100)
+        result = []
+        while True:
+            try:
+                result.append(loop.run_until_complete(records.__anext__()))
+            except StopAsyncIteration:
+                break
+        assert result == movies
+    finally:
+        loop.close()
+
+
+def test_intern_codec():
+    kson.add_schema({
+        'id': "interned",
+        'fields': ["name", "city", "tags", "n"],
+        'meta': ["intern", "prefix:c-|intern:cities", "[]intern", 0],
+    })
+    data = [{
+        'name': "name-%d" % (i % 5),
+        'city': "c-%d" % (i % 3),
+        'tags': ["a", "b", "name-1"][:i % 4],
+        'n': i,
+    } for i in range(20)]
+
+    raw = kson.dumps(data, "[]interned")
+    assert raw.startswith('["[]interned","name-0","0",[],0,"name-1","1",["a"]')
+    assert len(raw) < len(json.dumps(data))
+    result = kson.loads(raw)
+    assert result == data
+    assert result[0]['name'] is result[5]['name']
+
+    columnar = kson.dumps(data, "[]interned", layout="columnar")
+    assert kson.loads(columnar) == data
+    assert list(kson.iterload(io.StringIO(raw), chunk_size=10)) == data
+    assert kson.loadb(kson.dumpb(data, "[]interned")) == data
+
+    for kwargs in ({'lazy': True}, {'fields': ["n"]}, {'columns': True}):
+        try:
+            kson.loads(raw, **kwargs)
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+
+    for name in (5, ["x"], {'x': 1}):
+        try:
+            kson.dumps([{'name': name}], "[]interned")
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+
+
+def test_sequence_codecs():
+    kson.add_schema({
+        'id': "series",
+        'fields': ["time", "value", "steps", "state"],
+        'meta': ["date|delta", "dod", "[]delta|rle", "rle"],
+    })
+    start = datetime(2013, 4, 2)
+    data = [{
+        'time': start + timedelta(seconds=15 * i),
+        'value': i * i,
+        'steps': [1, 2, 3, 3, 3, 4][:i % 7],
+        'state': "ok" if i % 50 else "failed",
+    } for i in range(200)]
+
+    raw = kson.dumps(data, "[]series", layout="columnar")
+    assert raw.startswith('["||series",[1364860800,15,15,')
+    assert '["ok",49],"failed",' in raw
+    assert kson.loads(raw) == data
+    assert list(kson.iterload(io.StringIO(raw))) == data
+
+    # rle is only supported for [] fields and columns
+    try:
+        kson.dumps(data, "[]series")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+    for obj in data:
+        obj['state'] = None
+    raw = kson.dumps(data, "[]series")
+    assert raw.startswith('["[]series",1364860800,0,[],null,15,1,[1],null,')
+    assert '[[1,3],[0,2],1]' in raw
+    assert kson.loads(raw) == data
+    assert list(kson.iterload(io.StringIO(raw), chunk_size=20)) == data
+
+    # None is skipped by delta and dod in both layouts
+    data[3]['time'] = data[7]['value'] = None
+    rows = kson.loads(kson.dumps(data, "[]series"))
+    columnar = kson.loads(kson.dumps(data, "[]series", layout="columnar"))
+    assert rows == columnar == data
+
+
+def test_stats():
+    kson.load_schemas(FIXTURES_PATH + "movie_schemas.json")
+    movies = kson.loads(kson.dumps(MOVIE_DATA, "movies"))['content']['movies']
+    plan = kson.get_plan("movies-item")
+
+    with kson.collect_stats() as stats:
+        raw = kson.dumps(movies, "[]movies-item")
+        assert kson.loads(raw) == movies
+        assert kson.loads(raw, fields=["title"])[0] == {
+            'title': movies[0]['title']
+        }
+        result = kson.get_stats()
+        assert kson.get_plan("movies-item") is not plan
+
+    assert kson.get_stats() is None
+    assert kson.get_plan("movies-item") is not plan
+    assert stats.as_dict() == result
+
+    counters = result['schemas']['movies-item']
+    assert counters['dumps'] == 1
+    assert counters['loads'] == 2
+    assert counters['dumps_bytes'] == len(raw)
+    assert 0 < counters['ratio'] < 1
+    assert counters['dumps_time'] > 0
+    assert result['json']['loads'] == 2
+    assert result['json']['dumps'] == 1
+    for counters in result['codecs'].values():
+        assert counters['encode'] == len(movies)
+        assert counters['decode'] == len(movies)
+
+    stats = kson.enable_stats(measure_ratio=False)
+    kson.dumps(movies, "[]movies-item")
+    assert kson.disable_stats() is stats
+    assert stats.as_dict()['schemas']['movies-item']['ratio'] is None
+
+    report = "/tmp/kson_test_stats.json"
+    kson.dump(movies, "/tmp/kson_test_movies.kson", "[]movies-item")
+    assert main([
+        "stats", FIXTURES_PATH + "movie_schemas.json",
+        "--schema_id", "movies-item", "--json",
+        "--input", "/tmp/kson_test_movies.kson", "--output", report,
+    ]) == 0
+    with open(report) as fp:
+        assert json.load(fp)['schemas']['movies-item']['loads'] == 1